@@ -1,11 +1,39 @@
 import json
 import os
+import re
+import sys
 import csv
+import io
+import gzip
 import uuid
+import tempfile
+import time
+import random
+import heapq
+import bisect
+import unicodedata
+import threading
+import asyncio
+import functools
+import multiprocessing
+try:
+    import fcntl
+except ImportError:
+    # Sin fcntl (Windows) no hay candado entre procesos; el sharding requiere Linux
+    fcntl = None
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime, timedelta
-from telegram import Update
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, filters, ContextTypes
 import requests
+import numpy as np
+import openpyxl
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
 from dotenv import load_dotenv
 import google.generativeai as genai
 
@@ -23,37 +51,45 @@ else:
         print(f" Archivo .env no encontrado en: {os.getcwd()}")
 
 # Configurar Gemini AI
+# Modelos candidatos, en orden de preferencia (el router los reordena según latencia y errores)
+GEMINI_MODELS = [
+    m.strip() for m in os.getenv(
+        'GEMINI_MODELS', 'gemini-2.5-flash,gemini-2.5-pro,gemini-pro-latest,gemini-pro'
+    ).split(',') if m.strip()
+]
+GEMINI_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', '20'))
+GEMINI_SHORT_PROMPT_CHARS = int(os.getenv('GEMINI_SHORT_PROMPT_CHARS', '200'))
+
+# Límites superiores (segundos) de los buckets del histograma de latencia
+LATENCY_BUCKETS = [0.5, 1, 2, 5, 10, 20, 60]
+
+# Instancias de modelos creadas bajo demanda y estadísticas por modelo
+gemini_models = {}
+gemini_model_stats = {}
+
 try:
     gemini_api_key = os.getenv('GEMINI_API_KEY')
     if gemini_api_key:
-        genai.configure(api_key=gemini_api_key)
-        model_name = None
-        try:
-            gemini_model = genai.GenerativeModel('gemini-2.5-flash')
-            model_name = 'gemini-2.5-flash'
-        except:
-            try:
-                gemini_model = genai.GenerativeModel('gemini-2.5-pro')
-                model_name = 'gemini-2.5-pro'
-            except:
-                try:
-                    gemini_model = genai.GenerativeModel('gemini-pro-latest')
-                    model_name = 'gemini-pro-latest'
-                except:
-                    gemini_model = genai.GenerativeModel('gemini-pro')
-                    model_name = 'gemini-pro'
+        gemini_endpoint = os.getenv('GEMINI_API_ENDPOINT')
+        if gemini_endpoint:
+            # Servidor alternativo (por ejemplo, un servidor local que simula Gemini)
+            genai.configure(
+                api_key=gemini_api_key,
+                transport='rest',
+                client_options={'api_endpoint': gemini_endpoint}
+            )
+        else:
+            genai.configure(api_key=gemini_api_key)
         
         gemini_enabled = True
-        print(f" Gemini AI configurado correctamente (modelo: {model_name})")
+        print(f" Gemini AI configurado correctamente (modelos: {', '.join(GEMINI_MODELS)})")
     else:
         print("Advertencia: GEMINI_API_KEY no encontrada en .env")
-        gemini_model = None
         gemini_enabled = False
 except Exception as e:
     print(f"Error al configurar Gemini: {e}")
     import traceback
     traceback.print_exc()
-    gemini_model = None
     gemini_enabled = False
 
 # Archivos
@@ -62,6 +98,10 @@ PRESUPUESTOS_FILE = "presupuestos.json"
 INTERCAMBIOS_FILE = "intercambios.json"
 INGRESOS_FILE = "ingresos.json"
 TASAS_FILE = "tasas.json"
+SINONIMOS_FILE = "sinonimos.json"
+PRESUPUESTOS_CATEGORIAS_FILE = "presupuestos_categorias.json"
+POSICIONES_FILE = "posiciones.json"
+VENTAS_FILE = "ventas.json"
 
 # Categorías disponibles
 CATEGORIAS = [
@@ -69,6 +109,190 @@ CATEGORIAS = [
     "salud", "educacion", "ropa", "tecnologia", "hogar", "otros"
 ]
 
+# Contexto para la IA: meses de historial y límite aproximado de tokens
+AI_CONTEXT_MONTHS = int(os.getenv('AI_CONTEXT_MONTHS', '3'))
+AI_CONTEXT_MAX_TOKENS = int(os.getenv('AI_CONTEXT_MAX_TOKENS', '600'))
+
+# Versión del registro de cada usuario (se incrementa con cada cambio)
+ledger_versions = {}
+
+# Índice ordenado por (fecha, id) de los gastos de cada usuario, para paginar con cursor
+gastos_index = {}
+
+# Arreglos NumPy (fechas, montos, categorías) de los gastos de cada usuario para las estadísticas
+gastos_arrays = {}
+
+# Índice invertido de texto (descripción y categoría) de los gastos de cada usuario para
+# /buscar, y búsquedas recientes (sus filtros no caben en el callback_data de los botones)
+busqueda_index = {}
+BUSQUEDAS_MAX = 256
+busquedas_guardadas = OrderedDict()
+# Palabras que no se indexan ni se buscan
+PALABRAS_VACIAS = {
+    "de", "del", "la", "las", "el", "los", "en", "y", "o", "a", "al", "un", "una", "unos", "unas",
+    "para", "por", "con", "sin", "que", "mi", "mis", "su", "sus", "lo",
+}
+
+# Sketches KLL de montos (USD) por usuario y categoría: parámetro k (precisión ~1/k,
+# memoria acotada) y mínimo de gastos de una categoría para marcar uno como inusual
+KLL_K = int(os.getenv('KLL_K', '200'))
+GASTO_INUSUAL_MIN = 20
+GASTO_INUSUAL_RANGO = 0.95
+quantile_sketches = {}
+
+# Exportación CSV: bytes que se guardan en memoria antes de pasar a un archivo temporal,
+# filas a partir de las cuales se comprime con gzip y filas por bloque de escritura
+EXPORT_SPOOL_MAX = int(os.getenv('EXPORT_SPOOL_MAX', str(1024 * 1024)))
+EXPORT_GZIP_ROWS = int(os.getenv('EXPORT_GZIP_ROWS', '5000'))
+EXPORT_BLOQUE = 500
+EXPORT_COLUMNAS = {
+    "gastos": ['ID', 'Fecha', 'Bolívares', 'Dólares', 'Tipo Cambio', 'Categoría', 'Descripción'],
+    "intercambios": ['ID', 'Fecha', 'Bolívares', 'USDT', 'Tasa Paralela', 'Descripción'],
+    "ingresos": ['Mes', 'Bolívares', 'USDT', 'Tasa Paralela', 'Fecha Registro'],
+}
+
+# Importación: tamaño máximo del documento (límite de descarga de la API de bots)
+# e importaciones pendientes de documento (/importar sin archivo) por usuario
+IMPORT_MAX_BYTES = 20 * 1024 * 1024
+IMPORT_ESPERA = 600
+importaciones_pendientes = {}
+# Nombres de columna aceptados (en minúsculas y sin acentos) para cada campo
+IMPORT_COLUMNAS = {
+    "id": ("id",),
+    "fecha": ("fecha", "date", "dia"),
+    "bolivares": ("bolivares", "bs", "monto", "monto bs", "cantidad", "amount", "importe"),
+    "dolares": ("dolares", "usd", "monto usd", "dollars"),
+    "tasa": ("tipo cambio", "tipo de cambio", "tasa", "rate"),
+    "categoria": ("categoria", "category"),
+    "descripcion": ("descripcion", "description", "concepto", "detalle"),
+}
+IMPORT_FORMATOS_FECHA = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%d/%m/%y")
+
+# Gráficos PNG ya renderizados (LRU), por (usuario, tipo, período, versión de los datos)
+CHART_CACHE_MAX = int(os.getenv('CHART_CACHE_MAX', '64'))
+chart_state = {"cache": OrderedDict(), "renderizados": 0, "aciertos": 0}
+chart_lock = threading.Lock()
+GRAFICO_TIPOS = ("diario", "categorias", "tasas")
+
+# Proyección de fin de mes: días de la serie diaria móvil de gastos de cada usuario
+# (mínimo 31, para cubrir siempre el mes en curso) y estado mantenido por usuario
+PROYECCION_VENTANA = max(31, int(os.getenv('PROYECCION_VENTANA', '56')))
+proyecciones = {}
+
+# Umbrales (% del presupuesto) que disparan una alerta al registrar gastos; cada uno
+# se avisa una sola vez por mes y presupuesto. Estado de alertas de cada usuario
+PRESUPUESTO_UMBRALES = sorted(int(u) for u in os.getenv('PRESUPUESTO_UMBRALES', '80,100').split(',') if u.strip())
+alertas_presupuesto = {}
+
+# Totales por mes (general y por categoría) de cada usuario para /comparar; un mes
+# cerrado no cambia salvo que se registre, edite o elimine un gasto con esa fecha
+month_rollups = {}
+# Meses máximos en /comparar N
+COMPARAR_MAX_MESES = 36
+
+# Gastos por página en /listar y /buscar (máximo 25) y largo máximo de un mensaje de Telegram
+PAGE_SIZE_MAX = 25
+PAGE_SIZE = min(int(os.getenv('PAGE_SIZE', '10')), PAGE_SIZE_MAX)
+MESSAGE_MAX_CHARS = 4096
+# Telegram limita callback_data a 64 bytes: "pag|<filtro>|25|s|" más un cursor de 23
+# caracteres deja 31 para el filtro; un rango más largo se guarda como búsqueda
+CALLBACK_DATA_MAX = 64
+FILTRO_MAX_CHARS = 31
+# Caracteres de la descripción que se muestran en los listados
+DESCRIPCION_MAX_LISTADO = 200
+
+# Snapshots del contexto financiero para la IA por usuario
+ai_context_snapshots = {}
+
+# Planificador de handlers: prioridades (menor número = mayor prioridad)
+PRIORIDAD_ALTA = 0   # registro de gastos, intercambios, ingresos y consulta de tasas
+PRIORIDAD_MEDIA = 1  # consultas (resúmenes, listados, estadísticas, exportación)
+PRIORIDAD_BAJA = 2   # consultas a la IA
+PRIORIDAD_NOMBRES = {PRIORIDAD_ALTA: "alta", PRIORIDAD_MEDIA: "media", PRIORIDAD_BAJA: "baja"}
+
+# Handlers ejecutándose a la vez, cuántos de ellos pueden ser consultas a la IA
+# y cuántas consultas a la IA puede tener pendientes cada usuario
+SCHED_MAX_CONCURRENT = int(os.getenv('SCHED_MAX_CONCURRENT', '8'))
+SCHED_MAX_AI_CONCURRENT = int(os.getenv('SCHED_MAX_AI_CONCURRENT', '2'))
+SCHED_AI_QUOTA_PER_USER = int(os.getenv('SCHED_AI_QUOTA_PER_USER', '2'))
+# Objetivo de latencia p99 (ms) para la prioridad alta; si se supera, la IA baja a un solo hilo
+SCHED_P99_TARGET_MS = float(os.getenv('SCHED_P99_TARGET_MS', '500'))
+
+scheduler_state = {"activos": 0, "activos_ia": 0, "cola": [], "secuencia": 0}
+scheduler_ai_pending = {}
+scheduler_metrics = {
+    prioridad: {"esperas": deque(maxlen=1000), "latencias": deque(maxlen=1000), "atendidos": 0, "rechazados": 0}
+    for prioridad in PRIORIDAD_NOMBRES
+}
+
+# Modo de ejecución: "polling" (por defecto) o "webhook"
+BOT_MODE = os.getenv('BOT_MODE', 'polling').strip().lower()
+# Webhook: URL pública base, dirección y puerto donde escucha el servidor embebido,
+# ruta del endpoint, token secreto y certificado/clave (solo si no hay proxy inverso con TLS)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').strip().rstrip('/')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram').strip().strip('/')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '').strip()
+WEBHOOK_CERT = os.getenv('WEBHOOK_CERT', '').strip()
+WEBHOOK_KEY = os.getenv('WEBHOOK_KEY', '').strip()
+# Endpoint de salud (GET /health); desactivado (0) salvo que se indique un puerto,
+# así en modo polling el bot no abre ningún puerto
+HEALTH_LISTEN = os.getenv('HEALTH_LISTEN', '127.0.0.1')
+HEALTH_PORT = int(os.getenv('HEALTH_PORT', '0'))
+# API de Telegram alternativa (por ejemplo, un servidor Bot API local o de prueba)
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL', '').strip()
+
+# Candados por usuario: los updates de un mismo usuario se procesan en orden de llegada
+user_locks = {}
+
+# Candado de almacenamiento: toda lectura-modificación-escritura de los JSON se hace
+# con este candado tomado, para que dos escrituras no se pisen entre sí
+storage_lock = threading.RLock()
+
+# Pool de E/S: lecturas/escrituras de los JSON, exportaciones y consultas de tasas
+# se ejecutan fuera del event loop para que un disco lento no frene a los demás updates
+IO_MAX_WORKERS = int(os.getenv('IO_MAX_WORKERS', '8'))
+io_executor = ThreadPoolExecutor(max_workers=IO_MAX_WORKERS, thread_name_prefix="bot-io")
+
+# Pool propio de las llamadas a Gemini: una llamada abandonada por timeout sigue ocupando
+# su hilo hasta que el SDK corta la petición (también a los GEMINI_TIMEOUT segundos), y
+# así no llena el pool por defecto ni frena al resto de la E/S
+GEMINI_MAX_WORKERS = int(os.getenv('GEMINI_MAX_WORKERS', '4'))
+gemini_executor = ThreadPoolExecutor(max_workers=GEMINI_MAX_WORKERS, thread_name_prefix="bot-gemini")
+
+# Tiempos de E/S: espera en la cola del pool, duración y totales por función
+io_metrics = {"esperas": deque(maxlen=1000), "duraciones": deque(maxlen=1000), "en_curso": 0, "por_funcion": {}}
+
+# Sharding: con BOT_WORKERS > 1 un proceso frontal recibe los updates y los reparte
+# entre procesos trabajadores según user_id; cada trabajador es dueño de los datos de sus usuarios
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '1'))
+SHARDS_DIR = os.getenv('SHARDS_DIR', os.path.join(script_dir, "shards"))
+
+# Procesos trabajadores y sus colas (solo en el proceso frontal)
+shard_state = {"procesos": [], "colas": [], "directorios": []}
+
+# Envío de mensajes: límites de Telegram (~30 mensajes/s en total, ~1/s por chat
+# privado y ~20/min por grupo), ráfaga permitida por chat y reintentos tras RetryAfter
+OUT_GLOBAL_RATE = float(os.getenv('OUT_GLOBAL_RATE', '30'))
+OUT_CHAT_RATE = float(os.getenv('OUT_CHAT_RATE', '1'))
+OUT_GROUP_RATE = float(os.getenv('OUT_GROUP_RATE', str(20 / 60)))
+OUT_CHAT_BURST = int(os.getenv('OUT_CHAT_BURST', '3'))
+OUT_MAX_RETRIES = int(os.getenv('OUT_MAX_RETRIES', '3'))
+
+# Colas de salida por chat, tareas que las vacían y token buckets (por chat y global)
+outbound_state = {"colas": {}, "tareas": {}, "buckets": {}, "global": None}
+outbound_metrics = {"enviados": 0, "reintentos": 0, "errores": 0, "esperas": deque(maxlen=1000), "max_cola": 0}
+
+# Arranque: el bot atiende de inmediato y precalienta tasas e índices en segundo plano.
+# Los handlers esperan hasta WARMUP_MAX_WAIT segundos a que termine; después siguen
+# igual (las tasas se consultan bajo demanda)
+WARMUP_MAX_WAIT = float(os.getenv('WARMUP_MAX_WAIT', '2'))
+warmup_state = {"evento": None, "tarea": None, "fases": {}, "duracion": None}
+
+# Estado para el endpoint de salud
+health_state = {"modo": BOT_MODE, "inicio": time.time(), "updates": 0, "ultima_actualizacion": None, "servidor": None}
+
 def get_dollar_rate(save_to_file=True, force_api=False):
     """Obtiene el tipo de cambio del dólar oficial desde la API y lo guarda automáticamente
     
@@ -93,13 +317,7 @@ def get_dollar_rate(save_to_file=True, force_api=False):
             rate_float = float(rate)
             # Guardar automáticamente la tasa del día (usando fecha del sistema, no la de la API)
             if save_to_file:
-                if date_key not in tasas:
-                    tasas[date_key] = {}
-                # Solo actualizar si no existe o si se fuerza la actualización
-                if date_key not in tasas or "oficial" not in tasas[date_key] or force_api:
-                    tasas[date_key]["oficial"] = rate_float
-                    tasas[date_key]["oficial_timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    save_tasas(tasas)
+                update_tasa(date_key, "oficial", rate_float, reemplazar=force_api)
             return rate_float
         return None
     except Exception as e:
@@ -134,13 +352,7 @@ def get_parallel_rate(save_to_file=True, force_api=False):
             rate_float = float(rate)
             # Guardar automáticamente la tasa del día (usando fecha del sistema, no la de la API)
             if save_to_file:
-                if date_key not in tasas:
-                    tasas[date_key] = {}
-                # Solo actualizar si no existe o si se fuerza la actualización
-                if date_key not in tasas or "paralela" not in tasas[date_key] or force_api:
-                    tasas[date_key]["paralela"] = rate_float
-                    tasas[date_key]["paralela_timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    save_tasas(tasas)
+                update_tasa(date_key, "paralela", rate_float, reemplazar=force_api)
             return rate_float
         return None
     except Exception as e:
@@ -151,6 +363,70 @@ def get_parallel_rate(save_to_file=True, force_api=False):
             return tasas[date_key]["paralela"]
         return None
 
+async def run_io(func, *args, **kwargs):
+    """Ejecuta una función de almacenamiento (o de red) en el pool de E/S
+
+    Los handlers la esperan con await en lugar de llamar directo a load_*/save_*,
+    así el event loop sigue despachando updates mientras el disco trabaja.
+    Registra cuánto esperó la tarea en la cola del pool y cuánto duró.
+    """
+    enviado = time.perf_counter()
+    tiempos = {}
+    
+    def tarea():
+        tiempos["inicio"] = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            tiempos["fin"] = time.perf_counter()
+    
+    io_metrics["en_curso"] += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(io_executor, tarea)
+    finally:
+        io_metrics["en_curso"] -= 1
+        if "fin" in tiempos:
+            duracion = tiempos["fin"] - tiempos["inicio"]
+            io_metrics["esperas"].append(tiempos["inicio"] - enviado)
+            io_metrics["duraciones"].append(duracion)
+            stats = io_metrics["por_funcion"].setdefault(func.__name__, {"llamadas": 0, "tiempo": 0.0})
+            stats["llamadas"] += 1
+            stats["tiempo"] += duracion
+
+def format_io_metrics(top=5):
+    """Genera el texto con los tiempos de E/S y las funciones que más tiempo consumen"""
+    espera_p50 = percentile(io_metrics["esperas"], 50)
+    if espera_p50 is None:
+        return "E/S: sin operaciones registradas\n"
+    message = (
+        f"E/S (pool de {IO_MAX_WORKERS} hilos, en curso: {io_metrics['en_curso']})\n"
+        f"Espera p50/p99: {espera_p50 * 1000:,.1f}/{percentile(io_metrics['esperas'], 99) * 1000:,.1f} ms\n"
+        f"Duracion p50/p99: {percentile(io_metrics['duraciones'], 50) * 1000:,.1f}"
+        f"/{percentile(io_metrics['duraciones'], 99) * 1000:,.1f} ms\n"
+    )
+    funciones = sorted(io_metrics["por_funcion"].items(), key=lambda x: x[1]["tiempo"], reverse=True)
+    for nombre, stats in funciones[:top]:
+        message += f"{nombre}: {stats['llamadas']} llamadas, {stats['tiempo'] * 1000:,.0f} ms en total\n"
+    return message
+
+def write_json_atomic(path, data):
+    """Escribe el JSON en un archivo temporal y lo reemplaza de forma atómica
+
+    Si la escritura falla a mitad, el archivo original queda intacto.
+    """
+    directorio = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directorio, prefix=os.path.basename(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
 def load_tasas():
     """Carga las tasas guardadas desde el archivo JSON"""
     if os.path.exists(TASAS_FILE):
@@ -163,8 +439,47 @@ def load_tasas():
 
 def save_tasas(tasas):
     """Guarda las tasas en el archivo JSON"""
-    with open(TASAS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(tasas, f, ensure_ascii=False, indent=2)
+    write_json_atomic(TASAS_FILE, tasas)
+
+@contextmanager
+def tasas_file_lock():
+    """Candado de tasas.json entre procesos
+
+    Las tasas son globales: con sharding todos los procesos comparten el mismo
+    tasas.json, así que storage_lock (por proceso) no basta para releer y escribir.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(TASAS_FILE + ".lock", "a") as candado:
+        fcntl.flock(candado, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(candado, fcntl.LOCK_UN)
+
+def get_tasas_version():
+    """Versión de tasas.json (fecha de modificación), compartida por todos los procesos"""
+    try:
+        return os.stat(TASAS_FILE).st_mtime_ns
+    except OSError:
+        return 0
+
+def update_tasa(date_key, tipo, rate, reemplazar=True):
+    """Guarda una tasa del día releyendo el archivo con los candados tomados
+
+    Las tasas se consultan a la API sin candado; releer antes de escribir evita
+    perder la tasa que otro update (u otro proceso) haya guardado mientras tanto.
+    Si reemplazar es False, solo se guarda si aún no existe.
+    """
+    with storage_lock, tasas_file_lock():
+        tasas = load_tasas()
+        dia = tasas.setdefault(date_key, {})
+        if tipo in dia and not reemplazar:
+            return
+        dia[tipo] = rate
+        dia[f"{tipo}_timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        save_tasas(tasas)
 
 def get_date_key(fecha=None):
     """Obtiene la clave de fecha (YYYY-MM-DD)"""
@@ -189,24 +504,17 @@ def get_date_key(fecha=None):
 def save_today_rates():
     """Guarda las tasas del día actual"""
     date_key = get_date_key()
-    tasas = load_tasas()
     
     # Obtener tasas actuales
     tasa_oficial = get_dollar_rate()
     tasa_paralela = get_parallel_rate()
     
-    if date_key not in tasas:
-        tasas[date_key] = {}
-    
     if tasa_oficial:
-        tasas[date_key]["oficial"] = tasa_oficial
-        tasas[date_key]["oficial_timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        update_tasa(date_key, "oficial", tasa_oficial)
     
     if tasa_paralela:
-        tasas[date_key]["paralela"] = tasa_paralela
-        tasas[date_key]["paralela_timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        update_tasa(date_key, "paralela", tasa_paralela)
     
-    save_tasas(tasas)
     return tasa_oficial, tasa_paralela
 
 def get_tasa_for_date(fecha=None, tipo="oficial"):
@@ -271,8 +579,7 @@ def load_gastos():
 
 def save_gastos(gastos):
     """Guarda los gastos en el archivo JSON"""
-    with open(GASTOS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(gastos, f, ensure_ascii=False, indent=2)
+    write_json_atomic(GASTOS_FILE, gastos)
 
 def load_presupuestos():
     """Carga los presupuestos desde el archivo JSON"""
@@ -286,8 +593,7 @@ def load_presupuestos():
 
 def save_presupuestos(presupuestos):
     """Guarda los presupuestos en el archivo JSON"""
-    with open(PRESUPUESTOS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(presupuestos, f, ensure_ascii=False, indent=2)
+    write_json_atomic(PRESUPUESTOS_FILE, presupuestos)
 
 def load_intercambios():
     """Carga los intercambios Bs->USDT desde el archivo JSON"""
@@ -301,8 +607,7 @@ def load_intercambios():
 
 def save_intercambios(intercambios):
     """Guarda los intercambios en el archivo JSON"""
-    with open(INTERCAMBIOS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(intercambios, f, ensure_ascii=False, indent=2)
+    write_json_atomic(INTERCAMBIOS_FILE, intercambios)
 
 def load_ingresos():
     """Carga los ingresos mensuales desde el archivo JSON"""
@@ -316,21 +621,231 @@ def load_ingresos():
 
 def save_ingresos(ingresos):
     """Guarda los ingresos en el archivo JSON"""
-    with open(INGRESOS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(ingresos, f, ensure_ascii=False, indent=2)
+    write_json_atomic(INGRESOS_FILE, ingresos)
+
+def load_sinonimos():
+    """Carga los sinónimos de categorías definidos por los usuarios"""
+    if os.path.exists(SINONIMOS_FILE):
+        try:
+            with open(SINONIMOS_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except:
+            return {}
+    return {}
+
+def save_sinonimos(sinonimos):
+    """Guarda los sinónimos de categorías en el archivo JSON"""
+    write_json_atomic(SINONIMOS_FILE, sinonimos)
+
+def load_presupuestos_categorias():
+    """Carga los presupuestos por categoría y las alertas ya enviadas"""
+    if os.path.exists(PRESUPUESTOS_CATEGORIAS_FILE):
+        try:
+            with open(PRESUPUESTOS_CATEGORIAS_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except:
+            return {}
+    return {}
+
+def save_presupuestos_categorias(presupuestos_categorias):
+    """Guarda los presupuestos por categoría en el archivo JSON"""
+    write_json_atomic(PRESUPUESTOS_CATEGORIAS_FILE, presupuestos_categorias)
+
+def load_posiciones():
+    """Carga las posiciones en USDT de los usuarios desde el archivo JSON"""
+    if os.path.exists(POSICIONES_FILE):
+        try:
+            with open(POSICIONES_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except:
+            return {}
+    return {}
+
+def save_posiciones(posiciones):
+    """Guarda las posiciones en USDT en el archivo JSON"""
+    write_json_atomic(POSICIONES_FILE, posiciones)
+
+def load_ventas():
+    """Carga las ventas de USDT de los usuarios desde el archivo JSON"""
+    if os.path.exists(VENTAS_FILE):
+        try:
+            with open(VENTAS_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except:
+            return {}
+    return {}
+
+def save_ventas(ventas):
+    """Guarda las ventas de USDT en el archivo JSON"""
+    write_json_atomic(VENTAS_FILE, ventas)
+
+def new_posicion():
+    """Posición en USDT vacía
+
+    Se lleva el costo en Bs por dos métodos: costo promedio y FIFO (los lotes de
+    compra se consumen del más antiguo al más reciente al vender). De las ventas
+    solo se guardan el número y las ganancias acumuladas; el detalle va a ventas.json.
+    """
+    return {
+        "usdt": 0,
+        "costo_promedio_bs": 0,
+        "costo_fifo_bs": 0,
+        "lotes": [],
+        "realizado_promedio_bs": 0,
+        "realizado_fifo_bs": 0,
+        "compras": 0,
+        "ventas": 0,
+    }
+
+def _aplicar_compra(posicion, intercambio):
+    """Suma un intercambio Bs -> USDT a la posición (se ignoran los de 0 USDT)"""
+    if not intercambio.get("usdt"):
+        return
+    posicion["usdt"] += intercambio["usdt"]
+    posicion["costo_promedio_bs"] += intercambio["bolivares"]
+    posicion["costo_fifo_bs"] += intercambio["bolivares"]
+    posicion["lotes"].append({
+        "id": intercambio["id"],
+        "fecha": intercambio["fecha"],
+        "usdt": intercambio["usdt"],
+        "tasa": intercambio["bolivares"] / intercambio["usdt"],
+    })
+    posicion["compras"] += 1
+
+def _aplicar_venta(posicion, venta):
+    """Descuenta una venta USDT -> Bs de la posición y registra la ganancia realizada"""
+    usdt = venta["usdt"]
+    if usdt > posicion["usdt"] + 1e-9:
+        raise ValueError(f"Solo tienes {posicion['usdt']:,.4f} USDT")
+    
+    costo_promedio = posicion["costo_promedio_bs"] * usdt / posicion["usdt"]
+    costo_fifo = 0
+    pendiente = usdt
+    while pendiente > 1e-9 and posicion["lotes"]:
+        lote = posicion["lotes"][0]
+        tomado = min(lote["usdt"], pendiente)
+        costo_fifo += tomado * lote["tasa"]
+        lote["usdt"] -= tomado
+        pendiente -= tomado
+        if lote["usdt"] <= 1e-9:
+            posicion["lotes"].pop(0)
+    
+    posicion["usdt"] = max(posicion["usdt"] - usdt, 0)
+    posicion["costo_promedio_bs"] = max(posicion["costo_promedio_bs"] - costo_promedio, 0)
+    posicion["costo_fifo_bs"] = max(posicion["costo_fifo_bs"] - costo_fifo, 0)
+    venta["ganancia_promedio_bs"] = venta["bolivares"] - costo_promedio
+    venta["ganancia_fifo_bs"] = venta["bolivares"] - costo_fifo
+    posicion["realizado_promedio_bs"] += venta["ganancia_promedio_bs"]
+    posicion["realizado_fifo_bs"] += venta["ganancia_fifo_bs"]
+    posicion["ventas"] += 1
+
+def build_posicion(user_id):
+    """Construye la posición desde todos los intercambios del usuario (solo la primera vez)"""
+    posicion = new_posicion()
+    meses = load_intercambios().get(str(user_id), {})
+    for intercambio in sorted((i for mes in meses.values() for i in mes), key=lambda i: i["fecha"]):
+        _aplicar_compra(posicion, intercambio)
+    return posicion
+
+def _get_posicion_cargada(posiciones, user_id):
+    """Posición del usuario dentro del diccionario cargado, construyéndola si no existe"""
+    if str(user_id) not in posiciones:
+        posiciones[str(user_id)] = build_posicion(user_id)
+    return posiciones[str(user_id)]
+
+def get_posicion(user_id):
+    """Obtiene la posición en USDT del usuario (se mantiene con cada intercambio)"""
+    with storage_lock:
+        posiciones = load_posiciones()
+        if str(user_id) in posiciones:
+            return posiciones[str(user_id)]
+        posicion = _get_posicion_cargada(posiciones, user_id)
+        save_posiciones(posiciones)
+    return posicion
+
+def vender_usdt(user_id, amount_usdt, tasa_paralela, descripcion=""):
+    """Registra una venta de USDT a Bs y devuelve la venta con su ganancia realizada"""
+    venta = {
+        "id": str(uuid.uuid4())[:8],
+        "fecha": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "usdt": amount_usdt,
+        "bolivares": round(amount_usdt * tasa_paralela, 2),
+        "tasa_paralela": tasa_paralela,
+        "descripcion": descripcion
+    }
+    with storage_lock:
+        posiciones = load_posiciones()
+        posicion = _get_posicion_cargada(posiciones, user_id)
+        # Las posiciones guardadas antes de ventas.json traen la lista de ventas: se mueve
+        anteriores = []
+        if isinstance(posicion["ventas"], list):
+            anteriores = posicion["ventas"]
+            posicion["ventas"] = len(anteriores)
+        _aplicar_venta(posicion, venta)
+        ventas = load_ventas()
+        user_ventas = ventas.setdefault(str(user_id), {})
+        for v in anteriores + [venta]:
+            user_ventas.setdefault(v["fecha"][:7], []).append(v)
+        save_ventas(ventas)
+        save_posiciones(posiciones)
+        bump_ledger_version(user_id)
+    return venta, posicion
+
+def valorar_posicion(posicion, tasa_paralela):
+    """Valor de la posición a una tasa y ganancia no realizada por cada método de costo"""
+    valor_bs = posicion["usdt"] * tasa_paralela if tasa_paralela else None
+    valoracion = {
+        "valor_bs": valor_bs,
+        "costo_medio": posicion["costo_promedio_bs"] / posicion["usdt"] if posicion["usdt"] > 0 else None,
+    }
+    for metodo in ("promedio", "fifo"):
+        costo = posicion[f"costo_{metodo}_bs"]
+        ganancia = valor_bs - costo if valor_bs is not None else None
+        valoracion[f"no_realizado_{metodo}_bs"] = ganancia
+        valoracion[f"no_realizado_{metodo}_pct"] = ganancia / costo * 100 if ganancia is not None and costo > 0 else None
+    return valoracion
+
+def format_posicion(posicion, tasa_paralela, detalle=True):
+    """Texto de la posición en USDT (detalle incluye FIFO, ganancias realizadas y lotes)"""
+    valoracion = valorar_posicion(posicion, tasa_paralela)
+    message = f"USDT acumulado: {posicion['usdt']:,.4f} USDT\n"
+    if valoracion["costo_medio"]:
+        message += f"Costo medio: {valoracion['costo_medio']:,.2f} Bs/USDT ({posicion['costo_promedio_bs']:,.2f} Bs)\n"
+    if valoracion["valor_bs"] is not None and posicion["usdt"] > 0:
+        message += (
+            f"Valor a tasa paralela ({tasa_paralela:,.2f}): {valoracion['valor_bs']:,.2f} Bs\n"
+            f"Ganancia no realizada: {valoracion['no_realizado_promedio_bs']:+,.2f} Bs"
+        )
+        if valoracion["no_realizado_promedio_pct"] is not None:
+            message += f" ({valoracion['no_realizado_promedio_pct']:+.1f}%)"
+        message += "\n"
+    if not detalle:
+        return message
+    
+    if valoracion["valor_bs"] is not None and posicion["usdt"] > 0:
+        message += f"Ganancia no realizada (FIFO): {valoracion['no_realizado_fifo_bs']:+,.2f} Bs\n"
+    num_ventas = len(posicion["ventas"]) if isinstance(posicion["ventas"], list) else posicion["ventas"]
+    if num_ventas:
+        message += (
+            f"\nGanancia realizada ({num_ventas} ventas):\n"
+            f"Costo promedio: {posicion['realizado_promedio_bs']:+,.2f} Bs\n"
+            f"FIFO: {posicion['realizado_fifo_bs']:+,.2f} Bs\n"
+        )
+    if posicion["lotes"]:
+        message += f"\nLotes abiertos (FIFO, {len(posicion['lotes'])}):\n"
+        for lote in posicion["lotes"][:10]:
+            message += f"{lote['fecha'][:10]}: {lote['usdt']:,.4f} USDT a {lote['tasa']:,.2f} Bs/USDT\n"
+        if len(posicion["lotes"]) > 10:
+            message += f"... y {len(posicion['lotes']) - 10} mas\n"
+    return message
 
 def add_intercambio(user_id, amount_bs, tasa_paralela, descripcion=""):
     """Registra un intercambio de Bs a USDT (compra de divisa, NO es gasto)"""
-    intercambios = load_intercambios()
-    
-    if str(user_id) not in intercambios:
-        intercambios[str(user_id)] = {}
-    
     month_key = get_current_month_key()
-    if month_key not in intercambios[str(user_id)]:
-        intercambios[str(user_id)][month_key] = []
-    
     amount_usdt = amount_bs / tasa_paralela
+    if round(amount_usdt, 4) <= 0:
+        # Se valida antes de guardar: un intercambio de 0 USDT no cambia la posición
+        raise ValueError("El monto equivale a menos de 0.0001 USDT")
     intercambio_id = str(uuid.uuid4())[:8]
     
     intercambio = {
@@ -342,8 +857,20 @@ def add_intercambio(user_id, amount_bs, tasa_paralela, descripcion=""):
         "descripcion": descripcion
     }
     
-    intercambios[str(user_id)][month_key].append(intercambio)
-    save_intercambios(intercambios)
+    with storage_lock:
+        intercambios = load_intercambios()
+        intercambios.setdefault(str(user_id), {}).setdefault(month_key, []).append(intercambio)
+        save_intercambios(intercambios)
+        # Posición en USDT: se construye la primera vez (ya incluye este intercambio)
+        # y desde entonces solo se le suma cada compra
+        posiciones = load_posiciones()
+        if str(user_id) in posiciones:
+            _aplicar_compra(posiciones[str(user_id)], intercambio)
+        else:
+            _get_posicion_cargada(posiciones, user_id)
+        save_posiciones(posiciones)
+        bump_ledger_version(user_id)
+    update_ai_context_intercambio(user_id, intercambio, month_key)
     
     return amount_usdt, intercambio_id
 
@@ -363,21 +890,21 @@ def set_ingreso_mensual(user_id, amount_bs, tasa_paralela=None):
     if tasa_paralela is None:
         tasa_paralela = get_parallel_rate() or get_dollar_rate() or 0
     
-    ingresos = load_ingresos()
-    if str(user_id) not in ingresos:
-        ingresos[str(user_id)] = {}
-    
     month_key = get_current_month_key()
     amount_usdt = amount_bs / tasa_paralela if tasa_paralela > 0 else 0
-    
-    ingresos[str(user_id)][month_key] = {
+    ingreso = {
         "bolivares": amount_bs,
         "usdt": round(amount_usdt, 4),
         "tasa_paralela": tasa_paralela,
         "fecha_registro": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     }
     
-    save_ingresos(ingresos)
+    with storage_lock:
+        ingresos = load_ingresos()
+        ingresos.setdefault(str(user_id), {})[month_key] = ingreso
+        save_ingresos(ingresos)
+        bump_ledger_version(user_id)
+    update_ai_context_ingreso(user_id, ingreso, month_key)
     return amount_usdt
 
 def get_ingreso_mensual(user_id, month_key=None):
@@ -400,13 +927,18 @@ def get_saldo_disponible(user_id, month_key=None):
     if not ingreso:
         return None, None, None, None
     
-    # Gastos del mes
-    total_bs_gastos, total_usd_gastos, gastos = get_month_summary(user_id, month_key)
-    total_bs_gastos = total_bs_gastos or 0
-    total_usd_gastos = total_usd_gastos or 0
+    _, _, gastos = get_month_summary(user_id, month_key)
+    return compute_saldo(ingreso, gastos, get_intercambios_month(user_id, month_key))
+
+def compute_saldo(ingreso, gastos, intercambios):
+    """Calcula el saldo (ingreso - gastos - intercambios) a partir de datos ya cargados"""
+    if not ingreso:
+        return None, None, None, None
+    
+    total_bs_gastos = sum(g["bolivares"] for g in gastos)
+    total_usd_gastos = sum(g["dolares"] for g in gastos)
     
     # Intercambios del mes (Bs convertidos a USDT)
-    intercambios = get_intercambios_month(user_id, month_key)
     total_bs_intercambios = sum(i["bolivares"] for i in intercambios)
     total_usdt_intercambios = sum(i["usdt"] for i in intercambios)
     
@@ -425,6 +957,121 @@ def get_previous_month_key():
     last_month = datetime.now() - timedelta(days=datetime.now().day)
     return last_month.strftime("%Y-%m")
 
+def parse_fecha_gasto(fecha_gasto):
+    """Normaliza la fecha de un gasto (datetime, str o None para ahora)"""
+    if fecha_gasto is None:
+        return datetime.now()
+    if isinstance(fecha_gasto, str):
+        try:
+            # Intentar parsear diferentes formatos
+            if len(fecha_gasto) == 10:  # YYYY-MM-DD
+                return datetime.strptime(fecha_gasto, "%Y-%m-%d")
+            return datetime.strptime(fecha_gasto, "%Y-%m-%d %H:%M:%S")
+        except:
+            return datetime.now()
+    return fecha_gasto
+
+def add_gastos_batch(user_id, items, dollar_rate=None, fecha_gasto=None):
+    """Registra varios gastos en una sola escritura atómica
+    
+    Todos los gastos se validan y se les asigna tasa antes de tocar el archivo;
+    si algo falla no se registra ninguno.
+    
+    Args:
+        user_id: ID del usuario
+        items: Lista de dicts con "amount", y opcionalmente "categoria", "descripcion",
+            "fecha" (datetime o str), "tasa" e "id" (al importar un CSV exportado)
+        dollar_rate: Tasa de cambio común (si es None, se obtiene para la fecha de cada gasto)
+        fecha_gasto: Fecha común para los items que no indiquen la suya
+    
+    Returns:
+        (registrados, saldo, alertas): registrados es una lista de dicts con los gastos
+        guardados y "amount_usd"; saldo es (saldo_bs, saldo_usdt) del mes actual o
+        (None, None) si no hay ingreso registrado; alertas son los textos de los
+        umbrales de presupuesto alcanzados con estos gastos.
+    """
+    # Validar y asignar tasa a todos los gastos antes de modificar nada
+    tasas_por_fecha = {}
+    nuevos = []
+    for item in items:
+        amount_bs = float(item["amount"])
+        if amount_bs <= 0:
+            raise ValueError(f"Monto invalido: {item['amount']}")
+        fecha = parse_fecha_gasto(item.get("fecha", fecha_gasto))
+        
+        tasa = item.get("tasa") or dollar_rate
+        if not tasa:
+            date_key = get_date_key(fecha)
+            if date_key not in tasas_por_fecha:
+                tasa_fecha = get_tasa_for_date(fecha, tipo="oficial")
+                if tasa_fecha is None or tasa_fecha == 0:
+                    # Si no hay tasa para esa fecha, usar la actual
+                    tasa_fecha = get_dollar_rate()
+                tasas_por_fecha[date_key] = tasa_fecha
+            tasa = tasas_por_fecha[date_key]
+        if not tasa:
+            raise ValueError("No se pudo obtener el tipo de cambio")
+        
+        amount_usd = amount_bs / tasa
+        nuevos.append({
+            "month_key": fecha.strftime("%Y-%m"),
+            "amount_usd": amount_usd,
+            "gasto": {
+                "id": item.get("id") or str(uuid.uuid4())[:8],
+                "fecha": fecha.strftime("%Y-%m-%d %H:%M:%S"),
+                "bolivares": amount_bs,
+                "dolares": round(amount_usd, 2),
+                "tipo_cambio": tasa,
+                "categoria": (item.get("categoria") or "otros").lower(),
+                "descripcion": item.get("descripcion", "")
+            }
+        })
+    
+    with storage_lock:
+        gastos = load_gastos()
+        # Totales del mes para las alertas, tomados antes de agregar los gastos nuevos
+        get_alertas_estado(user_id, gastos)
+        user_gastos = gastos.setdefault(str(user_id), {})
+        for nuevo in nuevos:
+            user_gastos.setdefault(nuevo["month_key"], []).append(nuevo["gasto"])
+        save_gastos(gastos)
+        bump_ledger_version(user_id)
+        update_gastos_index(user_id, [(nuevo["gasto"], nuevo["month_key"]) for nuevo in nuevos])
+        update_busqueda_gastos(user_id, [(nuevo["gasto"], nuevo["month_key"]) for nuevo in nuevos])
+        # Los gastos ya están guardados: un fallo en los cachés derivados no debe
+        # reportarse como gasto fallido (un reintento lo duplicaría)
+        try:
+            for nuevo in nuevos:
+                update_quantile_sketches(user_id, nuevo["gasto"])
+                update_ai_context_gasto(user_id, nuevo["gasto"], nuevo["month_key"])
+                invalidate_month_rollup(user_id, nuevo["month_key"])
+            update_proyeccion_gastos(user_id, [nuevo["gasto"] for nuevo in nuevos])
+            alertas = evaluar_alertas_presupuesto(user_id, [nuevo["gasto"] for nuevo in nuevos])
+        except Exception as e:
+            print(f"Error actualizando caches tras registrar gastos de {user_id}: {e}")
+            invalidate_derived_caches(user_id, {nuevo["month_key"] for nuevo in nuevos})
+            alertas = []
+    
+    # Saldo del mes actual calculado con los gastos ya cargados en memoria
+    month_key = get_current_month_key()
+    saldo = compute_saldo(
+        get_ingreso_mensual(user_id, month_key),
+        user_gastos.get(month_key, []),
+        get_intercambios_month(user_id, month_key)
+    )
+    
+    registrados = [dict(nuevo["gasto"], amount_usd=nuevo["amount_usd"]) for nuevo in nuevos]
+    return registrados, saldo[:2], alertas
+
+def invalidate_derived_caches(user_id, month_keys):
+    """Descarta los cachés derivados del registro del usuario (se reconstruyen bajo demanda)"""
+    invalidate_ai_context(user_id)
+    invalidate_proyeccion(user_id)
+    invalidate_alertas_presupuesto(user_id)
+    invalidate_quantile_sketches(user_id)
+    for month_key in month_keys:
+        invalidate_month_rollup(user_id, month_key)
+
 def add_gasto(user_id, amount_bs, dollar_rate=None, categoria="otros", descripcion="", fecha_gasto=None):
     """Agrega un gasto al registro del usuario
     
@@ -435,55 +1082,17 @@ def add_gasto(user_id, amount_bs, dollar_rate=None, categoria="otros", descripci
         categoria: Categoría del gasto
         descripcion: Descripción del gasto
         fecha_gasto: Fecha del gasto (datetime, str o None para hoy)
-    """
-    gastos = load_gastos()
-    
-    if str(user_id) not in gastos:
-        gastos[str(user_id)] = {}
-    
-    # Determinar la fecha del gasto
-    if fecha_gasto is None:
-        fecha_gasto = datetime.now()
-    elif isinstance(fecha_gasto, str):
-        try:
-            # Intentar parsear diferentes formatos
-            if len(fecha_gasto) == 10:  # YYYY-MM-DD
-                fecha_gasto = datetime.strptime(fecha_gasto, "%Y-%m-%d")
-            else:
-                fecha_gasto = datetime.strptime(fecha_gasto, "%Y-%m-%d %H:%M:%S")
-        except:
-            fecha_gasto = datetime.now()
-    
-    # Obtener la tasa para la fecha del gasto si no se proporcionó
-    if dollar_rate is None:
-        dollar_rate = get_tasa_for_date(fecha_gasto, tipo="oficial")
-        if dollar_rate is None or dollar_rate == 0:
-            # Si no hay tasa para esa fecha, usar la actual
-            dollar_rate = get_dollar_rate()
-            if dollar_rate is None or dollar_rate == 0:
-                raise ValueError("No se pudo obtener el tipo de cambio")
-    
-    # Determinar el mes del gasto
-    month_key = fecha_gasto.strftime("%Y-%m")
-    if month_key not in gastos[str(user_id)]:
-        gastos[str(user_id)][month_key] = []
-    
-    amount_usd = amount_bs / dollar_rate
-    gasto_id = str(uuid.uuid4())[:8]
-    gasto = {
-        "id": gasto_id,
-        "fecha": fecha_gasto.strftime("%Y-%m-%d %H:%M:%S"),
-        "bolivares": amount_bs,
-        "dolares": round(amount_usd, 2),
-        "tipo_cambio": dollar_rate,
-        "categoria": categoria.lower(),
-        "descripcion": descripcion
-    }
     
-    gastos[str(user_id)][month_key].append(gasto)
-    save_gastos(gastos)
-    
-    return amount_usd, gasto_id
+    Returns:
+        (amount_usd, gasto_id, alertas)
+    """
+    registrados, _, alertas = add_gastos_batch(
+        user_id,
+        [{"amount": amount_bs, "categoria": categoria, "descripcion": descripcion}],
+        dollar_rate,
+        fecha_gasto
+    )
+    return registrados[0]["amount_usd"], registrados[0]["id"], alertas
 
 def get_gasto_by_id(user_id, gasto_id):
     """Obtiene un gasto por su ID"""
@@ -499,37 +1108,56 @@ def get_gasto_by_id(user_id, gasto_id):
 
 def delete_gasto(user_id, gasto_id):
     """Elimina un gasto por su ID"""
-    gastos = load_gastos()
-    if str(user_id) not in gastos:
-        return False
-    
-    for month_key, month_gastos in gastos[str(user_id)].items():
-        for i, gasto in enumerate(month_gastos):
-            if gasto.get("id") == gasto_id:
-                del month_gastos[i]
-                save_gastos(gastos)
-                return True
+    with storage_lock:
+        gastos = load_gastos()
+        if str(user_id) not in gastos:
+            return False
+        
+        for month_key, month_gastos in gastos[str(user_id)].items():
+            for i, gasto in enumerate(month_gastos):
+                if gasto.get("id") == gasto_id:
+                    del month_gastos[i]
+                    save_gastos(gastos)
+                    bump_ledger_version(user_id)
+                    remove_gastos_index(user_id, gasto)
+                    remove_busqueda_gasto(user_id, gasto)
+                    invalidate_derived_caches(user_id, [month_key])
+                    return True
     return False
 
 def edit_gasto(user_id, gasto_id, new_amount_bs=None, new_categoria=None, new_descripcion=None):
     """Edita un gasto existente"""
-    gasto, month_key, month_gastos = get_gasto_by_id(user_id, gasto_id)
-    if not gasto:
-        return False
-    
-    if new_amount_bs is not None:
-        dollar_rate = gasto.get("tipo_cambio", get_dollar_rate())
-        if dollar_rate:
-            gasto["bolivares"] = new_amount_bs
-            gasto["dolares"] = round(new_amount_bs / dollar_rate, 2)
-    
-    if new_categoria:
-        gasto["categoria"] = new_categoria.lower()
-    
-    if new_descripcion is not None:
-        gasto["descripcion"] = new_descripcion
-    
-    save_gastos(load_gastos())
+    with storage_lock:
+        # Se modifica y guarda el mismo diccionario cargado, para no perder el cambio
+        gastos = load_gastos()
+        gasto = None
+        for month_key, month_gastos in gastos.get(str(user_id), {}).items():
+            for g in month_gastos:
+                if g.get("id") == gasto_id:
+                    gasto = g
+                    break
+            if gasto:
+                break
+        if not gasto:
+            return False
+        
+        if new_amount_bs is not None:
+            dollar_rate = gasto.get("tipo_cambio") or get_dollar_rate()
+            if dollar_rate:
+                gasto["bolivares"] = new_amount_bs
+                gasto["dolares"] = round(new_amount_bs / dollar_rate, 2)
+        
+        if new_categoria:
+            gasto["categoria"] = new_categoria.lower()
+        
+        if new_descripcion is not None:
+            gasto["descripcion"] = new_descripcion
+        
+        save_gastos(gastos)
+        bump_ledger_version(user_id)
+        replace_gastos_index(user_id, gasto, month_key)
+        reindex_busqueda_gasto(user_id, gasto, month_key)
+    invalidate_derived_caches(user_id, [month_key])
     return True
 
 def get_month_summary(user_id, month_key=None):
@@ -547,17 +1175,138 @@ def get_month_summary(user_id, month_key=None):
     
     return total_bs, total_usd, month_gastos
 
+def _build_month_rollup(month_gastos):
+    """Totales de un mes: general, por categoría y tasa promedio (Bs por USD gastado)"""
+    rollup = {"bs": 0, "usd": 0, "count": 0, "categorias": {}}
+    for g in month_gastos:
+        rollup["bs"] += g["bolivares"]
+        rollup["usd"] += g["dolares"]
+        rollup["count"] += 1
+        cat = rollup["categorias"].setdefault(g.get("categoria", "otros"), {"bs": 0, "usd": 0, "count": 0})
+        cat["bs"] += g["bolivares"]
+        cat["usd"] += g["dolares"]
+        cat["count"] += 1
+    rollup["tasa"] = rollup["bs"] / rollup["usd"] if rollup["usd"] > 0 else None
+    return rollup
+
+def get_month_rollups(user_id, month_keys):
+    """Obtiene los totales de varios meses ({month_key: rollup})
+
+    Los meses ya calculados salen del caché; los que faltan se calculan en una
+    sola lectura del archivo, así comparar 24 meses cuesta casi lo mismo que 2.
+    """
+    cache = month_rollups.setdefault(str(user_id), {})
+    faltantes = [mk for mk in month_keys if mk not in cache]
+    if faltantes:
+        user_gastos = load_gastos().get(str(user_id), {})
+        for mk in faltantes:
+            cache[mk] = _build_month_rollup(user_gastos.get(mk, []))
+    return {mk: cache[mk] for mk in month_keys}
+
+def invalidate_month_rollup(user_id, month_key):
+    """Descarta los totales cacheados de un mes del usuario"""
+    month_rollups.get(str(user_id), {}).pop(month_key, None)
+
+def _variacion(actual, anterior):
+    """Variación porcentual (None si no hay base para compararla)"""
+    if not anterior:
+        return None
+    return (actual - anterior) / anterior * 100
+
+def _format_variacion(valor):
+    """Texto de una variación porcentual"""
+    return "n/a" if valor is None else f"{valor:+.1f}%"
+
+def compare_rollups(anterior, actual):
+    """Compara dos meses: diferencias totales, en Bs, en USD, de tasa y por categoría
+
+    El gasto en Bs de un mes con la tasa del otro separa el cambio real (USD)
+    de la devaluación: "ajustado" es el gasto del mes anterior a la tasa actual.
+    """
+    comparacion = {
+        "diff_bs": actual["bs"] - anterior["bs"],
+        "diff_usd": actual["usd"] - anterior["usd"],
+        "var_bs": _variacion(actual["bs"], anterior["bs"]),
+        "var_usd": _variacion(actual["usd"], anterior["usd"]),
+        "var_tasa": _variacion(actual["tasa"], anterior["tasa"]) if actual["tasa"] else None,
+        "ajustado_bs": anterior["usd"] * actual["tasa"] if actual["tasa"] else None,
+    }
+    categorias = {}
+    for cat in set(anterior["categorias"]) | set(actual["categorias"]):
+        antes = anterior["categorias"].get(cat, {}).get("usd", 0)
+        ahora = actual["categorias"].get(cat, {}).get("usd", 0)
+        categorias[cat] = {"antes": antes, "ahora": ahora, "diff": ahora - antes, "var": _variacion(ahora, antes)}
+    comparacion["categorias"] = dict(sorted(categorias.items(), key=lambda x: abs(x[1]["diff"]), reverse=True))
+    return comparacion
+
+def format_comparacion(mes_anterior, anterior, mes_actual, actual):
+    """Texto de la comparación entre dos meses con el detalle por categoría"""
+    comparacion = compare_rollups(anterior, actual)
+    message = ""
+    for mes, rollup in ((mes_anterior, anterior), (mes_actual, actual)):
+        if rollup["count"]:
+            message += f"{mes}: {rollup['bs']:,.2f} Bs (${rollup['usd']:,.2f} USD) - {rollup['count']} gastos"
+            if rollup["tasa"]:
+                message += f" - tasa media {rollup['tasa']:,.2f} Bs/$"
+            message += "\n"
+        else:
+            message += f"{mes}: Sin datos\n"
+    
+    message += (
+        f"\nDiferencia:\n"
+        f"{comparacion['diff_bs']:+,.2f} Bs ({_format_variacion(comparacion['var_bs'])})\n"
+        f"${comparacion['diff_usd']:+,.2f} USD ({_format_variacion(comparacion['var_usd'])})\n"
+    )
+    if comparacion["var_tasa"] is not None and anterior["count"]:
+        message += (
+            f"Tasa: {_format_variacion(comparacion['var_tasa'])}\n"
+            f"{mes_anterior} a la tasa de {mes_actual}: {comparacion['ajustado_bs']:,.2f} Bs "
+            f"(variacion real: {_format_variacion(comparacion['var_usd'])})\n"
+        )
+    
+    if comparacion["categorias"]:
+        message += "\nPor categoria (USD):\n"
+        for cat, datos in comparacion["categorias"].items():
+            message += (
+                f"{cat}: ${datos['antes']:,.2f} -> ${datos['ahora']:,.2f} "
+                f"(${datos['diff']:+,.2f}, {_format_variacion(datos['var'])})\n"
+            )
+    return message
+
+def format_comparacion_meses(month_keys, rollups):
+    """Texto de la evolución de varios meses (del más antiguo al más reciente)"""
+    message = ""
+    anterior = None
+    for mk in month_keys:
+        rollup = rollups[mk]
+        message += f"{mk}: {rollup['bs']:,.2f} Bs (${rollup['usd']:,.2f} USD) - {rollup['count']} gastos"
+        if anterior is not None and anterior["count"] and rollup["count"]:
+            message += (
+                f" | USD {_format_variacion(_variacion(rollup['usd'], anterior['usd']))}"
+                f", Bs {_format_variacion(_variacion(rollup['bs'], anterior['bs']))}"
+            )
+        message += "\n"
+        anterior = rollup
+    
+    con_datos = [mk for mk in month_keys if rollups[mk]["count"]]
+    total_usd = sum(rollups[mk]["usd"] for mk in month_keys)
+    message += f"\nPromedio mensual: ${total_usd / len(month_keys):,.2f} USD\n"
+    if len(con_datos) >= 2:
+        message += f"\nDel primer al ultimo mes con datos ({con_datos[0]} -> {con_datos[-1]}):\n"
+        message += format_comparacion(con_datos[0], rollups[con_datos[0]], con_datos[-1], rollups[con_datos[-1]])
+    return message
+
 def get_all_gastos(user_id):
     """Obtiene todos los gastos del usuario"""
     gastos = load_gastos()
     if str(user_id) not in gastos:
         return []
     
+    # Copias con month_key: no se modifican los gastos del archivo cargado
     all_gastos = []
     for month_key, month_gastos in gastos[str(user_id)].items():
         for gasto in month_gastos:
-            gasto["month_key"] = month_key
-            all_gastos.append(gasto)
+            all_gastos.append(dict(gasto, month_key=month_key))
     return all_gastos
 
 def get_gastos_by_date(user_id, fecha):
@@ -586,106 +1335,1514 @@ def get_gastos_by_range(user_id, min_amount=None, max_amount=None):
         filtered.append(g)
     return filtered
 
-def get_statistics(user_id):
-    """Obtiene estadísticas avanzadas del mes actual"""
-    total_bs, total_usd, gastos = get_month_summary(user_id)
-    
-    if not gastos:
-        return None
-    
-    amounts_bs = [g["bolivares"] for g in gastos]
-    amounts_usd = [g["dolares"] for g in gastos]
-    
-    # Estadísticas básicas
-    stats = {
-        "total_bs": total_bs,
-        "total_usd": total_usd,
-        "count": len(gastos),
-        "promedio_diario_bs": total_bs / datetime.now().day if datetime.now().day > 0 else 0,
-        "promedio_diario_usd": total_usd / datetime.now().day if datetime.now().day > 0 else 0,
-        "max_bs": max(amounts_bs),
-        "min_bs": min(amounts_bs),
-        "max_usd": max(amounts_usd),
-        "min_usd": min(amounts_usd),
-    }
-    
-    # Gasto máximo y mínimo
-    max_gasto = max(gastos, key=lambda x: x["bolivares"])
-    min_gasto = min(gastos, key=lambda x: x["bolivares"])
-    stats["max_gasto"] = max_gasto
-    stats["min_gasto"] = min_gasto
-    
-    # Gastos por categoría
-    by_category = {}
-    for g in gastos:
-        cat = g.get("categoria", "otros")
-        if cat not in by_category:
-            by_category[cat] = {"bs": 0, "usd": 0, "count": 0}
-        by_category[cat]["bs"] += g["bolivares"]
-        by_category[cat]["usd"] += g["dolares"]
-        by_category[cat]["count"] += 1
-    stats["by_category"] = by_category
-    
-    # Gastos por día
-    by_day = {}
-    for g in gastos:
-        fecha = g["fecha"].split()[0]
-        if fecha not in by_day:
-            by_day[fecha] = {"bs": 0, "usd": 0, "count": 0}
-        by_day[fecha]["bs"] += g["bolivares"]
-        by_day[fecha]["usd"] += g["dolares"]
-        by_day[fecha]["count"] += 1
-    
-    max_day = max(by_day.items(), key=lambda x: x[1]["bs"]) if by_day else None
-    stats["max_day"] = max_day
-    
-    return stats
+def get_gastos_index(user_id, gastos=None):
+    """Índice de los gastos del usuario ordenado por (fecha, id)
 
-def get_presupuesto(user_id, month_key=None):
-    """Obtiene el presupuesto del usuario para un mes"""
-    if month_key is None:
-        month_key = get_current_month_key()
-    
-    presupuestos = load_presupuestos()
-    user_presupuestos = presupuestos.get(str(user_id), {})
-    return user_presupuestos.get(month_key)
+    Se construye una vez desde el archivo y luego se mantiene gasto a gasto al
+    registrar, editar o eliminar (ver update_gastos_index), así una página cuesta
+    lo mismo con 100 o con 100.000 gastos aunque el registro acabe de cambiar.
+    "version" es la versión del registro en el último cambio de gastos, para los
+    cachés que dependen del índice. gastos permite pasar el archivo ya cargado
+    (al precalentar todos los índices).
+    """
+    with storage_lock:
+        entrada = gastos_index.get(str(user_id))
+        if entrada is not None:
+            return entrada
+        
+        claves = []
+        por_clave = {}
+        if gastos is None:
+            gastos = load_gastos()
+        for month_key, month_gastos in gastos.get(str(user_id), {}).items():
+            for gasto in month_gastos:
+                clave = (gasto.get("fecha", ""), gasto.get("id", ""))
+                claves.append(clave)
+                por_clave[clave] = dict(gasto, month_key=month_key)
+        claves.sort()
+        
+        entrada = {"version": get_ledger_version(user_id), "claves": claves, "gastos": por_clave}
+        gastos_index[str(user_id)] = entrada
+        return entrada
 
-def set_presupuesto(user_id, amount_usd, month_key=None):
-    """Establece el presupuesto del usuario para un mes"""
-    if month_key is None:
-        month_key = get_current_month_key()
-    
-    presupuestos = load_presupuestos()
-    if str(user_id) not in presupuestos:
-        presupuestos[str(user_id)] = {}
-    
-    presupuestos[str(user_id)][month_key] = amount_usd
-    save_presupuestos(presupuestos)
+def update_gastos_index(user_id, nuevos):
+    """Agrega gastos nuevos ([(gasto, month_key)]) al índice ordenado
 
-def export_to_csv(user_id):
-    """Exporta los gastos del usuario a CSV"""
-    all_gastos = get_all_gastos(user_id)
-    if not all_gastos:
-        return None
+    Un gasto se inserta con búsqueda binaria; un lote grande (importación) se
+    agrega al final y se reordena una vez, que con dos tramos ya ordenados es lineal.
+    """
+    entrada = gastos_index.get(str(user_id))
+    if entrada is None:
+        return
+    claves = entrada["claves"]
+    nuevas = []
+    for gasto, month_key in nuevos:
+        clave = (gasto.get("fecha", ""), gasto.get("id", ""))
+        entrada["gastos"][clave] = dict(gasto, month_key=month_key)
+        nuevas.append(clave)
+    if len(nuevas) == 1:
+        bisect.insort(claves, nuevas[0])
+    else:
+        claves.extend(sorted(nuevas))
+        claves.sort()
+    entrada["version"] = get_ledger_version(user_id)
+
+def remove_gastos_index(user_id, gasto):
+    """Quita un gasto eliminado del índice ordenado"""
+    entrada = gastos_index.get(str(user_id))
+    if entrada is None:
+        return
+    clave = (gasto.get("fecha", ""), gasto.get("id", ""))
+    claves = entrada["claves"]
+    i = bisect.bisect_left(claves, clave)
+    if i < len(claves) and claves[i] == clave:
+        del claves[i]
+    entrada["gastos"].pop(clave, None)
+    entrada["version"] = get_ledger_version(user_id)
+
+def replace_gastos_index(user_id, gasto, month_key):
+    """Reemplaza en el índice un gasto editado (la fecha y el ID no cambian)"""
+    entrada = gastos_index.get(str(user_id))
+    if entrada is None:
+        return
+    entrada["gastos"][(gasto.get("fecha", ""), gasto.get("id", ""))] = dict(gasto, month_key=month_key)
+    entrada["version"] = get_ledger_version(user_id)
+
+def get_gastos_page(user_id, cursor=None, direccion="siguiente", fecha=None,
+                    min_amount=None, max_amount=None, limite=PAGE_SIZE,
+                    terminos=None, desde=None, hasta=None):
+    """Obtiene una página de gastos (del más reciente al más antiguo) con un cursor (fecha, id)
+
+    direccion "siguiente" devuelve los gastos anteriores (más antiguos) al cursor;
+    "anterior", los posteriores. fecha (YYYY-MM-DD) limita la búsqueda a ese día,
+    desde/hasta (YYYY-MM-DD, incluidos) a un período, min_amount/max_amount al
+    rango de montos en Bs y terminos a los gastos cuya descripción o categoría
+    contenga todos los términos (ver terminos_busqueda).
+
+    Returns:
+        (gastos, hay_anteriores, hay_siguientes)
+    """
+    with storage_lock:
+        return _get_gastos_page(user_id, cursor, direccion, fecha, min_amount, max_amount,
+                                limite, terminos, desde, hasta)
+
+def _get_gastos_page(user_id, cursor, direccion, fecha, min_amount, max_amount, limite, terminos, desde, hasta):
+    """Cuerpo de get_gastos_page, con storage_lock tomado (el índice se modifica en cada escritura)"""
+    if terminos:
+        claves, por_clave = buscar_claves(user_id, terminos, desde, hasta)
+    else:
+        indice = get_gastos_index(user_id)
+        claves, por_clave = indice["claves"], indice["gastos"]
+    
+    # Límites del recorrido: todo el historial, el día o el período indicado
+    lo, hi = 0, len(claves)
+    if fecha:
+        desde = hasta = fecha
+    if desde:
+        lo = bisect.bisect_left(claves, (desde,))
+    if hasta:
+        hi = bisect.bisect_left(claves, (hasta + "~",))
+    
+    if direccion == "siguiente":
+        fin = bisect.bisect_left(claves, cursor, lo, hi) if cursor else hi
+        posiciones = range(fin - 1, lo - 1, -1)
+    else:
+        inicio = bisect.bisect_right(claves, cursor, lo, hi) if cursor else lo
+        posiciones = range(inicio, hi)
+    
+    # Se toma un gasto de más para saber si hay otra página en esa dirección
+    encontrados = []
+    for pos in posiciones:
+        gasto = por_clave[claves[pos]]
+        if min_amount is not None and gasto["bolivares"] < min_amount:
+            continue
+        if max_amount is not None and gasto["bolivares"] > max_amount:
+            continue
+        encontrados.append(gasto)
+        if len(encontrados) > limite:
+            break
+    
+    hay_mas = len(encontrados) > limite
+    pagina = encontrados[:limite]
+    if direccion == "siguiente":
+        return pagina, cursor is not None, hay_mas
+    return list(reversed(pagina)), hay_mas, True
+
+def encode_cursor(gasto):
+    """Cursor compacto de un gasto para callback_data ("20251118143000.abc12345")"""
+    return re.sub(r"\D", "", gasto.get("fecha", "")) + "." + gasto.get("id", "")
+
+def decode_cursor(texto):
+    """Convierte el cursor compacto de nuevo en la clave (fecha, id) del índice"""
+    digitos, _, gasto_id = texto.partition(".")
+    fecha = datetime.strptime(digitos, "%Y%m%d%H%M%S").strftime("%Y-%m-%d %H:%M:%S")
+    return (fecha, gasto_id)
+
+def plegar_texto(texto):
+    """Texto en minúsculas y sin acentos ("Farmacía" -> "farmacia")"""
+    texto = unicodedata.normalize("NFKD", str(texto or "").lower())
+    return "".join(c for c in texto if not unicodedata.combining(c))
+
+def raiz_busqueda(palabra):
+    """Raíz aproximada de una palabra ya plegada: quita el plural y la vocal final
+
+    Es un lematizador liviano, no un análisis morfológico: basta con que la forma
+    indexada y la buscada coincidan ("farmacias" y "farmacia" -> "farmaci",
+    "luces" -> "luz", "pasajes" y "pasaje" -> "pasaj").
+    """
+    if len(palabra) > 4 and palabra.endswith("ces"):
+        palabra = palabra[:-3] + "z"
+    elif len(palabra) > 4 and palabra.endswith("es") and palabra[-3] in "lrndjsy":
+        palabra = palabra[:-2]
+    elif len(palabra) > 3 and palabra.endswith("s"):
+        palabra = palabra[:-1]
+    if len(palabra) > 3 and palabra[-1] in "aeo":
+        palabra = palabra[:-1]
+    return palabra
+
+@functools.lru_cache(maxsize=4096)
+def terminos_busqueda(texto):
+    """Términos (raíces) de un texto para el índice de búsqueda, sin repetir y en orden
+
+    Se guarda en caché porque las descripciones se repiten mucho ("pasaje", "uber").
+    """
+    terminos = []
+    for palabra in re.findall(r"[a-z0-9]+", plegar_texto(texto)):
+        if len(palabra) < 2 or palabra in PALABRAS_VACIAS:
+            continue
+        raiz = raiz_busqueda(palabra)
+        if raiz not in terminos:
+            terminos.append(raiz)
+    return tuple(terminos)
+
+def _indexar_gasto(indice, gasto, month_key):
+    """Agrega un gasto a las listas (ordenadas por (fecha, id)) de sus términos"""
+    clave = (gasto.get("fecha", ""), gasto.get("id", ""))
+    terminos = terminos_busqueda(f"{gasto.get('descripcion', '')} {gasto.get('categoria', 'otros')}")
+    indice["terminos"][clave] = terminos
+    indice["gastos"][clave] = dict(gasto, month_key=month_key)
+    for termino in terminos:
+        lista = indice["postings"].setdefault(termino, [])
+        if not lista or lista[-1] < clave:
+            lista.append(clave)
+        else:
+            bisect.insort(lista, clave)
+
+def _desindexar_gasto(indice, clave):
+    """Quita un gasto de las listas de sus términos"""
+    for termino in indice["terminos"].pop(clave, ()):
+        lista = indice["postings"][termino]
+        i = bisect.bisect_left(lista, clave)
+        if i < len(lista) and lista[i] == clave:
+            del lista[i]
+        if not lista:
+            del indice["postings"][termino]
+    indice["gastos"].pop(clave, None)
+
+def get_busqueda_index(user_id):
+    """Índice invertido de los gastos del usuario ({"postings": {termino: [claves]}, ...})
+
+    Se construye una vez desde el índice de gastos y luego se mantiene gasto a
+    gasto al registrar, editar o eliminar, así una búsqueda solo recorre las listas
+    de sus términos y no se reconstruye con cada cambio del registro.
+    """
+    with storage_lock:
+        indice = busqueda_index.get(str(user_id))
+        if indice is not None:
+            return indice
+        
+        indice = {"postings": {}, "terminos": {}, "gastos": {}}
+        gastos = get_gastos_index(user_id)
+        for clave in gastos["claves"]:
+            gasto = gastos["gastos"][clave]
+            _indexar_gasto(indice, gasto, gasto["month_key"])
+        busqueda_index[str(user_id)] = indice
+        return indice
+
+def update_busqueda_gastos(user_id, nuevos):
+    """Agrega gastos nuevos ([(gasto, month_key)]) al índice de búsqueda"""
+    indice = busqueda_index.get(str(user_id))
+    if indice is None:
+        return
+    for gasto, month_key in nuevos:
+        _indexar_gasto(indice, gasto, month_key)
+
+def remove_busqueda_gasto(user_id, gasto):
+    """Quita un gasto eliminado del índice de búsqueda"""
+    indice = busqueda_index.get(str(user_id))
+    if indice is not None:
+        _desindexar_gasto(indice, (gasto.get("fecha", ""), gasto.get("id", "")))
+
+def reindex_busqueda_gasto(user_id, gasto, month_key):
+    """Vuelve a indexar un gasto editado (su descripción o categoría pueden haber cambiado)"""
+    indice = busqueda_index.get(str(user_id))
+    if indice is not None:
+        _desindexar_gasto(indice, (gasto.get("fecha", ""), gasto.get("id", "")))
+        _indexar_gasto(indice, gasto, month_key)
+
+def buscar_claves(user_id, terminos, desde=None, hasta=None):
+    """Claves (fecha, id) de los gastos que contienen todos los términos, en orden
+
+    Se recorre solo la lista más corta, recortada al período [desde, hasta]
+    (YYYY-MM-DD) con búsqueda binaria, y cada clave se busca en las demás listas
+    también con búsqueda binaria.
+
+    Returns:
+        (claves, gastos): lista ordenada de claves y {clave: gasto}
+    """
+    with storage_lock:
+        indice = get_busqueda_index(user_id)
+        listas = [indice["postings"].get(termino) for termino in terminos]
+        if not listas or not all(listas):
+            return [], indice["gastos"]
+        listas.sort(key=len)
+        
+        base = listas[0]
+        lo = bisect.bisect_left(base, (desde,)) if desde else 0
+        hi = bisect.bisect_left(base, (hasta + "~",)) if hasta else len(base)
+        claves = []
+        for clave in base[lo:hi]:
+            for lista in listas[1:]:
+                i = bisect.bisect_left(lista, clave)
+                if i == len(lista) or lista[i] != clave:
+                    break
+            else:
+                claves.append(clave)
+        return claves, indice["gastos"]
+
+def get_gastos_arrays(user_id):
+    """Arreglos NumPy con el historial del usuario, ordenados por fecha
+
+    Se construyen a partir del índice de gastos y se reutilizan mientras no cambie
+    la versión del registro, así cada consulta de estadísticas solo corta y suma.
+    """
+    indice = get_gastos_index(user_id)
+    entrada = gastos_arrays.get(str(user_id))
+    if entrada is not None and entrada["version"] == indice["version"]:
+        return entrada
+    
+    gastos = [indice["gastos"][clave] for clave in indice["claves"]]
+    categorias = sorted({g.get("categoria", "otros") for g in gastos})
+    codigos = {cat: i for i, cat in enumerate(categorias)}
+    entrada = {
+        "version": indice["version"],
+        "gastos": gastos,
+        "dias": np.array([g["fecha"][:10] for g in gastos], dtype="datetime64[D]"),
+        "bs": np.array([g["bolivares"] for g in gastos], dtype=np.float64),
+        "usd": np.array([g["dolares"] for g in gastos], dtype=np.float64),
+        "categoria": np.array([codigos[g.get("categoria", "otros")] for g in gastos], dtype=np.int64),
+        "categorias": categorias,
+    }
+    gastos_arrays[str(user_id)] = entrada
+    return entrada
+
+def get_statistics(user_id, inicio=None, fin=None):
+    """Obtiene estadísticas de un período (por defecto, el mes actual)
+
+    inicio y fin son fechas (date) incluidas. Los totales, la participación por
+    categoría, la serie diaria, la mediana y los percentiles salen de operaciones
+    vectorizadas sobre el tramo del período, ubicado con búsqueda binaria.
+    """
+    hoy = datetime.now().date()
+    if inicio is None:
+        rango = _rango_mes(hoy.year, hoy.month)
+        inicio, fin = rango[0].date(), rango[1].date()
+    
+    datos = get_gastos_arrays(user_id)
+    desde = np.datetime64(inicio, "D")
+    a = int(np.searchsorted(datos["dias"], desde, side="left"))
+    b = int(np.searchsorted(datos["dias"], np.datetime64(fin, "D"), side="right"))
+    if a == b:
+        return None
+    
+    bs = datos["bs"][a:b]
+    usd = datos["usd"][a:b]
+    offsets = (datos["dias"][a:b] - desde).astype(np.int64)
+    categorias_idx = datos["categoria"][a:b]
+    gastos = datos["gastos"][a:b]
+    
+    # Días transcurridos del período (un período en curso se promedia hasta hoy)
+    dias_periodo = (fin - inicio).days + 1
+    dias_transcurridos = max(1, min((min(fin, hoy) - inicio).days + 1, dias_periodo))
+    
+    serie_bs = np.bincount(offsets, weights=bs, minlength=dias_periodo)
+    serie_usd = np.bincount(offsets, weights=usd, minlength=dias_periodo)
+    serie_count = np.bincount(offsets, minlength=dias_periodo)
+    
+    n_categorias = len(datos["categorias"])
+    cat_bs = np.bincount(categorias_idx, weights=bs, minlength=n_categorias)
+    cat_usd = np.bincount(categorias_idx, weights=usd, minlength=n_categorias)
+    cat_count = np.bincount(categorias_idx, minlength=n_categorias)
+    
+    total_bs = float(bs.sum())
+    total_usd = float(usd.sum())
+    i_max = int(np.argmax(bs))
+    i_min = int(np.argmin(bs))
+    p50_bs, p75_bs, p90_bs = np.percentile(bs, [50, 75, 90])
+    
+    stats = {
+        "inicio": inicio,
+        "fin": fin,
+        "dias": dias_transcurridos,
+        "total_bs": total_bs,
+        "total_usd": total_usd,
+        "count": len(gastos),
+        "promedio_diario_bs": total_bs / dias_transcurridos,
+        "promedio_diario_usd": total_usd / dias_transcurridos,
+        "dias_con_gastos": int(np.count_nonzero(serie_count)),
+        "max_bs": float(bs[i_max]),
+        "min_bs": float(bs[i_min]),
+        "max_usd": float(usd[i_max]),
+        "min_usd": float(usd[i_min]),
+        "max_gasto": gastos[i_max],
+        "min_gasto": gastos[i_min],
+        "mediana_bs": float(p50_bs),
+        "p75_bs": float(p75_bs),
+        "p90_bs": float(p90_bs),
+        "mediana_usd": float(np.median(usd)),
+        "serie_bs": serie_bs.tolist(),
+        "serie_usd": serie_usd.tolist(),
+    }
+    
+    # Gastos por categoría, con su participación en el total (USD)
+    stats["by_category"] = {
+        datos["categorias"][i]: {
+            "bs": float(cat_bs[i]),
+            "usd": float(cat_usd[i]),
+            "count": int(cat_count[i]),
+            "porcentaje": float(cat_usd[i] / total_usd * 100) if total_usd > 0 else 0,
+        }
+        for i in np.flatnonzero(cat_count)
+    }
+    
+    # Día con más gastos
+    dia_max = int(np.argmax(serie_bs))
+    stats["max_day"] = (
+        (inicio + timedelta(days=dia_max)).strftime("%Y-%m-%d"),
+        {"bs": float(serie_bs[dia_max]), "usd": float(serie_usd[dia_max]), "count": int(serie_count[dia_max])},
+    )
+    
+    return stats
+
+# Períodos de /estadisticas: "2025-11", "2025", "q3", "2025-q3", "30d", "ultimos 30 dias", "este año"
+PERIODO_MES = re.compile(r"^(\d{4})-(\d{1,2})$")
+PERIODO_ANIO = re.compile(r"^(\d{4})$")
+PERIODO_TRIMESTRE = re.compile(r"^(?:(\d{4})[-\s]?)?[qt]([1-4])(?:[-\s]?(\d{4}))?$")
+PERIODO_DIAS = re.compile(r"^(?:[uú]ltimos?\s+)?(\d+)\s*(?:d|d[ií]as)$")
+
+def parse_periodo(texto, hoy=None):
+    """Convierte el texto de /estadisticas en (inicio, fin, etiqueta); None si no se reconoce
+
+    Sin texto es el mes actual. También acepta meses, semanas y fechas con la
+    misma gramática de los mensajes ("noviembre", "el mes pasado", "ayer").
+    """
+    if hoy is None:
+        hoy = datetime.now().date()
+    texto = texto.strip().lower()
+    
+    if not texto:
+        rango = _rango_mes(hoy.year, hoy.month)
+        return rango[0].date(), rango[1].date(), f"mes {hoy.strftime('%Y-%m')}"
+    
+    match = PERIODO_MES.match(texto)
+    if match and 1 <= int(match.group(2)) <= 12:
+        rango = _rango_mes(int(match.group(1)), int(match.group(2)))
+        return rango[0].date(), rango[1].date(), f"mes {rango[0].strftime('%Y-%m')}"
+    
+    match = PERIODO_ANIO.match(texto)
+    if match or texto in ("año", "este año", "anio", "este anio", "año pasado", "el año pasado"):
+        year = int(match.group(1)) if match else hoy.year - ("pasado" in texto)
+        return datetime(year, 1, 1).date(), datetime(year, 12, 31).date(), f"año {year}"
+    
+    match = PERIODO_TRIMESTRE.match(texto)
+    if match or texto in ("trimestre", "este trimestre"):
+        if match:
+            year = int(match.group(1) or match.group(3) or hoy.year)
+            trimestre = int(match.group(2))
+        else:
+            year, trimestre = hoy.year, (hoy.month - 1) // 3 + 1
+        inicio = datetime(year, 3 * trimestre - 2, 1).date()
+        fin = _rango_mes(year, 3 * trimestre)[1].date()
+        return inicio, fin, f"trimestre {trimestre} de {year}"
+    
+    match = PERIODO_DIAS.match(texto)
+    if match and int(match.group(1)) > 0:
+        n = int(match.group(1))
+        return hoy - timedelta(days=n - 1), hoy, f"ultimos {n} dias"
+    
+    fecha_info = parse_fecha_expresion(texto, hoy)
+    if not fecha_info["rango"] and not fecha_info["fecha"]:
+        # "mes pasado", "semana pasada": la gramática de mensajes espera el artículo
+        fecha_info = parse_fecha_expresion(f"el {texto}", hoy)
+    if fecha_info["rango"]:
+        inicio, fin = fecha_info["rango"]
+        return inicio.date(), fin.date(), f"{inicio.strftime('%Y-%m-%d')} a {fin.strftime('%Y-%m-%d')}"
+    if fecha_info["fecha"]:
+        dia = fecha_info["fecha"].date()
+        return dia, dia, dia.strftime("%Y-%m-%d")
+    return None
+
+def new_kll(k=None):
+    """Crea un sketch KLL vacío (cuantiles aproximados con memoria acotada)
+
+    Los valores se guardan en niveles; un valor del nivel h representa 2**h
+    valores originales. Cuando un nivel se llena se ordena y la mitad de sus
+    valores (pares o impares, al azar) sube al nivel siguiente.
+    """
+    return {"k": k or KLL_K, "n": 0, "niveles": [[]], "ordenado": None}
+
+def _kll_capacidad(sketch, nivel):
+    """Capacidad de un nivel: k en el más alto, decreciendo 2/3 por nivel hacia abajo"""
+    profundidad = len(sketch["niveles"]) - nivel - 1
+    return max(2, int(sketch["k"] * (2 / 3) ** profundidad))
+
+def _kll_comprimir(sketch):
+    """Compacta niveles mientras el sketch supere su capacidad total"""
+    niveles = sketch["niveles"]
+    while sum(len(n) for n in niveles) > sum(_kll_capacidad(sketch, h) for h in range(len(niveles))):
+        for h, nivel in enumerate(niveles):
+            if len(nivel) < _kll_capacidad(sketch, h):
+                continue
+            if h + 1 == len(niveles):
+                niveles.append([])
+            nivel.sort()
+            # Con un número impar de valores, el último se queda para no perder peso
+            pares = len(nivel) - len(nivel) % 2
+            niveles[h + 1].extend(nivel[random.randint(0, 1):pares:2])
+            niveles[h] = nivel[pares:]
+            break
+
+def kll_update(sketch, valor):
+    """Agrega un valor al sketch"""
+    sketch["niveles"][0].append(valor)
+    sketch["n"] += 1
+    sketch["ordenado"] = None
+    if len(sketch["niveles"][0]) >= _kll_capacidad(sketch, 0):
+        _kll_comprimir(sketch)
+
+def kll_merge(*sketches):
+    """Combina varios sketches en uno nuevo (equivale a un sketch de todos los valores)"""
+    combinado = new_kll(max(s["k"] for s in sketches))
+    for sketch in sketches:
+        combinado["n"] += sketch["n"]
+        for h, nivel in enumerate(sketch["niveles"]):
+            while len(combinado["niveles"]) <= h:
+                combinado["niveles"].append([])
+            combinado["niveles"][h].extend(nivel)
+    _kll_comprimir(combinado)
+    return combinado
+
+def _kll_ordenado(sketch):
+    """Valores del sketch ordenados con su peso acumulado (se cachea hasta el próximo cambio)"""
+    if sketch["ordenado"] is None:
+        items = sorted((v, 1 << h) for h, nivel in enumerate(sketch["niveles"]) for v in nivel)
+        valores, acumulados, total = [], [], 0
+        for valor, peso in items:
+            total += peso
+            valores.append(valor)
+            acumulados.append(total)
+        sketch["ordenado"] = (valores, acumulados)
+    return sketch["ordenado"]
+
+def kll_quantile(sketch, q):
+    """Cuantil aproximado q (0 a 1) de los valores del sketch (None si está vacío)"""
+    valores, acumulados = _kll_ordenado(sketch)
+    if not valores:
+        return None
+    i = bisect.bisect_left(acumulados, q * acumulados[-1])
+    return valores[min(i, len(valores) - 1)]
+
+def kll_rank(sketch, valor):
+    """Fracción aproximada de los valores del sketch menores que valor"""
+    valores, acumulados = _kll_ordenado(sketch)
+    i = bisect.bisect_left(valores, valor)
+    return acumulados[i - 1] / acumulados[-1] if i else 0.0
+
+def get_quantile_sketches(user_id):
+    """Sketches de montos en USD del usuario por categoría ({categoria: sketch})
+
+    Se construyen una vez desde los arreglos de gastos y luego cada gasto nuevo
+    se agrega al sketch de su categoría; editar o eliminar un gasto los descarta.
+    Se construyen e instalan bajo storage_lock: un gasto guardado mientras tanto
+    (p. ej. durante el arranque) queda en los arreglos o llega al sketch ya instalado.
+    """
+    with storage_lock:
+        sketches = quantile_sketches.get(str(user_id))
+        if sketches is not None:
+            return sketches
+        
+        datos = get_gastos_arrays(user_id)
+        sketches = {}
+        for codigo, categoria in enumerate(datos["categorias"]):
+            sketch = new_kll()
+            for valor in datos["usd"][datos["categoria"] == codigo].tolist():
+                kll_update(sketch, valor)
+            sketches[categoria] = sketch
+        quantile_sketches[str(user_id)] = sketches
+        return sketches
+
+def update_quantile_sketches(user_id, gasto):
+    """Agrega un gasto nuevo al sketch de su categoría (se llama bajo storage_lock, junto al guardado)"""
+    with storage_lock:
+        sketches = quantile_sketches.get(str(user_id))
+        if sketches is None:
+            return
+        categoria = gasto.get("categoria", "otros")
+        if categoria not in sketches:
+            sketches[categoria] = new_kll()
+        kll_update(sketches[categoria], gasto["dolares"])
+
+def invalidate_quantile_sketches(user_id):
+    """Descarta los sketches del usuario (se reconstruyen en la próxima consulta)"""
+    quantile_sketches.pop(str(user_id), None)
+
+def get_category_quantiles(user_id):
+    """Mediana y p90 en USD de todo el historial, por categoría y en total"""
+    sketches = get_quantile_sketches(user_id)
+    resultado = {}
+    for categoria, sketch in sketches.items():
+        if sketch["n"]:
+            resultado[categoria] = {
+                "n": sketch["n"],
+                "mediana": kll_quantile(sketch, 0.5),
+                "p90": kll_quantile(sketch, 0.9),
+            }
+    if len(resultado) > 1:
+        total = kll_merge(*sketches.values())
+        resultado["total"] = {"n": total["n"], "mediana": kll_quantile(total, 0.5), "p90": kll_quantile(total, 0.9)}
+    return resultado
+
+def get_gasto_inusual(user_id, categoria, amount_usd):
+    """Texto de aviso si un gasto es inusualmente caro para su categoría (None si no)
+
+    Se consulta antes de registrar el gasto, para no compararlo consigo mismo.
+    """
+    sketch = get_quantile_sketches(user_id).get(categoria)
+    if sketch is None or sketch["n"] < GASTO_INUSUAL_MIN:
+        return None
+    rango = kll_rank(sketch, amount_usd)
+    if rango < GASTO_INUSUAL_RANGO:
+        return None
+    return (
+        f"Gasto inusual: es mayor que el {int(rango * 100)}% de tus gastos de {categoria} "
+        f"(mediana ${kll_quantile(sketch, 0.5):,.2f}, p90 ${kll_quantile(sketch, 0.9):,.2f} USD)"
+    )
+
+def _figura_a_png(figura):
+    """Renderiza una figura de matplotlib (backend Agg, sin pantalla) a bytes PNG"""
+    buffer = io.BytesIO()
+    figura.savefig(buffer, format="png", dpi=120, bbox_inches="tight")
+    return buffer.getvalue()
+
+def render_grafico_diario(user_id, inicio, fin, etiqueta):
+    """Gráfico de barras del gasto diario (USD) de un período"""
+    stats = get_statistics(user_id, inicio, fin)
+    if not stats:
+        return None
+    dias = np.arange(np.datetime64(inicio, "D"), np.datetime64(fin, "D") + 1).astype(datetime)
+    serie = np.array(stats["serie_usd"])
+    figura = Figure(figsize=(8, 4))
+    ax = figura.subplots()
+    ax.bar(dias, serie, width=0.8, color="#2e86de")
+    ax.axhline(stats["promedio_diario_usd"], color="#e74c3c", linestyle="--", linewidth=1,
+               label=f"Promedio ${stats['promedio_diario_usd']:,.2f}")
+    ax.set_title(f"Gasto diario - {etiqueta} (total ${stats['total_usd']:,.2f} USD)")
+    ax.set_ylabel("USD")
+    ax.legend()
+    ax.grid(axis="y", alpha=0.3)
+    figura.autofmt_xdate()
+    return _figura_a_png(figura)
+
+def render_grafico_categorias(user_id, inicio, fin, etiqueta):
+    """Gráfico de barras horizontales del gasto por categoría (USD) de un período"""
+    stats = get_statistics(user_id, inicio, fin)
+    if not stats:
+        return None
+    categorias = sorted(stats["by_category"].items(), key=lambda x: x[1]["usd"])
+    figura = Figure(figsize=(8, max(3, 0.5 * len(categorias) + 1.5)))
+    ax = figura.subplots()
+    barras = ax.barh([cat for cat, _ in categorias], [datos["usd"] for _, datos in categorias], color="#10ac84")
+    ax.bar_label(barras, labels=[f"${d['usd']:,.2f} ({d['porcentaje']:.1f}%)" for _, d in categorias], padding=3)
+    ax.set_title(f"Gasto por categoria - {etiqueta} (total ${stats['total_usd']:,.2f} USD)")
+    ax.set_xlabel("USD")
+    ax.margins(x=0.25)
+    return _figura_a_png(figura)
+
+def render_grafico_tasas(inicio, fin, etiqueta):
+    """Gráfico de la tasa oficial y paralela guardadas en tasas.json para un período"""
+    tasas = load_tasas()
+    desde, hasta = inicio.strftime("%Y-%m-%d"), fin.strftime("%Y-%m-%d")
+    fechas = sorted(k for k in tasas if desde <= k <= hasta)
+    figura = Figure(figsize=(8, 4))
+    ax = figura.subplots()
+    hay_datos = False
+    for tipo, color in (("oficial", "#2e86de"), ("paralela", "#ee5253")):
+        puntos = [(datetime.strptime(k, "%Y-%m-%d"), tasas[k][tipo]) for k in fechas if tasas[k].get(tipo)]
+        if puntos:
+            hay_datos = True
+            ax.plot([p[0] for p in puntos], [p[1] for p in puntos], marker=".", color=color, label=tipo)
+    if not hay_datos:
+        return None
+    ax.set_title(f"Tasas Bs/USD - {etiqueta}")
+    ax.set_ylabel("Bs por USD")
+    ax.legend()
+    ax.grid(alpha=0.3)
+    figura.autofmt_xdate()
+    return _figura_a_png(figura)
+
+def get_grafico(user_id, tipo, inicio, fin, etiqueta):
+    """PNG de un gráfico, servido desde el caché mientras los datos no cambien
+
+    La clave incluye la versión del registro del usuario (o de tasas.json), así
+    que un gasto nuevo invalida sus gráficos sin tener que borrarlos.
+    """
+    if tipo == "tasas":
+        clave = ("tasas", inicio, fin, get_tasas_version())
+    else:
+        clave = (str(user_id), tipo, inicio, fin, get_ledger_version(user_id))
+    
+    cache = chart_state["cache"]
+    with chart_lock:
+        if clave in cache:
+            cache.move_to_end(clave)
+            chart_state["aciertos"] += 1
+            return cache[clave]
+    
+    # Se renderiza fuera del candado (puede tardar); la figura no usa pyplot, es segura entre hilos
+    if tipo == "tasas":
+        png = render_grafico_tasas(inicio, fin, etiqueta)
+    elif tipo == "categorias":
+        png = render_grafico_categorias(user_id, inicio, fin, etiqueta)
+    else:
+        png = render_grafico_diario(user_id, inicio, fin, etiqueta)
+    with chart_lock:
+        chart_state["renderizados"] += 1
+        cache[clave] = png
+        while len(cache) > CHART_CACHE_MAX:
+            cache.popitem(last=False)
+    return png
+
+def _pronosticar_serie(serie, dia_semana_inicio, dias_futuros):
+    """Pronostica el gasto de cada uno de los próximos dias_futuros días de una serie diaria
+
+    Combina una tendencia lineal (mínimos cuadrados sobre la serie sin efecto
+    semanal) con un factor por día de la semana, suavizado hacia 1 cuando hay
+    pocas semanas de historial. Con menos de dos semanas no se estima tendencia.
+    """
+    n = len(serie)
+    media = serie.mean()
+    if media <= 0:
+        return np.zeros(dias_futuros)
+    
+    dias_semana = (dia_semana_inicio + np.arange(n)) % 7
+    suma = np.bincount(dias_semana, weights=serie, minlength=7)
+    cuenta = np.bincount(dias_semana, minlength=7)
+    factores = (suma + 2 * media) / ((cuenta + 2) * media)
+    sin_semana = serie / factores[dias_semana]
+    
+    if n >= 14:
+        pendiente, intercepto = np.polyfit(np.arange(n), sin_semana, 1)
+    else:
+        pendiente, intercepto = 0.0, sin_semana.mean()
+    futuro = np.arange(n, n + dias_futuros)
+    base = np.maximum(intercepto + pendiente * futuro, 0)
+    return base * factores[(dia_semana_inicio + futuro) % 7]
+
+def _recalcular_proyeccion(estado):
+    """Recalcula la proyección de fin de mes a partir de la serie diaria del estado"""
+    hoy = estado["hoy"]
+    if estado["primer_dia"] is None:
+        estado["proyeccion"] = None
+        return
+    
+    fin_mes = _rango_mes(hoy.year, hoy.month)[1].date()
+    dias_restantes = (fin_mes - hoy).days
+    desde_mes = (hoy.replace(day=1) - estado["inicio"]).days
+    # Un primer gasto con fecha futura deja al menos hoy como historial (evita dividir por cero)
+    desde_historial = min(max(0, (estado["primer_dia"] - estado["inicio"]).days), PROYECCION_VENTANA - 1)
+    
+    proyeccion = {
+        "month_key": hoy.strftime("%Y-%m"),
+        "dias_restantes": dias_restantes,
+        "dias_historial": PROYECCION_VENTANA - 1 - desde_historial,
+    }
+    for moneda in ("usd", "bs"):
+        serie = estado[moneda]
+        gastado = float(serie[desde_mes:].sum())
+        # Solo días completos (hasta ayer); con menos de una semana, promedio simple incluyendo hoy
+        historial = serie[desde_historial:-1]
+        if len(historial) >= 7:
+            dia_semana = (estado["inicio"] + timedelta(days=desde_historial)).weekday()
+            pronostico = _pronosticar_serie(historial, dia_semana, dias_restantes + 1)
+            # El primer día pronosticado es hoy: solo cuenta lo que falte por gastar hoy
+            futuro = max(float(pronostico[0] - serie[-1]), 0) + float(pronostico[1:].sum())
+            proyeccion["metodo"] = "tendencia"
+        else:
+            promedio = float(serie[desde_historial:].sum()) / (len(serie) - desde_historial)
+            futuro = promedio * dias_restantes
+            proyeccion["metodo"] = "promedio"
+        proyeccion[f"gastado_{moneda}"] = gastado
+        proyeccion[f"proyectado_{moneda}"] = gastado + futuro
+    estado["proyeccion"] = proyeccion
+
+def build_proyeccion(user_id, hoy=None):
+    """Construye la serie diaria de los últimos PROYECCION_VENTANA días del usuario"""
+    if hoy is None:
+        hoy = datetime.now().date()
+    datos = get_gastos_arrays(user_id)
+    inicio = hoy - timedelta(days=PROYECCION_VENTANA - 1)
+    desde = np.datetime64(inicio, "D")
+    a = int(np.searchsorted(datos["dias"], desde, side="left"))
+    b = int(np.searchsorted(datos["dias"], np.datetime64(hoy, "D"), side="right"))
+    offsets = (datos["dias"][a:b] - desde).astype(np.int64)
+    
+    estado = {
+        "hoy": hoy,
+        "inicio": inicio,
+        "primer_dia": datos["dias"][0].item() if len(datos["dias"]) else None,
+        "usd": np.bincount(offsets, weights=datos["usd"][a:b], minlength=PROYECCION_VENTANA),
+        "bs": np.bincount(offsets, weights=datos["bs"][a:b], minlength=PROYECCION_VENTANA),
+    }
+    _recalcular_proyeccion(estado)
+    proyecciones[str(user_id)] = estado
+    return estado
+
+def _avanzar_proyeccion(estado, hoy):
+    """Desplaza la serie diaria hasta hoy (los días nuevos empiezan en cero)"""
+    dias = min((hoy - estado["hoy"]).days, PROYECCION_VENTANA)
+    for moneda in ("usd", "bs"):
+        estado[moneda] = np.concatenate([estado[moneda][dias:], np.zeros(dias)])
+    estado["hoy"] = hoy
+    estado["inicio"] = hoy - timedelta(days=PROYECCION_VENTANA - 1)
+    _recalcular_proyeccion(estado)
+
+def update_proyeccion_gastos(user_id, gastos):
+    """Suma gastos nuevos a la serie diaria del usuario y recalcula la proyección una vez"""
+    estado = proyecciones.get(str(user_id))
+    if estado is None:
+        return
+    hoy = datetime.now().date()
+    if estado["hoy"] != hoy:
+        _avanzar_proyeccion(estado, hoy)
+    
+    for gasto in gastos:
+        dia = datetime.strptime(gasto["fecha"][:10], "%Y-%m-%d").date()
+        offset = (dia - estado["inicio"]).days
+        if 0 <= offset < PROYECCION_VENTANA:
+            estado["usd"][offset] += gasto["dolares"]
+            estado["bs"][offset] += gasto["bolivares"]
+        if estado["primer_dia"] is None or dia < estado["primer_dia"]:
+            estado["primer_dia"] = dia
+    _recalcular_proyeccion(estado)
+
+def invalidate_proyeccion(user_id):
+    """Descarta la serie del usuario (se reconstruye en la próxima consulta)"""
+    proyecciones.pop(str(user_id), None)
+
+def get_proyeccion(user_id):
+    """Obtiene la proyección de fin de mes del usuario (None si no tiene gastos)
+
+    Se lee del estado mantenido; solo se reconstruye si no existe, y al cambiar
+    el día la serie se desplaza sin volver a recorrer los gastos.
+    """
+    hoy = datetime.now().date()
+    estado = proyecciones.get(str(user_id))
+    if estado is None:
+        estado = build_proyeccion(user_id, hoy)
+    elif estado["hoy"] != hoy:
+        _avanzar_proyeccion(estado, hoy)
+    return estado["proyeccion"]
+
+def format_proyeccion(proyeccion, presupuesto=None):
+    """Texto de la proyección de fin de mes, comparada con el presupuesto si existe"""
+    if not proyeccion:
+        return ""
+    texto = (
+        f"Proyeccion a fin de mes: {proyeccion['proyectado_bs']:,.2f} Bs "
+        f"(${proyeccion['proyectado_usd']:,.2f} USD)\n"
+    )
+    if proyeccion["metodo"] == "promedio":
+        texto += "(estimacion preliminar: menos de una semana de historial)\n"
+    if presupuesto:
+        diferencia = presupuesto - proyeccion["proyectado_usd"]
+        porcentaje = proyeccion["proyectado_usd"] / presupuesto * 100
+        if diferencia < 0:
+            texto += f"Al ritmo actual superaras el presupuesto en ${-diferencia:,.2f} USD ({porcentaje:.1f}%)\n"
+        else:
+            texto += f"Margen estimado al cierre: ${diferencia:,.2f} USD ({porcentaje:.1f}% del presupuesto)\n"
+    return texto
+
+def get_presupuesto(user_id, month_key=None):
+    """Obtiene el presupuesto del usuario para un mes"""
+    if month_key is None:
+        month_key = get_current_month_key()
+    
+    presupuestos = load_presupuestos()
+    user_presupuestos = presupuestos.get(str(user_id), {})
+    return user_presupuestos.get(month_key)
+
+def set_presupuesto(user_id, amount_usd, month_key=None):
+    """Establece el presupuesto del usuario para un mes"""
+    if month_key is None:
+        month_key = get_current_month_key()
+    
+    with storage_lock:
+        presupuestos = load_presupuestos()
+        presupuestos.setdefault(str(user_id), {})[month_key] = amount_usd
+        save_presupuestos(presupuestos)
+        _reset_alertas_presupuesto(user_id, "total", amount_usd, month_key)
+
+def get_presupuestos_categorias(user_id, month_key=None):
+    """Obtiene los presupuestos por categoría del usuario para un mes ({categoria: usd})"""
+    if month_key is None:
+        month_key = get_current_month_key()
+    
+    presupuestos_categorias = load_presupuestos_categorias()
+    mes = presupuestos_categorias.get(str(user_id), {}).get(month_key, {})
+    return dict(mes.get("limites", {}))
+
+def set_presupuesto_categoria(user_id, categoria, amount_usd, month_key=None):
+    """Establece (o elimina, si amount_usd es 0) el presupuesto de una categoría para un mes"""
+    if month_key is None:
+        month_key = get_current_month_key()
+    
+    with storage_lock:
+        presupuestos_categorias = load_presupuestos_categorias()
+        mes = presupuestos_categorias.setdefault(str(user_id), {}).setdefault(
+            month_key, {"limites": {}, "alertas": {}}
+        )
+        if amount_usd:
+            mes["limites"][categoria] = amount_usd
+        else:
+            mes["limites"].pop(categoria, None)
+        save_presupuestos_categorias(presupuestos_categorias)
+        _reset_alertas_presupuesto(user_id, categoria, amount_usd, month_key)
+
+def _reset_alertas_presupuesto(user_id, clave, limite, month_key):
+    """Rearma las alertas de un presupuesto recién cambiado ("total" es el presupuesto del mes)"""
+    with storage_lock:
+        presupuestos_categorias = load_presupuestos_categorias()
+        mes = presupuestos_categorias.get(str(user_id), {}).get(month_key)
+        if mes and mes.get("alertas", {}).pop(clave, None) is not None:
+            save_presupuestos_categorias(presupuestos_categorias)
+    
+    estado = alertas_presupuesto.get(str(user_id))
+    if estado is not None and estado["month_key"] == month_key:
+        if limite:
+            estado["limites"][clave] = limite
+        else:
+            estado["limites"].pop(clave, None)
+        estado["disparadas"].pop(clave, None)
+
+def get_alertas_estado(user_id, gastos=None):
+    """Estado de alertas de presupuesto del usuario para el mes actual
+
+    Guarda los totales en USD del mes (general y por categoría), los límites y los
+    umbrales ya avisados. Se construye una vez por mes (o tras editar/eliminar un
+    gasto) y luego cada gasto nuevo solo suma a sus totales.
+    gastos permite pasar el archivo ya cargado.
+    """
+    month_key = get_current_month_key()
+    estado = alertas_presupuesto.get(str(user_id))
+    if estado is not None and estado["month_key"] == month_key:
+        return estado
+    
+    if gastos is None:
+        gastos = load_gastos()
+    totales = {"total": 0}
+    for g in gastos.get(str(user_id), {}).get(month_key, []):
+        cat = g.get("categoria", "otros")
+        totales[cat] = totales.get(cat, 0) + g["dolares"]
+        totales["total"] += g["dolares"]
+    
+    # Umbrales avisados; los que dejaron de alcanzarse (gasto editado o eliminado) se rearman
+    with storage_lock:
+        presupuestos_categorias = load_presupuestos_categorias()
+        mes = presupuestos_categorias.get(str(user_id), {}).get(month_key, {})
+        limites = dict(mes.get("limites", {}))
+        presupuesto = get_presupuesto(user_id, month_key)
+        if presupuesto:
+            limites["total"] = presupuesto
+        guardadas = mes.get("alertas", {})
+        disparadas = {}
+        for clave, umbrales in guardadas.items():
+            limite = limites.get(clave)
+            if limite:
+                porcentaje = totales.get(clave, 0) / limite * 100
+                vigentes = [u for u in umbrales if porcentaje >= u]
+                if vigentes:
+                    disparadas[clave] = vigentes
+        if disparadas != guardadas:
+            mes["alertas"] = disparadas
+            save_presupuestos_categorias(presupuestos_categorias)
+    
+    estado = {"month_key": month_key, "totales": totales, "limites": limites, "disparadas": disparadas}
+    alertas_presupuesto[str(user_id)] = estado
+    return estado
+
+def invalidate_alertas_presupuesto(user_id):
+    """Descarta el estado de alertas del usuario (se reconstruye en el próximo gasto)"""
+    alertas_presupuesto.pop(str(user_id), None)
+
+def evaluar_alertas_presupuesto(user_id, gastos):
+    """Suma gastos nuevos a los totales del mes y devuelve las alertas de umbral alcanzadas
+
+    Cada gasto solo toca su categoría y el total, así que el costo no depende del
+    historial. Por presupuesto se avisa el umbral más alto recién alcanzado, y cada
+    umbral una sola vez por mes.
+    """
+    estado = get_alertas_estado(user_id)
+    totales = estado["totales"]
+    tocadas = set()
+    for gasto in gastos:
+        if gasto["fecha"][:7] != estado["month_key"]:
+            continue
+        cat = gasto.get("categoria", "otros")
+        totales[cat] = totales.get(cat, 0) + gasto["dolares"]
+        totales["total"] += gasto["dolares"]
+        tocadas.update((cat, "total"))
+    
+    nuevas = {}
+    for clave in tocadas:
+        limite = estado["limites"].get(clave)
+        if not limite:
+            continue
+        porcentaje = totales[clave] / limite * 100
+        disparadas = estado["disparadas"].setdefault(clave, [])
+        alcanzados = [u for u in PRESUPUESTO_UMBRALES if porcentaje >= u and u not in disparadas]
+        if alcanzados:
+            disparadas.extend(alcanzados)
+            nuevas[clave] = max(alcanzados)
+    if not nuevas:
+        return []
     
-    filename = f"gastos_{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-    filepath = os.path.join(script_dir, filename)
-    
-    with open(filepath, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow(['ID', 'Fecha', 'Bolívares', 'Dólares', 'Tipo Cambio', 'Categoría', 'Descripción'])
-        for g in all_gastos:
-            writer.writerow([
-                g.get("id", ""),
-                g.get("fecha", ""),
-                g.get("bolivares", 0),
-                g.get("dolares", 0),
-                g.get("tipo_cambio", 0),
-                g.get("categoria", "otros"),
-                g.get("descripcion", "")
-            ])
-    
-    return filepath
+    with storage_lock:
+        presupuestos_categorias = load_presupuestos_categorias()
+        mes = presupuestos_categorias.setdefault(str(user_id), {}).setdefault(
+            estado["month_key"], {"limites": {}, "alertas": {}}
+        )
+        mes["alertas"] = {clave: list(umbrales) for clave, umbrales in estado["disparadas"].items() if umbrales}
+        save_presupuestos_categorias(presupuestos_categorias)
+    
+    # Primero el presupuesto general y luego las categorías
+    return [
+        format_alerta_presupuesto(clave, umbral, totales[clave], estado["limites"][clave])
+        for clave, umbral in sorted(nuevas.items(), key=lambda x: (x[0] != "total", x[0]))
+    ]
+
+def format_alerta_presupuesto(clave, umbral, gastado, limite):
+    """Texto de una alerta de presupuesto ("total" es el presupuesto del mes)"""
+    nombre = "del mes" if clave == "total" else f"de {clave}"
+    porcentaje = gastado / limite * 100
+    if umbral >= 100:
+        return f"PRESUPUESTO {nombre.upper()} EXCEDIDO: ${gastado:,.2f} de ${limite:,.2f} USD ({porcentaje:.1f}%)"
+    return f"Alerta: llevas el {porcentaje:.1f}% del presupuesto {nombre} (${gastado:,.2f} de ${limite:,.2f} USD)"
+
+def _en_rango(valor, minimo, maximo):
+    """Indica si un valor está dentro de un rango (los límites None no se aplican)"""
+    return (minimo is None or valor >= minimo) and (maximo is None or valor <= maximo)
+
+def _filas_export(user_id, tipo, inicio=None, fin=None, categoria=None, min_bs=None, max_bs=None):
+    """Filas a exportar de un tipo de registro, filtradas y en orden cronológico
+
+    Devuelve (estimado, filas): estimado es el número de registros dentro del
+    período (antes de filtrar por categoría y monto) y filas un generador, para
+    no armar la lista completa en memoria.
+    """
+    desde = inicio.strftime("%Y-%m-%d") if inicio else None
+    hasta = fin.strftime("%Y-%m-%d") if fin else None
+    
+    if tipo == "gastos":
+        indice = get_gastos_index(user_id)
+        claves = indice["claves"]
+        a = bisect.bisect_left(claves, (desde,)) if desde else 0
+        b = bisect.bisect_left(claves, ((fin + timedelta(days=1)).strftime("%Y-%m-%d"),)) if fin else len(claves)
+        
+        def filas():
+            for i in range(a, b):
+                g = indice["gastos"][claves[i]]
+                if categoria and g.get("categoria", "otros") != categoria:
+                    continue
+                if not _en_rango(g.get("bolivares", 0), min_bs, max_bs):
+                    continue
+                yield [
+                    g.get("id", ""),
+                    g.get("fecha", ""),
+                    g.get("bolivares", 0),
+                    g.get("dolares", 0),
+                    g.get("tipo_cambio", 0),
+                    g.get("categoria", "otros"),
+                    g.get("descripcion", "")
+                ]
+        return b - a, filas()
+    
+    if tipo == "intercambios":
+        meses = load_intercambios().get(str(user_id), {})
+        registros = [
+            i for mk in sorted(meses) for i in meses[mk]
+            if _en_rango(i.get("fecha", "")[:10], desde, hasta)
+        ]
+        filas = (
+            [i.get("id", ""), i.get("fecha", ""), i.get("bolivares", 0), i.get("usdt", 0),
+             i.get("tasa_paralela", 0), i.get("descripcion", "")]
+            for i in registros if _en_rango(i.get("bolivares", 0), min_bs, max_bs)
+        )
+        return len(registros), filas
+    
+    # Ingresos: uno por mes
+    meses = load_ingresos().get(str(user_id), {})
+    claves = [
+        mk for mk in sorted(meses)
+        if _en_rango(mk, desde[:7] if desde else None, hasta[:7] if hasta else None)
+    ]
+    filas = (
+        [mk, meses[mk].get("bolivares", 0), meses[mk].get("usdt", 0),
+         meses[mk].get("tasa_paralela", 0), meses[mk].get("fecha_registro", "")]
+        for mk in claves if _en_rango(meses[mk].get("bolivares", 0), min_bs, max_bs)
+    )
+    return len(claves), filas
+
+def export_csv(user_id, tipo="gastos", inicio=None, fin=None, categoria=None,
+               min_bs=None, max_bs=None, comprimir=None):
+    """Exporta un tipo de registro del usuario a CSV sin pasar por un archivo junto a bot.py
+
+    Las filas se escriben por bloques en un SpooledTemporaryFile: queda en memoria
+    mientras es pequeño y pasa a un archivo temporal si crece, así la memoria no
+    depende del tamaño del historial. Si comprimir es None, se usa gzip cuando el
+    período tiene más de EXPORT_GZIP_ROWS registros.
+    
+    Returns:
+        (archivo, nombre, filas) con el archivo posicionado al inicio (quien lo
+        recibe debe cerrarlo), o None si no hay filas.
+    """
+    estimado, filas = _filas_export(user_id, tipo, inicio, fin, categoria, min_bs, max_bs)
+    if comprimir is None:
+        comprimir = estimado > EXPORT_GZIP_ROWS
+    
+    nombre = f"{tipo}_{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    archivo = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX)
+    destino = gzip.GzipFile(filename=nombre, mode="wb", fileobj=archivo) if comprimir else archivo
+    
+    bloque = io.StringIO()
+    writer = csv.writer(bloque)
+    writer.writerow(EXPORT_COLUMNAS[tipo])
+    total = 0
+    for fila in filas:
+        writer.writerow(fila)
+        total += 1
+        if total % EXPORT_BLOQUE == 0:
+            destino.write(bloque.getvalue().encode("utf-8"))
+            bloque.seek(0)
+            bloque.truncate()
+    destino.write(bloque.getvalue().encode("utf-8"))
+    if comprimir:
+        destino.close()
+    
+    if total == 0:
+        archivo.close()
+        return None
+    archivo.seek(0)
+    return archivo, nombre + (".gz" if comprimir else ""), total
+
+def _normalizar_columna(nombre):
+    """Nombre de columna en minúsculas, sin acentos ni espacios extra"""
+    return " ".join(plegar_texto(nombre).replace("_", " ").split())
+
+def _mapear_columnas(encabezado):
+    """Índice de cada campo conocido en el encabezado ({campo: posición})"""
+    nombres = [_normalizar_columna(c) for c in encabezado]
+    columnas = {}
+    for campo, alias in IMPORT_COLUMNAS.items():
+        for i, nombre in enumerate(nombres):
+            if nombre in alias:
+                columnas[campo] = i
+                break
+    return columnas
+
+def _leer_filas_csv(archivo):
+    """Filas de un CSV (coma o punto y coma) leídas de a una desde un archivo binario"""
+    texto = io.TextIOWrapper(archivo, encoding="utf-8-sig", errors="replace", newline="")
+    muestra = texto.read(4096)
+    texto.seek(0)
+    try:
+        dialecto = csv.Sniffer().sniff(muestra, delimiters=",;\t")
+    except csv.Error:
+        dialecto = csv.excel
+    try:
+        yield from csv.reader(texto, dialecto)
+    finally:
+        # Soltar el archivo sin cerrarlo: lo cierra quien lo abrió
+        texto.detach()
+
+def _leer_filas_xlsx(archivo):
+    """Filas de la primera hoja de un XLSX en modo de solo lectura (sin cargar el libro completo)"""
+    libro = openpyxl.load_workbook(archivo, read_only=True, data_only=True)
+    try:
+        for fila in libro.worksheets[0].iter_rows(values_only=True):
+            yield fila
+    finally:
+        libro.close()
+
+def _parse_fecha_import(valor, formatos):
+    """Fecha de una celda importada (datetime de XLSX o texto en los formatos comunes)
+
+    formatos es la lista de formatos a probar; el que funciona pasa al frente,
+    porque un archivo suele usar el mismo formato en todas sus filas.
+    """
+    if isinstance(valor, datetime):
+        return valor
+    texto = str(valor or "").strip()
+    for i, formato in enumerate(formatos):
+        try:
+            fecha = datetime.strptime(texto, formato)
+        except ValueError:
+            continue
+        if i:
+            formatos.insert(0, formatos.pop(i))
+        return fecha
+    return None
+
+def _parse_monto_import(valor):
+    """Monto de una celda importada (número de XLSX o texto)
+
+    Con coma se interpreta como en los mensajes ("1.200,75"); sin coma el punto es
+    decimal, como lo escribe /exportar (una tasa "36.125" no se lee como miles).
+    """
+    if isinstance(valor, (int, float)):
+        return float(valor)
+    texto = str(valor or "").strip().replace(" ", "")
+    if not texto:
+        return None
+    try:
+        return parse_monto(texto) if "," in texto else float(texto)
+    except ValueError:
+        return None
+
+def _tasa_historica(fechas_tasas, tasas, date_key):
+    """Tasa oficial de un día de tasas.json, o la del día guardado más cercano anterior"""
+    i = bisect.bisect_right(fechas_tasas, date_key)
+    return tasas[fechas_tasas[i - 1]]["oficial"] if i else None
+
+def import_gastos(user_id, archivo, formato):
+    """Importa gastos desde un CSV o XLSX, leyendo fila por fila
+
+    Cada fila se valora con la tasa oficial de su fecha en tasas.json (o la del
+    día guardado más cercano anterior) sin consultar la API, salvo que traiga su
+    propia tasa. Los gastos válidos se registran juntos con add_gastos_batch, en
+    una sola escritura atómica: reescribir gastos.json por cada lote domina el
+    tiempo de una importación grande. Las filas con un ID y fecha ya registrados se
+    rechazan, así reimportar un CSV de /exportar no duplica gastos; si el ID ya
+    existe con otra fecha, el gasto se importa con un ID nuevo.
+    
+    Returns:
+        dict con "aceptadas", "rechazadas", "motivos" ({motivo: cantidad}),
+        "ejemplos" (primeros rechazos con su fila), "total_bs", "total_usd",
+        "desde", "hasta", "ids_nuevos" y "alertas" (alertas de presupuesto disparadas)
+    """
+    resumen = {
+        "aceptadas": 0, "rechazadas": 0, "motivos": {}, "ejemplos": [],
+        "total_bs": 0, "total_usd": 0, "desde": None, "hasta": None,
+        "ids_nuevos": 0, "alertas": [],
+    }
+    
+    def rechazar(numero, motivo):
+        resumen["rechazadas"] += 1
+        resumen["motivos"][motivo] = resumen["motivos"].get(motivo, 0) + 1
+        if len(resumen["ejemplos"]) < 5:
+            resumen["ejemplos"].append(f"fila {numero}: {motivo}")
+    
+    tasas = load_tasas()
+    fechas_tasas = sorted(k for k, dia in tasas.items() if dia.get("oficial"))
+    claves_existentes = set(get_gastos_index(user_id)["claves"])
+    ids_existentes = {gasto_id for _, gasto_id in claves_existentes}
+    ahora = datetime.now()
+    
+    filas = _leer_filas_xlsx(archivo) if formato == "xlsx" else _leer_filas_csv(archivo)
+    encabezado = next(filas, None)
+    columnas = _mapear_columnas(encabezado or [])
+    if "fecha" not in columnas or ("bolivares" not in columnas and "dolares" not in columnas):
+        raise ValueError("El archivo debe tener una columna de fecha y una de monto (Bolivares o Dolares)")
+    
+    def celda(fila, campo):
+        i = columnas.get(campo)
+        return fila[i] if i is not None and i < len(fila) else None
+    
+    formatos = list(IMPORT_FORMATOS_FECHA)
+    lote = []
+    for numero, fila in enumerate(filas, start=2):
+        if not fila or all(c in (None, "") for c in fila):
+            continue
+        
+        fecha = _parse_fecha_import(celda(fila, "fecha"), formatos)
+        if fecha is None:
+            rechazar(numero, "fecha invalida")
+            continue
+        if fecha > ahora:
+            rechazar(numero, "fecha futura")
+            continue
+        
+        gasto_id = str(celda(fila, "id") or "").strip()
+        clave = (fecha.strftime("%Y-%m-%d %H:%M:%S"), gasto_id)
+        if gasto_id and clave in claves_existentes:
+            rechazar(numero, "ya registrado (mismo ID y fecha)")
+            continue
+        
+        tasa = _parse_monto_import(celda(fila, "tasa"))
+        if not tasa or tasa <= 0:
+            tasa = _tasa_historica(fechas_tasas, tasas, fecha.strftime("%Y-%m-%d"))
+        if not tasa:
+            rechazar(numero, "sin tasa para la fecha")
+            continue
+        
+        amount_bs = _parse_monto_import(celda(fila, "bolivares"))
+        if amount_bs is None:
+            amount_usd = _parse_monto_import(celda(fila, "dolares"))
+            amount_bs = amount_usd * tasa if amount_usd is not None else None
+        if amount_bs is None or amount_bs <= 0:
+            rechazar(numero, "monto invalido")
+            continue
+        
+        categoria = _normalizar_columna(celda(fila, "categoria"))
+        if gasto_id in ids_existentes:
+            # El ID ya es de otro gasto: dos gastos con el mismo ID no se podrían borrar ni editar.
+            # La clave original queda registrada para rechazar la misma fila repetida en el archivo
+            claves_existentes.add(clave)
+            while gasto_id in ids_existentes:
+                gasto_id = str(uuid.uuid4())[:8]
+            clave = (clave[0], gasto_id)
+            resumen["ids_nuevos"] += 1
+        if gasto_id:
+            claves_existentes.add(clave)
+            ids_existentes.add(gasto_id)
+        lote.append({
+            "id": gasto_id or None,
+            "amount": amount_bs,
+            "tasa": tasa,
+            "fecha": fecha,
+            "categoria": categoria if categoria in CATEGORIAS else "otros",
+            "descripcion": str(celda(fila, "descripcion") or "").strip(),
+        })
+        fecha_str = fecha.strftime("%Y-%m-%d")
+        resumen["desde"] = min(resumen["desde"] or fecha_str, fecha_str)
+        resumen["hasta"] = max(resumen["hasta"] or fecha_str, fecha_str)
+    
+    if lote:
+        registrados, _, resumen["alertas"] = add_gastos_batch(user_id, lote)
+        resumen["aceptadas"] = len(registrados)
+        resumen["total_bs"] = sum(g["bolivares"] for g in registrados)
+        resumen["total_usd"] = sum(g["amount_usd"] for g in registrados)
+    return resumen
+
+def format_import_resumen(resumen, nombre):
+    """Texto del resultado de una importación"""
+    message = (
+        f"Importacion de {nombre}\n\n"
+        f"Filas aceptadas: {resumen['aceptadas']}\n"
+        f"Filas rechazadas: {resumen['rechazadas']}\n"
+    )
+    if resumen["aceptadas"]:
+        message += (
+            f"Total importado: {resumen['total_bs']:,.2f} Bs (${resumen['total_usd']:,.2f} USD)\n"
+            f"Fechas: {resumen['desde']} a {resumen['hasta']}\n"
+        )
+    if resumen["ids_nuevos"]:
+        message += f"Con ID nuevo (el ID ya existia con otra fecha): {resumen['ids_nuevos']}\n"
+    if resumen["motivos"]:
+        message += "\nMotivos de rechazo:\n"
+        for motivo, cantidad in sorted(resumen["motivos"].items(), key=lambda x: -x[1]):
+            message += f"{motivo}: {cantidad}\n"
+        message += "\n" + "\n".join(resumen["ejemplos"]) + "\n"
+    if resumen["alertas"]:
+        message += "\n" + "\n".join(resumen["alertas"])
+    return message
+
+def get_last_month_keys(n, month_key=None):
+    """Obtiene las claves de los últimos n meses, del más reciente al más antiguo"""
+    if month_key is None:
+        month_key = get_current_month_key()
+    year, month = int(month_key[:4]), int(month_key[5:7])
+    keys = []
+    for _ in range(max(n, 1)):
+        keys.append(f"{year:04d}-{month:02d}")
+        month -= 1
+        if month == 0:
+            month = 12
+            year -= 1
+    return keys
+
+def bump_ledger_version(user_id):
+    """Incrementa la versión del registro del usuario (gastos, ingresos o intercambios)"""
+    ledger_versions[str(user_id)] = ledger_versions.get(str(user_id), 0) + 1
+    return ledger_versions[str(user_id)]
+
+def get_ledger_version(user_id):
+    """Obtiene la versión actual del registro del usuario"""
+    return ledger_versions.get(str(user_id), 0)
+
+def estimate_tokens(text):
+    """Estimación aproximada de tokens (~4 caracteres por token)"""
+    return len(text) // 4 + 1
+
+def _add_gasto_to_totals(totals, gasto):
+    """Suma un gasto a los totales de un mes (total y por categoría)"""
+    totals["bs"] += gasto["bolivares"]
+    totals["usd"] += gasto["dolares"]
+    totals["count"] += 1
+    cat = gasto.get("categoria", "otros")
+    if cat not in totals["categorias"]:
+        totals["categorias"][cat] = {"bs": 0, "usd": 0}
+    totals["categorias"][cat]["bs"] += gasto["bolivares"]
+    totals["categorias"][cat]["usd"] += gasto["dolares"]
+
+def build_ai_context_snapshot(user_id):
+    """Construye desde cero el snapshot del contexto financiero del usuario para la IA
+
+    Lee cada archivo una sola vez y guarda los totales por categoría de los
+    últimos AI_CONTEXT_MONTHS meses, el ingreso, los intercambios y los últimos gastos.
+    """
+    month_key = get_current_month_key()
+    user_gastos = load_gastos().get(str(user_id), {})
+    intercambios = load_intercambios().get(str(user_id), {}).get(month_key, [])
+    ingreso = load_ingresos().get(str(user_id), {}).get(month_key)
+
+    meses = {}
+    for mk in get_last_month_keys(AI_CONTEXT_MONTHS, month_key):
+        totals = {"bs": 0, "usd": 0, "count": 0, "categorias": {}}
+        for g in user_gastos.get(mk, []):
+            _add_gasto_to_totals(totals, g)
+        meses[mk] = totals
+
+    snapshot = {
+        "month_key": month_key,
+        "meses": meses,
+        "ingreso": ingreso,
+        "intercambios": {
+            "bs": sum(i["bolivares"] for i in intercambios),
+            "usdt": sum(i["usdt"] for i in intercambios),
+            "count": len(intercambios),
+            "ultimos": intercambios[-5:],
+        },
+        "ultimos_gastos": user_gastos.get(month_key, [])[-5:],
+        "texto": None,
+        "texto_tasa": None,
+    }
+    ai_context_snapshots[str(user_id)] = snapshot
+    return snapshot
+
+def get_ai_context_snapshot(user_id):
+    """Obtiene el snapshot del usuario, reconstruyéndolo solo si no existe o cambió el mes"""
+    snapshot = ai_context_snapshots.get(str(user_id))
+    if snapshot is None or snapshot["month_key"] != get_current_month_key():
+        snapshot = build_ai_context_snapshot(user_id)
+    return snapshot
+
+def invalidate_ai_context(user_id):
+    """Descarta el snapshot del usuario (se reconstruye en la próxima consulta)"""
+    ai_context_snapshots.pop(str(user_id), None)
+
+def update_ai_context_gasto(user_id, gasto, month_key):
+    """Actualiza incrementalmente el snapshot con un gasto nuevo"""
+    snapshot = ai_context_snapshots.get(str(user_id))
+    if snapshot is None:
+        return
+    if month_key in snapshot["meses"]:
+        _add_gasto_to_totals(snapshot["meses"][month_key], gasto)
+    if month_key == snapshot["month_key"]:
+        snapshot["ultimos_gastos"] = (snapshot["ultimos_gastos"] + [gasto])[-5:]
+    snapshot["texto"] = None
+
+def update_ai_context_intercambio(user_id, intercambio, month_key):
+    """Actualiza incrementalmente el snapshot con un intercambio nuevo"""
+    snapshot = ai_context_snapshots.get(str(user_id))
+    if snapshot is None or month_key != snapshot["month_key"]:
+        return
+    resumen_intercambios = snapshot["intercambios"]
+    resumen_intercambios["bs"] += intercambio["bolivares"]
+    resumen_intercambios["usdt"] += intercambio["usdt"]
+    resumen_intercambios["count"] += 1
+    resumen_intercambios["ultimos"] = (resumen_intercambios["ultimos"] + [intercambio])[-5:]
+    snapshot["texto"] = None
+
+def update_ai_context_ingreso(user_id, ingreso, month_key):
+    """Actualiza el ingreso mensual en el snapshot"""
+    snapshot = ai_context_snapshots.get(str(user_id))
+    if snapshot is None or month_key != snapshot["month_key"]:
+        return
+    snapshot["ingreso"] = ingreso
+    snapshot["texto"] = None
+
+def render_ai_context(snapshot, current_rate=None):
+    """Genera el texto de contexto para la IA sin superar AI_CONTEXT_MAX_TOKENS
+
+    El resumen del mes actual siempre se incluye; el resto de secciones
+    (categorías, últimos movimientos e historial) se agregan en orden de
+    prioridad mientras quepan en el presupuesto de tokens.
+    """
+    if snapshot["texto"] is not None and snapshot["texto_tasa"] == current_rate:
+        return snapshot["texto"]
+
+    actual = snapshot["meses"][snapshot["month_key"]]
+    ingreso = snapshot["ingreso"]
+    intercambios = snapshot["intercambios"]
+
+    texto = "\n\nINFORMACIÓN FINANCIERA DEL USUARIO (mes actual):\n"
+    if ingreso:
+        texto += f"- Ingreso mensual: {ingreso['bolivares']:,.2f} Bs (${ingreso['usdt']:,.4f} USDT)\n"
+    if actual["count"] > 0:
+        texto += f"- Total gastado: {actual['bs']:,.2f} Bs (${actual['usd']:,.2f} USD)\n"
+        texto += f"- Número de gastos: {actual['count']}\n"
+    if intercambios["count"] > 0:
+        texto += f"- Intercambios (Bs->USDT): {intercambios['bs']:,.2f} Bs -> {intercambios['usdt']:,.4f} USDT\n"
+        texto += f"- Número de intercambios: {intercambios['count']}\n"
+    if ingreso:
+        saldo_bs = ingreso["bolivares"] - actual["bs"] - intercambios["bs"]
+        saldo_usdt = ingreso["usdt"] - actual["usd"] - intercambios["usdt"]
+        texto += f"- Saldo disponible: {saldo_bs:,.2f} Bs (${saldo_usdt:,.2f} USD equivalente)\n"
+    if current_rate:
+        texto += f"- Tipo de cambio oficial actual: {current_rate:,.2f} Bs/$\n"
+
+    secciones = []
+    if actual["categorias"]:
+        seccion = "\nGastos por categoría (mes actual):\n"
+        for cat, amounts in sorted(actual["categorias"].items(), key=lambda x: x[1]["usd"], reverse=True):
+            seccion += f"- {cat}: {amounts['bs']:,.2f} Bs (${amounts['usd']:,.2f} USD)\n"
+        secciones.append(seccion)
+    if snapshot["ultimos_gastos"]:
+        seccion = "\nÚltimos gastos:\n"
+        for i, gasto in enumerate(snapshot["ultimos_gastos"], 1):
+            seccion += f"{i}. {gasto['fecha']}: {gasto['bolivares']:,.2f} Bs (${gasto['dolares']:,.2f} USD)\n"
+        secciones.append(seccion)
+    if intercambios["ultimos"]:
+        seccion = "\nÚltimos intercambios:\n"
+        for i, intercambio in enumerate(intercambios["ultimos"], 1):
+            seccion += f"{i}. {intercambio['fecha']}: {intercambio['bolivares']:,.2f} Bs -> {intercambio['usdt']:,.4f} USDT (tasa: {intercambio['tasa_paralela']:,.2f})\n"
+        secciones.append(seccion)
+
+    historial = [mk for mk in snapshot["meses"] if mk != snapshot["month_key"]]
+    if historial:
+        lineas = []
+        for mk in historial:
+            totals = snapshot["meses"][mk]
+            if totals["count"] == 0:
+                lineas.append(f"- {mk}: sin gastos\n")
+                continue
+            categorias = ", ".join(
+                f"{cat}: ${amounts['usd']:,.2f}"
+                for cat, amounts in sorted(totals["categorias"].items(), key=lambda x: x[1]["usd"], reverse=True)
+            )
+            lineas.append(f"- {mk}: {totals['bs']:,.2f} Bs (${totals['usd']:,.2f} USD) - {categorias}\n")
+        # El encabezado va con el primer mes: si ese mes no cabe, no se envía una sección vacía
+        lineas[0] = "\nHistorial de meses anteriores:\n" + lineas[0]
+        secciones.extend(lineas)
+
+    for seccion in secciones:
+        if estimate_tokens(texto + seccion) > AI_CONTEXT_MAX_TOKENS:
+            break
+        texto += seccion
+
+    snapshot["texto"] = texto
+    snapshot["texto_tasa"] = current_rate
+    return texto
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Comando /start - Mensaje de bienvenida"""
@@ -695,37 +2852,44 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "Bot de Control de Gastos con IA\n\n"
         "Comandos principales:\n"
         "/gasto <cantidad> [categoria] [descripcion] - Registra un gasto\n"
-        "/resumen - Resumen del mes\n"
-        "/listar [n] - Lista ultimos gastos\n"
-        "/estadisticas - Estadisticas avanzadas\n"
+        "/resumen - Resumen del mes y proyeccion a fin de mes\n"
+        "/listar [n] - Lista tus gastos (n por pagina)\n"
+        "/estadisticas [periodo] - Estadisticas (mes, trimestre, año o ultimos N dias)\n"
         "/dolar - Tipo de cambio actual\n"
-        "/presupuesto [monto] - Ver o establecer presupuesto\n"
-        "/comparar - Comparar con mes anterior\n"
-        "/buscar <fecha|rango> - Buscar gastos\n"
+        "/presupuesto [categoria] [monto] - Ver o establecer presupuestos (con proyeccion)\n"
+        "/comparar [N | mes1 mes2] - Comparar meses (por categoria y en Bs/USD)\n"
+        "/buscar <texto|fecha|rango> - Buscar gastos\n"
         "/gastos_hoy - Gastos del dia actual\n"
-        "/exportar - Exportar a CSV\n"
+        "/exportar [tipo] [categoria] [min-max] [periodo] - Exportar a CSV\n"
+        "/importar - Importar gastos desde CSV o XLSX\n"
+        "/grafico [diario|categorias|tasas] [periodo] - Graficos\n"
         "/eliminar <id> - Eliminar gasto\n"
-        "/editar <id> <monto> - Editar gasto\n\n"
+        "/editar <id> <monto> - Editar gasto\n"
+        "/sinonimo <palabra> <categoria> - Asociar una palabra a una categoria\n\n"
         "Sistema de Ingresos:\n"
         "/ingreso <cantidad_bs> [tasa] - Registrar ingreso mensual\n\n"
         "Intercambios (Binance/USDT):\n"
         "/binance_rate - Tasa paralela (Binance)\n"
-        "/cambiar <bs> [tasa] - Intercambiar Bs a USDT\n\n"
+        "/cambiar <bs> [tasa] - Intercambiar Bs a USDT\n"
+        "/posicion - USDT acumulado, costo medio y ganancia\n"
+        "/vender <usdt> [tasa] - Registrar venta de USDT a Bs\n\n"
         "/dolar [actualizar] - Tipo de cambio oficial (usa 'actualizar' para forzar actualización)\n"
-        "/ai <pregunta> - Pregunta a la IA\n\n"
+        "/ai <pregunta> - Pregunta a la IA\n"
+        "/modelos - Latencia de los modelos de IA\n"
+        "/metricas - Estado de la cola de procesamiento\n\n"
         f"IA: {ai_status}\n\n"
         "💡 Sistema de Tasas Históricas:\n"
         "El bot guarda automáticamente las tasas diarias. Para gastos de días anteriores, usa la tasa de ese día.\n"
         "Ejemplo: 'compré algo que me costó 2000 bs el día de ayer'\n\n"
         "Categorias disponibles: comida, transporte, servicios, entretenimiento, salud, educacion, ropa, tecnologia, hogar, otros"
     )
-    await update.message.reply_text(welcome_message)
+    await reply(update, welcome_message)
 
 async def gasto(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Comando /gasto - Registra un gasto (puede incluir fecha)"""
-    import re
     if not context.args:
-        await update.message.reply_text(
+        await reply(
+            update,
             "Por favor, indica la cantidad en bolivares.\n"
             "Ejemplo: /gasto 22000\n"
             "Ejemplo con categoria: /gasto 22000 comida\n"
@@ -739,27 +2903,22 @@ async def gasto(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         amount_bs = float(context.args[0].replace(',', '.'))
         
         if amount_bs <= 0:
-            await update.message.reply_text("La cantidad debe ser mayor a 0")
+            await reply(update, "La cantidad debe ser mayor a 0")
             return
         
         categoria = "otros"
         descripcion = ""
-        fecha_gasto = None
         
-        # Detectar fecha en los argumentos
-        args_text = " ".join(context.args).lower()
-        fecha_detectada = detect_fecha_in_text(" ".join(context.args))
-        if fecha_detectada:
-            fecha_gasto = fecha_detectada
+        # Detectar fecha en los argumentos (misma gramática que los mensajes de texto)
+        args_text = " ".join(context.args[1:])
+        fecha_info = parse_fecha_expresion(args_text)
+        fecha_gasto = fecha_info["fecha"]
         
         # Procesar argumentos restantes
         args_processed = context.args[1:]
         if fecha_gasto:
-            # Remover indicadores de fecha de los argumentos
-            args_processed = [arg for arg in args_processed 
-                            if arg.lower() not in ["ayer", "hoy", "anteayer"] 
-                            and not re.match(r'\d{4}-\d{2}-\d{2}', arg)
-                            and not re.match(r'\d{1,2}[/-]\d{1,2}', arg)]
+            # Remover las expresiones de fecha de los argumentos
+            args_processed = remove_spans(args_text, fecha_info["spans"]).split()
         
         if len(args_processed) > 0:
             if args_processed[0].lower() in CATEGORIAS:
@@ -774,14 +2933,20 @@ async def gasto(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             fecha_gasto = datetime.now()
         
         # Obtener la tasa para la fecha del gasto
-        dollar_rate = get_tasa_for_date(fecha_gasto, tipo="oficial")
+        dollar_rate = await run_io(get_tasa_for_date, fecha_gasto, tipo="oficial")
         if dollar_rate is None or dollar_rate == 0:
-            await update.message.reply_text(
+            await reply(
+                update,
                 "Error al obtener el tipo de cambio. Intenta mas tarde."
             )
             return
         
-        amount_usd, gasto_id = add_gasto(
+        # El rango se calcula antes de registrar el gasto, contra los gastos anteriores sin él
+        inusual = await run_io(
+            get_gasto_inusual, update.effective_user.id, categoria, round(amount_bs / dollar_rate, 2)
+        )
+        amount_usd, gasto_id, alertas = await run_io(
+            add_gasto,
             update.effective_user.id, 
             amount_bs, 
             dollar_rate, 
@@ -804,56 +2969,162 @@ async def gasto(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             f"Categoria: {categoria}\n"
         )
         if descripcion:
-            message += f"Descripcion: {descripcion}"
+            message += f"Descripcion: {descripcion}\n"
+        if inusual:
+            message += "\n" + inusual + "\n"
+        if alertas:
+            message += "\n" + "\n".join(alertas)
         
-        await update.message.reply_text(message)
+        await reply(update, message)
         
     except ValueError as e:
-        await update.message.reply_text(
+        await reply(
+            update,
             f"Por favor, ingresa un numero valido.\n"
             f"Ejemplo: /gasto 22000\n"
             f"Error: {str(e)}"
         )
 
+def format_gasto_item(g):
+    """Texto de un gasto en los listados paginados"""
+    message = (
+        f"ID: {g.get('id', 'N/A')}\n"
+        f"Fecha: {g['fecha']}\n"
+        f"Monto: {g['bolivares']:,.2f} Bs (${g['dolares']:,.2f} USD)\n"
+        f"Categoria: {g.get('categoria', 'otros')}\n"
+    )
+    if g.get("descripcion"):
+        descripcion = g["descripcion"]
+        if len(descripcion) > DESCRIPCION_MAX_LISTADO:
+            descripcion = descripcion[:DESCRIPCION_MAX_LISTADO] + "..."
+        message += f"Descripcion: {descripcion}\n"
+    return message + "\n"
+
+def es_numero(texto):
+    """Indica si un argumento es un monto ("1000", "1000,50" o "1000.50")"""
+    return re.fullmatch(r"\d+(?:[.,]\d+)?", texto) is not None
+
+def parse_filtro(filtro):
+    """Convierte el filtro de callback_data en argumentos de get_gastos_page
+
+    "t" = todo el historial, "d20251118" = un día, "r1000-50000" = rango de montos,
+    "q<clave>" = búsqueda de texto guardada en busquedas_guardadas; su copia
+    incluye el texto buscado en "consulta", que se quita antes de get_gastos_page.
+    """
+    if filtro.startswith("q"):
+        busqueda = busquedas_guardadas.get(filtro[1:])
+        if busqueda is None:
+            raise ValueError("Busqueda expirada")
+        return dict(busqueda)
+    if filtro.startswith("d"):
+        return {"fecha": datetime.strptime(filtro[1:], "%Y%m%d").strftime("%Y-%m-%d")}
+    if filtro.startswith("r"):
+        min_amount, max_amount = filtro[1:].split("-")
+        return {"min_amount": float(min_amount), "max_amount": float(max_amount)}
+    return {}
+
+def build_gastos_page(user_id, filtro="t", tamano=PAGE_SIZE, cursor=None, direccion="siguiente"):
+    """Arma el texto y los botones de una página de gastos
+
+    Los botones llevan el filtro, el tamaño de página y el cursor en callback_data
+    ("pag|<filtro>|<tamaño>|<a|s>|<cursor>"), que Telegram limita a 64 bytes.
+    Devuelve (texto, teclado) o (None, None) si no hay gastos.
+    """
+    # Una sola lectura de la búsqueda guardada: guardar_busqueda puede descartarla mientras tanto
+    filtros = parse_filtro(filtro)
+    consulta = filtros.pop("consulta", None)
+    gastos, hay_anteriores, hay_siguientes = get_gastos_page(
+        user_id, cursor, direccion, limite=tamano, **filtros
+    )
+    if not gastos:
+        return None, None
+    
+    if filtro.startswith("q"):
+        message = f"Gastos que coinciden con \"{consulta}\":\n\n"
+    elif filtro.startswith("d"):
+        message = f"Gastos del {filtros['fecha']}:\n\n"
+    elif filtro.startswith("r"):
+        message = f"Gastos entre {filtros['min_amount']:,.2f} y {filtros['max_amount']:,.2f} Bs:\n\n"
+    else:
+        message = "Tus gastos (del mas reciente al mas antiguo):\n\n"
+    
+    # Telegram rechaza mensajes de más de MESSAGE_MAX_CHARS: se muestran los gastos
+    # que caben, empezando por el lado del cursor, y el resto queda para la página siguiente
+    items = [format_gasto_item(g) for g in gastos]
+    disponible = MESSAGE_MAX_CHARS - len(message)
+    mostrados = 0
+    for item in (items if direccion == "siguiente" else reversed(items)):
+        if len(item) > disponible:
+            break
+        disponible -= len(item)
+        mostrados += 1
+    if mostrados < len(gastos):
+        if direccion == "siguiente":
+            gastos, items, hay_siguientes = gastos[:mostrados], items[:mostrados], True
+        else:
+            gastos, items, hay_anteriores = gastos[-mostrados:], items[-mostrados:], True
+    message += "".join(items)
+    
+    # Un cursor con un ID importado muy largo no cabe en callback_data: ese botón se omite
+    botones = []
+    anteriores = f"pag|{filtro}|{tamano}|a|{encode_cursor(gastos[0])}"
+    if hay_anteriores and len(anteriores.encode()) <= CALLBACK_DATA_MAX:
+        botones.append(InlineKeyboardButton("« Anteriores", callback_data=anteriores))
+    siguientes = f"pag|{filtro}|{tamano}|s|{encode_cursor(gastos[-1])}"
+    if hay_siguientes and len(siguientes.encode()) <= CALLBACK_DATA_MAX:
+        botones.append(InlineKeyboardButton("Siguientes »", callback_data=siguientes))
+    teclado = InlineKeyboardMarkup([botones]) if botones else None
+    return message, teclado
+
 async def listar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Comando /listar - Lista los ultimos gastos"""
-    n = 10
+    """Comando /listar - Lista los gastos de todo el historial, paginados"""
+    n = PAGE_SIZE
     if context.args:
         try:
             n = int(context.args[0])
-            if n < 1 or n > 50:
-                n = 10
+            if n < 1 or n > PAGE_SIZE_MAX:
+                n = PAGE_SIZE
         except:
             pass
     
-    total_bs, total_usd, gastos = get_month_summary(update.effective_user.id)
+    message, teclado = await run_io(build_gastos_page, update.effective_user.id, "t", n)
     
-    if not gastos:
-        await update.message.reply_text("No hay gastos registrados este mes.")
+    if not message:
+        await reply(update, "No hay gastos registrados.")
         return
     
-    gastos_recientes = gastos[-n:]
-    message = f"Ultimos {len(gastos_recientes)} gastos:\n\n"
-    
-    for g in reversed(gastos_recientes):
-        fecha = g["fecha"].split()[0]
-        hora = g["fecha"].split()[1] if len(g["fecha"].split()) > 1 else ""
-        message += (
-            f"ID: {g.get('id', 'N/A')}\n"
-            f"Fecha: {fecha} {hora}\n"
-            f"Monto: {g['bolivares']:,.2f} Bs (${g['dolares']:,.2f} USD)\n"
-            f"Categoria: {g.get('categoria', 'otros')}\n"
+    await reply(update, message, reply_markup=teclado)
+
+async def paginar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Botones de /listar y /buscar - Muestra la página anterior o siguiente"""
+    query = update.callback_query
+    chat_id = update.effective_chat.id if update.effective_chat else None
+    await query.answer()
+    try:
+        _, filtro, tamano, direccion, cursor = query.data.split("|")
+        message, teclado = await run_io(
+            build_gastos_page,
+            update.effective_user.id,
+            filtro,
+            int(tamano),
+            decode_cursor(cursor),
+            "anterior" if direccion == "a" else "siguiente"
         )
-        if g.get("descripcion"):
-            message += f"Descripcion: {g['descripcion']}\n"
-        message += "\n"
+    except ValueError:
+        await enqueue_message(chat_id, lambda: query.edit_message_text("Pagina invalida. Usa /listar o /buscar de nuevo."))
+        return
+    
+    if not message:
+        await enqueue_message(chat_id, lambda: query.edit_message_text("No hay mas gastos en esa direccion."))
+        return
     
-    await update.message.reply_text(message)
+    await enqueue_message(chat_id, lambda: query.edit_message_text(message, reply_markup=teclado))
 
 async def eliminar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Comando /eliminar - Elimina un gasto"""
     if not context.args:
-        await update.message.reply_text(
+        await reply(
+            update,
             "Por favor, indica el ID del gasto a eliminar.\n"
             "Ejemplo: /eliminar abc12345\n"
             "Usa /listar para ver los IDs de tus gastos."
@@ -861,25 +3132,27 @@ async def eliminar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     
     gasto_id = context.args[0]
-    gasto, _, _ = get_gasto_by_id(update.effective_user.id, gasto_id)
+    gasto, _, _ = await run_io(get_gasto_by_id, update.effective_user.id, gasto_id)
     
     if not gasto:
-        await update.message.reply_text("Gasto no encontrado. Verifica el ID.")
+        await reply(update, "Gasto no encontrado. Verifica el ID.")
         return
     
-    if delete_gasto(update.effective_user.id, gasto_id):
-        await update.message.reply_text(
+    if await run_io(delete_gasto, update.effective_user.id, gasto_id):
+        await reply(
+            update,
             f"Gasto eliminado:\n"
             f"{gasto['bolivares']:,.2f} Bs (${gasto['dolares']:,.2f} USD)\n"
             f"Fecha: {gasto['fecha']}"
         )
     else:
-        await update.message.reply_text("Error al eliminar el gasto.")
+        await reply(update, "Error al eliminar el gasto.")
 
 async def editar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Comando /editar - Edita un gasto"""
     if not context.args or len(context.args) < 2:
-        await update.message.reply_text(
+        await reply(
+            update,
             "Uso: /editar <id> <nuevo_monto> [categoria] [descripcion]\n"
             "Ejemplo: /editar abc12345 25000\n"
             "Ejemplo: /editar abc12345 25000 comida"
@@ -890,7 +3163,7 @@ async def editar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
         new_amount = float(context.args[1].replace(',', '.'))
     except ValueError:
-        await update.message.reply_text("El monto debe ser un numero valido.")
+        await reply(update, "El monto debe ser un numero valido.")
         return
     
     new_categoria = None
@@ -904,40 +3177,41 @@ async def editar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         else:
             new_descripcion = " ".join(context.args[2:])
     
-    gasto, _, _ = get_gasto_by_id(update.effective_user.id, gasto_id)
+    gasto, _, _ = await run_io(get_gasto_by_id, update.effective_user.id, gasto_id)
     if not gasto:
-        await update.message.reply_text("Gasto no encontrado.")
+        await reply(update, "Gasto no encontrado.")
         return
     
-    dollar_rate = gasto.get("tipo_cambio", get_dollar_rate())
-    if edit_gasto(update.effective_user.id, gasto_id, new_amount, new_categoria, new_descripcion):
+    dollar_rate = gasto.get("tipo_cambio") or await run_io(get_dollar_rate)
+    if await run_io(edit_gasto, update.effective_user.id, gasto_id, new_amount, new_categoria, new_descripcion):
         new_usd = round(new_amount / dollar_rate, 2)
-        await update.message.reply_text(
+        await reply(
+            update,
             f"Gasto editado:\n"
             f"Nuevo monto: {new_amount:,.2f} Bs (${new_usd:,.2f} USD)\n"
             f"ID: {gasto_id}"
         )
     else:
-        await update.message.reply_text("Error al editar el gasto.")
+        await reply(update, "Error al editar el gasto.")
 
 async def resumen(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Comando /resumen - Muestra el resumen completo del mes"""
     # Ingreso mensual
-    ingreso = get_ingreso_mensual(update.effective_user.id)
+    ingreso = await run_io(get_ingreso_mensual, update.effective_user.id)
     
     # Gastos
-    total_bs_gastos, total_usd_gastos, gastos = get_month_summary(update.effective_user.id)
+    total_bs_gastos, total_usd_gastos, gastos = await run_io(get_month_summary, update.effective_user.id)
     total_bs_gastos = total_bs_gastos or 0
     total_usd_gastos = total_usd_gastos or 0
     gastos = gastos or []
     
     # Intercambios (compra de USDT, NO son gastos)
-    intercambios = get_intercambios_month(update.effective_user.id)
+    intercambios = await run_io(get_intercambios_month, update.effective_user.id)
     total_bs_intercambios = sum(i["bolivares"] for i in intercambios)
     total_usdt_intercambios = sum(i["usdt"] for i in intercambios)
     
     # Saldo disponible
-    saldo_bs, saldo_usdt, _, _ = get_saldo_disponible(update.effective_user.id)
+    saldo_bs, saldo_usdt, _, _ = await run_io(get_saldo_disponible, update.effective_user.id)
     
     message = f"Resumen del mes ({get_current_month_key()})\n\n"
     
@@ -979,6 +3253,12 @@ async def resumen(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         # Si hay ingreso pero no se puede calcular saldo (error en cálculo)
         message += "Saldo disponible: Error en calculo\n\n"
     
+    # Posición acumulada en USDT (todos los meses)
+    posicion = await run_io(get_posicion, update.effective_user.id)
+    if posicion["usdt"] > 0:
+        tasa_paralela = await run_io(get_parallel_rate)
+        message += "Posicion USDT:\n" + format_posicion(posicion, tasa_paralela, detalle=False) + "\n"
+    
     # Por categoría (solo si hay gastos)
     if len(gastos) > 0:
         by_category = {}
@@ -996,26 +3276,44 @@ async def resumen(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             message += categoria_info
     
     # Presupuesto (si existe)
-    presupuesto = get_presupuesto(update.effective_user.id)
+    presupuesto = await run_io(get_presupuesto, update.effective_user.id)
     if presupuesto:
         porcentaje = (total_usd_gastos / presupuesto * 100) if presupuesto > 0 else 0
-        message += f"\nPresupuesto: ${presupuesto:,.2f} USD (Usado: {porcentaje:.1f}%)"
+        message += f"\nPresupuesto: ${presupuesto:,.2f} USD (Usado: {porcentaje:.1f}%)\n"
+    
+    # Proyección de fin de mes
+    if len(gastos) > 0:
+        proyeccion = await run_io(get_proyeccion, update.effective_user.id)
+        message += "\n" + format_proyeccion(proyeccion, presupuesto)
     
-    await update.message.reply_text(message)
+    await reply(update, message)
 
 async def estadisticas(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Comando /estadisticas - Muestra estadisticas avanzadas"""
-    stats = get_statistics(update.effective_user.id)
+    """Comando /estadisticas [periodo] - Muestra estadisticas avanzadas de un período"""
+    periodo = parse_periodo(" ".join(context.args or []))
+    if periodo is None:
+        await reply(
+            update,
+            "Periodo no reconocido.\n"
+            "Ejemplos: /estadisticas, /estadisticas 2025-11, /estadisticas noviembre,\n"
+            "/estadisticas q3, /estadisticas 2025, /estadisticas 30d, /estadisticas mes pasado"
+        )
+        return
+    inicio, fin, etiqueta = periodo
+    
+    stats = await run_io(get_statistics, update.effective_user.id, inicio, fin)
     
     if not stats:
-        await update.message.reply_text("No hay gastos registrados este mes.")
+        await reply(update, f"No hay gastos registrados en el periodo ({etiqueta}).")
         return
     
     message = (
-        f"Estadisticas del mes ({get_current_month_key()})\n\n"
+        f"Estadisticas ({etiqueta})\n\n"
         f"Total: {stats['total_bs']:,.2f} Bs (${stats['total_usd']:,.2f} USD)\n"
-        f"Numero de gastos: {stats['count']}\n"
-        f"Promedio diario: {stats['promedio_diario_bs']:,.2f} Bs (${stats['promedio_diario_usd']:,.2f} USD)\n\n"
+        f"Numero de gastos: {stats['count']} en {stats['dias_con_gastos']} dias\n"
+        f"Promedio diario ({stats['dias']} dias): {stats['promedio_diario_bs']:,.2f} Bs (${stats['promedio_diario_usd']:,.2f} USD)\n"
+        f"Mediana por gasto: {stats['mediana_bs']:,.2f} Bs (${stats['mediana_usd']:,.2f} USD)\n"
+        f"Percentiles 75/90: {stats['p75_bs']:,.2f} / {stats['p90_bs']:,.2f} Bs\n\n"
         f"Gasto maximo: {stats['max_bs']:,.2f} Bs (${stats['max_usd']:,.2f} USD)\n"
         f"Fecha: {stats['max_gasto']['fecha']}\n"
         f"Categoria: {stats['max_gasto'].get('categoria', 'otros')}\n\n"
@@ -1029,157 +3327,261 @@ async def estadisticas(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         message += (
             f"\nDia con mas gastos: {fecha}\n"
             f"Total: {datos['bs']:,.2f} Bs (${datos['usd']:,.2f} USD)\n"
-            f"Gastos: {datos['count']}"
+            f"Gastos: {datos['count']}\n"
         )
     
-    await update.message.reply_text(message)
+    categorias = sorted(stats["by_category"].items(), key=lambda x: x[1]["usd"], reverse=True)
+    if categorias:
+        message += "\nPor categoria:\n"
+        for cat, datos in categorias:
+            message += f"{cat}: ${datos['usd']:,.2f} USD ({datos['porcentaje']:.1f}%) - {datos['count']} gastos\n"
+    
+    # Gasto típico de cada categoría en todo el historial (sketches de cuantiles)
+    cuantiles = await run_io(get_category_quantiles, update.effective_user.id)
+    if cuantiles:
+        message += "\nGasto tipico (todo el historial, mediana / p90):\n"
+        for cat, datos in sorted(cuantiles.items(), key=lambda x: (x[0] == "total", -x[1]["n"])):
+            nombre = "todos" if cat == "total" else cat
+            message += f"{nombre}: ${datos['mediana']:,.2f} / ${datos['p90']:,.2f} USD ({datos['n']} gastos)\n"
+    
+    await reply(update, message)
 
 async def presupuesto(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Comando /presupuesto - Ver o establecer presupuesto"""
+    """Comando /presupuesto [categoria] [monto] - Ver o establecer presupuestos (general o por categoría)"""
     if not context.args:
-        presupuesto = get_presupuesto(update.effective_user.id)
+        presupuesto = await run_io(get_presupuesto, update.effective_user.id)
+        estado = await run_io(get_alertas_estado, update.effective_user.id)
+        categorias = {clave: limite for clave, limite in estado["limites"].items() if clave != "total"}
+        if not presupuesto and not categorias:
+            await reply(
+                update,
+                "No hay presupuesto establecido para este mes.\n"
+                "Usa: /presupuesto <monto_en_usd> o /presupuesto <categoria> <monto_en_usd>"
+            )
+            return
+        
+        message = f"Presupuesto del mes ({get_current_month_key()})\n\n"
         if presupuesto:
-            total_bs, total_usd, _ = get_month_summary(update.effective_user.id)
+            total_usd = estado["totales"]["total"]
             porcentaje = (total_usd / presupuesto * 100) if presupuesto > 0 else 0
-            restante = presupuesto - total_usd if total_usd else presupuesto
+            restante = presupuesto - total_usd
             
-            message = (
-                f"Presupuesto del mes ({get_current_month_key()})\n\n"
+            message += (
                 f"Presupuesto: ${presupuesto:,.2f} USD\n"
                 f"Gastado: ${total_usd:,.2f} USD ({porcentaje:.1f}%)\n"
-                f"Restante: ${restante:,.2f} USD"
+                f"Restante: ${restante:,.2f} USD\n"
             )
             if porcentaje >= 100:
-                message += "\n\nPRESUPUESTO EXCEDIDO"
+                message += "\nPRESUPUESTO EXCEDIDO\n"
             elif porcentaje >= 80:
-                message += "\n\nCerca del limite"
-        else:
-            message = "No hay presupuesto establecido para este mes.\nUsa: /presupuesto <monto_en_usd>"
-        await update.message.reply_text(message)
+                message += "\nCerca del limite\n"
+        
+        if categorias:
+            message += "\nPor categoria:\n"
+            for cat, limite in sorted(categorias.items()):
+                gastado = estado["totales"].get(cat, 0)
+                porcentaje = gastado / limite * 100
+                aviso = " - EXCEDIDO" if porcentaje >= 100 else (" - cerca del limite" if porcentaje >= 80 else "")
+                message += f"{cat}: ${gastado:,.2f} de ${limite:,.2f} USD ({porcentaje:.1f}%){aviso}\n"
+        
+        proyeccion = await run_io(get_proyeccion, update.effective_user.id)
+        if proyeccion:
+            message += "\n" + format_proyeccion(proyeccion, presupuesto)
+        await reply(update, message)
         return
     
+    # Presupuesto de una categoría: /presupuesto comida 50 (0 lo elimina)
+    categoria = None
+    args = context.args
+    if args[0].lower() in CATEGORIAS:
+        categoria = args[0].lower()
+        args = args[1:]
+        if not args:
+            await reply(update, f"Indica el monto en USD.\nEjemplo: /presupuesto {categoria} 50")
+            return
+    
     try:
-        amount_usd = float(context.args[0].replace(',', '.'))
-        if amount_usd <= 0:
-            await update.message.reply_text("El presupuesto debe ser mayor a 0.")
+        amount_usd = float(args[0].replace(',', '.'))
+        if amount_usd < 0 or (amount_usd == 0 and categoria is None):
+            await reply(update, "El presupuesto debe ser mayor a 0.")
             return
         
-        set_presupuesto(update.effective_user.id, amount_usd)
-        await update.message.reply_text(
-            f"Presupuesto establecido: ${amount_usd:,.2f} USD para el mes {get_current_month_key()}"
-        )
+        if categoria is None:
+            await run_io(set_presupuesto, update.effective_user.id, amount_usd)
+            await reply(
+                update,
+                f"Presupuesto establecido: ${amount_usd:,.2f} USD para el mes {get_current_month_key()}"
+            )
+        elif amount_usd == 0:
+            await run_io(set_presupuesto_categoria, update.effective_user.id, categoria, 0)
+            await reply(update, f"Presupuesto de {categoria} eliminado para el mes {get_current_month_key()}")
+        else:
+            await run_io(set_presupuesto_categoria, update.effective_user.id, categoria, amount_usd)
+            await reply(
+                update,
+                f"Presupuesto de {categoria}: ${amount_usd:,.2f} USD para el mes {get_current_month_key()}"
+            )
     except ValueError:
-        await update.message.reply_text("Por favor, ingresa un numero valido.\nEjemplo: /presupuesto 500")
+        await reply(
+            update,
+            "Por favor, ingresa un numero valido.\n"
+            "Ejemplo: /presupuesto 500\n"
+            f"Por categoria: /presupuesto comida 150 (categorias: {', '.join(CATEGORIAS)})"
+        )
+
+def parse_mes(texto, hoy=None):
+    """Convierte "2025-11", "noviembre" o "mes pasado" en una clave de mes (None si no es un mes)"""
+    periodo = parse_periodo(texto, hoy)
+    if periodo is None:
+        return None
+    inicio, fin, _ = periodo
+    if inicio.day != 1 or fin != _rango_mes(inicio.year, inicio.month)[1].date():
+        return None
+    return inicio.strftime("%Y-%m")
 
 async def comparar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Comando /comparar - Compara mes actual con mes anterior"""
-    current_month = get_current_month_key()
-    previous_month = get_previous_month_key()
-    
-    total_bs_curr, total_usd_curr, gastos_curr = get_month_summary(update.effective_user.id, current_month)
-    total_bs_prev, total_usd_prev, gastos_prev = get_month_summary(update.effective_user.id, previous_month)
+    """Comando /comparar [N | mes1 mes2] - Compara meses (por defecto, el actual con el anterior)"""
+    args = context.args or []
+    uso = (
+        "Uso:\n"
+        "/comparar - mes actual contra el anterior\n"
+        f"/comparar <N> - evolucion de los ultimos N meses (2 a {COMPARAR_MAX_MESES})\n"
+        "/comparar <mes1> <mes2> - dos meses cualesquiera\n"
+        "Ejemplo: /comparar 6, /comparar 2025-09 2025-11, /comparar octubre noviembre"
+    )
     
-    if total_bs_curr is None and total_bs_prev is None:
-        await update.message.reply_text("No hay datos para comparar.")
+    if len(args) == 1 and args[0].isdigit():
+        n = int(args[0])
+        if not 2 <= n <= COMPARAR_MAX_MESES:
+            await reply(update, uso)
+            return
+        month_keys = list(reversed(get_last_month_keys(n)))
+        rollups = await run_io(get_month_rollups, update.effective_user.id, month_keys)
+        if not any(r["count"] for r in rollups.values()):
+            await reply(update, "No hay datos para comparar.")
+            return
+        message = f"Comparacion de los ultimos {n} meses\n\n" + format_comparacion_meses(month_keys, rollups)
+        await reply(update, message)
         return
     
-    message = "Comparacion de meses\n\n"
-    
-    if total_bs_prev is not None:
-        message += (
-            f"Mes anterior ({previous_month}):\n"
-            f"Total: {total_bs_prev:,.2f} Bs (${total_usd_prev:,.2f} USD)\n"
-            f"Gastos: {len(gastos_prev)}\n\n"
-        )
-    else:
-        message += f"Mes anterior ({previous_month}): Sin datos\n\n"
-    
-    if total_bs_curr is not None:
-        message += (
-            f"Mes actual ({current_month}):\n"
-            f"Total: {total_bs_curr:,.2f} Bs (${total_usd_curr:,.2f} USD)\n"
-            f"Gastos: {len(gastos_curr)}\n\n"
-        )
+    if not args:
+        mes_anterior, mes_actual = get_previous_month_key(), get_current_month_key()
+    elif len(args) == 2:
+        mes_anterior, mes_actual = parse_mes(args[0]), parse_mes(args[1])
+        if mes_anterior is None or mes_actual is None:
+            await reply(update, uso)
+            return
+        if mes_anterior > mes_actual:
+            mes_anterior, mes_actual = mes_actual, mes_anterior
     else:
-        message += f"Mes actual ({current_month}): Sin datos\n\n"
+        await reply(update, uso)
+        return
     
-    if total_bs_prev is not None and total_bs_curr is not None:
-        diff_bs = total_bs_curr - total_bs_prev
-        diff_usd = total_usd_curr - total_usd_prev
-        diff_percent = (diff_usd / total_usd_prev * 100) if total_usd_prev > 0 else 0
-        
-        message += (
-            f"Diferencia:\n"
-            f"{diff_bs:+,.2f} Bs (${diff_usd:+,.2f} USD)\n"
-            f"{diff_percent:+.1f}%"
-        )
+    rollups = await run_io(get_month_rollups, update.effective_user.id, [mes_anterior, mes_actual])
+    if not rollups[mes_anterior]["count"] and not rollups[mes_actual]["count"]:
+        await reply(update, "No hay datos para comparar.")
+        return
     
-    await update.message.reply_text(message)
+    message = "Comparacion de meses\n\n" + format_comparacion(
+        mes_anterior, rollups[mes_anterior], mes_actual, rollups[mes_actual]
+    )
+    await reply(update, message)
+
+def parse_busqueda(texto, hoy=None):
+    """Convierte el texto de /buscar en los filtros de get_gastos_page
+
+    Reconoce un rango de montos ("1000-5000"), un período en una palabra
+    ("2025-11", "2025", "q3", "30d") o una expresión de fecha ("noviembre",
+    "ayer", "el mes pasado"); el resto son las palabras a buscar.
+    """
+    if hoy is None:
+        hoy = datetime.now().date()
+    filtros = {}
+    resto = []
+    for palabra in texto.lower().split():
+        periodo = None
+        if any(p.match(palabra) for p in (PERIODO_MES, PERIODO_ANIO, PERIODO_TRIMESTRE, PERIODO_DIAS)):
+            periodo = parse_periodo(palabra, hoy)
+        match = EXPORT_RANGO.match(palabra)
+        if periodo:
+            filtros["desde"], filtros["hasta"] = periodo[0].strftime("%Y-%m-%d"), periodo[1].strftime("%Y-%m-%d")
+        elif match:
+            filtros["min_amount"] = parse_monto(match.group(1))
+            filtros["max_amount"] = parse_monto(match.group(2))
+        else:
+            resto.append(palabra)
+    
+    resto = " ".join(resto)
+    fecha_info = parse_fecha_expresion(resto, hoy)
+    if fecha_info["rango"]:
+        inicio, fin = fecha_info["rango"]
+        filtros["desde"], filtros["hasta"] = inicio.strftime("%Y-%m-%d"), fin.strftime("%Y-%m-%d")
+    elif fecha_info["fecha"]:
+        filtros["desde"] = filtros["hasta"] = fecha_info["fecha"].strftime("%Y-%m-%d")
+    if fecha_info["rango"] or fecha_info["fecha"]:
+        resto = remove_spans(resto, fecha_info["spans"])
+    
+    filtros["terminos"] = list(terminos_busqueda(resto))
+    return filtros
+
+def guardar_busqueda(filtros, consulta):
+    """Guarda los filtros de una búsqueda y devuelve su filtro para los botones ("q<clave>")"""
+    clave = str(uuid.uuid4())[:8]
+    busquedas_guardadas[clave] = dict(filtros, consulta=consulta)
+    while len(busquedas_guardadas) > BUSQUEDAS_MAX:
+        busquedas_guardadas.popitem(last=False)
+    return f"q{clave}"
 
 async def buscar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Comando /buscar - Busca gastos por fecha o rango"""
+    """Comando /buscar - Busca gastos por texto, fecha, período o rango de montos"""
     if not context.args:
-        await update.message.reply_text(
-            "Uso: /buscar <fecha> o /buscar <min> <max>\n"
+        await reply(
+            update,
+            "Uso: /buscar <texto> [periodo] [min-max], /buscar <fecha> o /buscar <min> <max>\n"
+            "Ejemplo: /buscar farmacia\n"
+            "Ejemplo: /buscar uber noviembre\n"
+            "Ejemplo: /buscar comida 2025-10 1000-5000\n"
             "Ejemplo: /buscar 2025-11-11\n"
             "Ejemplo: /buscar 1000 50000"
         )
         return
     
-    if len(context.args) == 1:
+    args = context.args
+    if len(args) == 1 and re.fullmatch(r"\d{4}-\d{2}-\d{2}", args[0]):
         # Buscar por fecha
         try:
-            fecha_str = context.args[0]
-            fecha = datetime.strptime(fecha_str, "%Y-%m-%d")
-            gastos = get_gastos_by_date(update.effective_user.id, fecha)
+            fecha = datetime.strptime(args[0], "%Y-%m-%d")
+            filtro = f"d{fecha.strftime('%Y%m%d')}"
         except ValueError:
-            await update.message.reply_text("Formato de fecha invalido. Usa YYYY-MM-DD")
+            await reply(update, "Formato de fecha invalido. Usa YYYY-MM-DD")
             return
-    elif len(context.args) == 2:
+    elif len(args) == 2 and es_numero(args[0]) and es_numero(args[1]):
         # Buscar por rango
-        try:
-            min_amount = float(context.args[0].replace(',', '.'))
-            max_amount = float(context.args[1].replace(',', '.'))
-            gastos = get_gastos_by_range(update.effective_user.id, min_amount, max_amount)
-        except ValueError:
-            await update.message.reply_text("Los montos deben ser numeros validos.")
-            return
+        min_amount = float(args[0].replace(',', '.'))
+        max_amount = float(args[1].replace(',', '.'))
+        filtro = f"r{min_amount:.2f}-{max_amount:.2f}"
+        if len(filtro) > FILTRO_MAX_CHARS:
+            filtro = guardar_busqueda({"min_amount": min_amount, "max_amount": max_amount}, " ".join(args))
     else:
-        await update.message.reply_text("Formato invalido. Ver /start para ayuda.")
-        return
-    
-    if not gastos:
-        await update.message.reply_text("No se encontraron gastos.")
-        return
-    
-    total_bs = sum(g["bolivares"] for g in gastos)
-    total_usd = sum(g["dolares"] for g in gastos)
-    
-    message = (
-        f"Gastos encontrados: {len(gastos)}\n"
-        f"Total: {total_bs:,.2f} Bs (${total_usd:,.2f} USD)\n\n"
-    )
+        # Buscar por texto, combinable con período y rango de montos
+        consulta = " ".join(args)
+        filtro = guardar_busqueda(parse_busqueda(consulta), consulta)
     
-    for g in gastos[:10]:
-        message += (
-            f"ID: {g.get('id', 'N/A')}\n"
-            f"Fecha: {g['fecha']}\n"
-            f"Monto: {g['bolivares']:,.2f} Bs (${g['dolares']:,.2f} USD)\n"
-            f"Categoria: {g.get('categoria', 'otros')}\n\n"
-        )
+    message, teclado = await run_io(build_gastos_page, update.effective_user.id, filtro)
     
-    if len(gastos) > 10:
-        message += f"... y {len(gastos) - 10} mas"
+    if not message:
+        await reply(update, "No se encontraron gastos.")
+        return
     
-    await update.message.reply_text(message)
+    await reply(update, message, reply_markup=teclado)
 
 async def gastos_hoy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Comando /gastos_hoy - Muestra gastos del dia actual"""
     hoy = datetime.now().date()
-    gastos = get_gastos_by_date(update.effective_user.id, hoy)
+    gastos = await run_io(get_gastos_by_date, update.effective_user.id, hoy)
     
     if not gastos:
-        await update.message.reply_text("No hay gastos registrados hoy.")
+        await reply(update, "No hay gastos registrados hoy.")
         return
     
     total_bs = sum(g["bolivares"] for g in gastos)
@@ -1201,38 +3603,174 @@ async def gastos_hoy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
             message += f"Descripcion: {g['descripcion']}\n"
         message += "\n"
     
-    await update.message.reply_text(message)
+    await reply(update, message)
+
+async def grafico(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Comando /grafico [diario|categorias|tasas] [periodo] - Envía un gráfico PNG"""
+    args = context.args or []
+    tipo = "diario"
+    if args and args[0].lower() in GRAFICO_TIPOS:
+        tipo = args[0].lower()
+        args = args[1:]
+    
+    texto_periodo = " ".join(args)
+    if not texto_periodo and tipo == "tasas":
+        texto_periodo = "90d"
+    periodo = parse_periodo(texto_periodo)
+    if periodo is None:
+        await reply(
+            update,
+            "Uso: /grafico [diario|categorias|tasas] [periodo]\n"
+            "Ejemplos: /grafico, /grafico categorias mes pasado, /grafico diario 30d, /grafico tasas 2025"
+        )
+        return
+    inicio, fin, etiqueta = periodo
+    
+    png = await run_io(get_grafico, update.effective_user.id, tipo, inicio, fin, etiqueta)
+    if png is None:
+        if tipo == "tasas":
+            await reply(update, f"No hay tasas guardadas en el periodo ({etiqueta}).")
+        else:
+            await reply(update, f"No hay gastos registrados en el periodo ({etiqueta}).")
+        return
+    await reply_photo(update, photo=png, caption=f"{tipo.capitalize()} - {etiqueta}")
+
+EXPORT_RANGO = re.compile(r"^(\d+(?:[.,]\d+)?)-(\d+(?:[.,]\d+)?)$")
 
 async def exportar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Comando /exportar - Exporta gastos a CSV"""
-    filepath = export_to_csv(update.effective_user.id)
+    """Comando /exportar [gastos|intercambios|ingresos|todo] [categoria] [min-max] [periodo] [gz]"""
+    tipos = ["gastos"]
+    categoria = None
+    min_bs = max_bs = None
+    comprimir = None
+    resto = []
+    for arg in context.args or []:
+        palabra = arg.lower()
+        rango = EXPORT_RANGO.match(palabra)
+        if palabra in EXPORT_COLUMNAS:
+            tipos = [palabra]
+        elif palabra == "todo":
+            tipos = list(EXPORT_COLUMNAS)
+        elif palabra in CATEGORIAS:
+            categoria = palabra
+        elif palabra in ("gz", "gzip"):
+            comprimir = True
+        elif rango and not PERIODO_MES.match(palabra):
+            # "2025-11" es un mes, no un rango de montos
+            min_bs = float(rango.group(1).replace(',', '.'))
+            max_bs = float(rango.group(2).replace(',', '.'))
+        else:
+            resto.append(arg)
+    
+    # Sin período se exporta todo el historial
+    inicio = fin = None
+    if resto:
+        periodo = parse_periodo(" ".join(resto))
+        if periodo is None:
+            await reply(
+                update,
+                "Uso: /exportar [gastos|intercambios|ingresos|todo] [categoria] [min-max] [periodo] [gz]\n"
+                "Ejemplos: /exportar, /exportar comida 2025, /exportar 1000-50000 mes pasado,\n"
+                "/exportar todo q3 gz\n"
+                "El rango de montos es en Bs; sin periodo se exporta todo el historial."
+            )
+            return
+        inicio, fin, _ = periodo
     
-    if not filepath:
-        await update.message.reply_text("No hay gastos para exportar.")
+    generados = 0
+    for tipo in tipos:
+        resultado = await run_io(
+            export_csv, update.effective_user.id, tipo, inicio, fin, categoria, min_bs, max_bs, comprimir
+        )
+        if resultado is None:
+            continue
+        archivo, nombre, total = resultado
+        generados += 1
+        
+        def enviar(archivo=archivo, nombre=nombre, total=total, tipo=tipo):
+            # Un reintento tras un 429 vuelve a leer el archivo desde el inicio
+            archivo.seek(0)
+            return update.message.reply_document(document=archivo, filename=nombre, caption=f"{total} {tipo}")
+        
+        try:
+            await enqueue_message(update.effective_chat.id if update.effective_chat else None, enviar, esperar=True)
+        except Exception as e:
+            await reply(update, f"Error al exportar {tipo}: {e}")
+        finally:
+            archivo.close()
+    
+    if not generados:
+        await reply(update, "No hay datos para exportar con esos filtros.")
+
+IMPORT_USO = (
+    "Envia un archivo CSV o XLSX con /importar como descripcion (o responde al archivo con /importar).\n\n"
+    "Columnas: Fecha y Bolivares (o Dolares); opcionales: Categoria, Descripcion, Tipo Cambio e ID.\n"
+    "Fechas: 2025-11-18, 2025-11-18 14:30:00 o 18/11/2025. Sin tipo de cambio se usa la tasa "
+    "oficial guardada de ese dia. Un CSV de /exportar se puede importar tal cual, "
+    "tambien comprimido (.csv.gz)."
+)
+
+async def importar_documento(update, documento):
+    """Descarga un CSV/XLSX (o un CSV comprimido con gzip) a un buffer temporal e importa sus gastos"""
+    nombre = documento.file_name or "archivo"
+    comprimido = nombre.lower().endswith(".gz")
+    extension = nombre.lower().removesuffix(".gz").rsplit(".", 1)[-1]
+    if extension not in ("csv", "xlsx", "txt") or (comprimido and extension == "xlsx"):
+        await reply(update, "Formato no soportado. Usa un archivo .csv, .csv.gz o .xlsx")
+        return
+    if documento.file_size and documento.file_size > IMPORT_MAX_BYTES:
+        await reply(update, "El archivo es demasiado grande (maximo 20 MB).")
         return
     
-    try:
-        with open(filepath, 'rb') as f:
-            await update.message.reply_document(document=f, filename=os.path.basename(filepath))
-        os.remove(filepath)
-    except Exception as e:
-        await update.message.reply_text(f"Error al exportar: {e}")
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX) as archivo:
+        telegram_file = await documento.get_file()
+        await telegram_file.download_to_memory(archivo)
+        archivo.seek(0)
+        try:
+            # El CSV comprimido se descomprime a medida que se leen las filas
+            entrada = gzip.GzipFile(fileobj=archivo, mode="rb") if comprimido else archivo
+            resumen = await run_io(
+                import_gastos, update.effective_user.id, entrada, "xlsx" if extension == "xlsx" else "csv"
+            )
+        except Exception as e:
+            await reply(update, f"No se pudo importar {nombre}: {e}")
+            return
+    await reply(update, format_import_resumen(resumen, nombre))
+
+async def importar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Comando /importar - Importa gastos desde un CSV o XLSX"""
+    respondido = update.message.reply_to_message
+    if respondido is not None and respondido.document is not None:
+        await importar_documento(update, respondido.document)
+        return
+    
+    # Sin archivo: el próximo documento que envíe el usuario se importa
+    importaciones_pendientes[str(update.effective_user.id)] = time.time()
+    await reply(update, IMPORT_USO)
+
+async def documento_recibido(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Documento recibido: se importa si trae /importar como descripción o si se pidió con /importar"""
+    caption = (update.message.caption or "").strip().lower()
+    pendiente = importaciones_pendientes.pop(str(update.effective_user.id), None)
+    if caption.startswith("/importar") or (pendiente and time.time() - pendiente < IMPORT_ESPERA):
+        await importar_documento(update, update.message.document)
 
 async def dolar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Comando /dolar - Muestra el tipo de cambio actual"""
     # Verificar si hay argumento para forzar actualización
     force_update = context.args and context.args[0].lower() in ["actualizar", "update", "refresh"]
     
-    dollar_rate = get_dollar_rate(force_api=force_update)
+    dollar_rate = await run_io(get_dollar_rate, force_api=force_update)
     
     if dollar_rate is None or dollar_rate == 0:
-        await update.message.reply_text(
+        await reply(
+            update,
             "Error al obtener el tipo de cambio. Intenta mas tarde."
         )
         return
     
     date_key = get_date_key()
-    tasas = load_tasas()
+    tasas = await run_io(load_tasas)
     
     message = (
         f"Tipo de cambio del dolar oficial:\n\n"
@@ -1252,19 +3790,20 @@ async def dolar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     
     message += f"\n\n💡 Usa /dolar actualizar para forzar actualización"
     
-    await update.message.reply_text(message)
+    await reply(update, message)
 
 async def binance_rate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Comando /binance_rate - Muestra el tipo de cambio paralelo (Binance/USDT)"""
-    parallel_rate = get_parallel_rate()
+    parallel_rate = await run_io(get_parallel_rate)
     
     if parallel_rate is None or parallel_rate == 0:
-        await update.message.reply_text(
+        await reply(
+            update,
             "Error al obtener el tipo de cambio paralelo. Intenta mas tarde."
         )
         return
     
-    official_rate = get_dollar_rate() or 0
+    official_rate = await run_io(get_dollar_rate) or 0
     diferencia = parallel_rate - official_rate if official_rate > 0 else 0
     diferencia_porcentaje = (diferencia / official_rate * 100) if official_rate > 0 else 0
     
@@ -1275,12 +3814,81 @@ async def binance_rate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         f"Oficial: {official_rate:,.2f} Bs/$\n"
         f"Diferencia: {diferencia:+,.2f} Bs ({diferencia_porcentaje:+.1f}%)"
     )
-    await update.message.reply_text(message)
+    await reply(update, message)
+
+async def posicion(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Comando /posicion - USDT acumulado, costo en Bs y ganancia a la tasa paralela actual"""
+    posicion_usdt = await run_io(get_posicion, update.effective_user.id)
+    if posicion_usdt["compras"] == 0:
+        await reply(update, "No tienes intercambios registrados.\nUsa: /cambiar <cantidad_bs> [tasa]")
+        return
+    
+    tasa_paralela = await run_io(get_parallel_rate)
+    message = "Posicion en USDT\n\n" + format_posicion(posicion_usdt, tasa_paralela)
+    if not tasa_paralela:
+        message += "\n(No se pudo obtener la tasa paralela para valorar la posicion)"
+    await reply(update, message)
+
+async def vender(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Comando /vender - Registra una venta de USDT a Bs (descuenta la posición)"""
+    if not context.args:
+        await reply(
+            update,
+            "Uso: /vender <cantidad_usdt> [tasa] [descripcion]\n"
+            "Ejemplo: /vender 50\n"
+            "Ejemplo: /vender 50 340\n\n"
+            "Si no especificas la tasa, se usara la tasa paralela actual de la API."
+        )
+        return
+    
+    try:
+        amount_usdt = float(context.args[0].replace(',', '.'))
+        if amount_usdt <= 0:
+            await reply(update, "La cantidad debe ser mayor a 0")
+            return
+        
+        tasa_paralela = None
+        descripcion = ""
+        if len(context.args) > 1:
+            try:
+                tasa_paralela = float(context.args[1].replace(',', '.'))
+                descripcion = " ".join(context.args[2:])
+            except ValueError:
+                descripcion = " ".join(context.args[1:])
+        
+        if tasa_paralela is None or tasa_paralela <= 0:
+            tasa_paralela = await run_io(get_parallel_rate)
+            if not tasa_paralela:
+                await reply(
+                    update,
+                    "Error al obtener el tipo de cambio paralelo. Especifica la tasa manualmente.\n"
+                    "Ejemplo: /vender 50 340"
+                )
+                return
+        
+        venta, posicion_usdt = await run_io(
+            vender_usdt, update.effective_user.id, amount_usdt, tasa_paralela, descripcion
+        )
+    except ValueError as e:
+        await reply(update, f"No se pudo registrar la venta: {e}")
+        return
+    
+    message = (
+        f"Venta registrada (ID: {venta['id']})\n\n"
+        f"USDT vendido: {venta['usdt']:,.4f} USDT\n"
+        f"Bolivares recibidos: {venta['bolivares']:,.2f} Bs\n"
+        f"Tasa usada: {tasa_paralela:,.2f} Bs/USDT\n"
+        f"Ganancia realizada: {venta['ganancia_promedio_bs']:+,.2f} Bs (costo promedio), "
+        f"{venta['ganancia_fifo_bs']:+,.2f} Bs (FIFO)\n\n"
+        + format_posicion(posicion_usdt, tasa_paralela, detalle=False)
+    )
+    await reply(update, message)
 
 async def cambiar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Comando /cambiar - Intercambia bolívares a USDT (compra de divisa, NO es gasto)"""
     if not context.args or len(context.args) < 1:
-        await update.message.reply_text(
+        await reply(
+            update,
             "Uso: /cambiar <cantidad_bs> [tasa] [descripcion]\n"
             "Ejemplo: /cambiar 100000\n"
             "Ejemplo: /cambiar 100000 320\n"
@@ -1293,7 +3901,7 @@ async def cambiar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         amount_bs = float(context.args[0].replace(',', '.'))
         
         if amount_bs <= 0:
-            await update.message.reply_text("La cantidad debe ser mayor a 0")
+            await reply(update, "La cantidad debe ser mayor a 0")
             return
         
         # Verificar si hay tasa manual
@@ -1312,16 +3920,22 @@ async def cambiar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         
         # Si no se especificó tasa, usar la de la API
         if tasa_paralela is None or tasa_paralela <= 0:
-            tasa_paralela = get_parallel_rate()
+            tasa_paralela = await run_io(get_parallel_rate)
             if tasa_paralela is None or tasa_paralela == 0:
-                await update.message.reply_text(
+                await reply(
+                    update,
                     "Error al obtener el tipo de cambio paralelo. Especifica la tasa manualmente.\n"
                     "Ejemplo: /cambiar 100000 320"
                 )
                 return
         
+        if round(amount_bs / tasa_paralela, 4) <= 0:
+            await reply(update, "El monto es demasiado pequeño: equivale a menos de 0.0001 USDT")
+            return
+        
         # Registrar intercambio (NO es gasto, es compra de divisa)
-        amount_usdt, intercambio_id = add_intercambio(
+        amount_usdt, intercambio_id = await run_io(
+            add_intercambio,
             update.effective_user.id,
             amount_bs,
             tasa_paralela,
@@ -1329,7 +3943,7 @@ async def cambiar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         
         # Calcular saldo disponible
-        saldo_bs, saldo_usdt, _, _ = get_saldo_disponible(update.effective_user.id)
+        saldo_bs, saldo_usdt, _, _ = await run_io(get_saldo_disponible, update.effective_user.id)
         
         message = (
             f"Intercambio registrado (ID: {intercambio_id})\n\n"
@@ -1347,10 +3961,11 @@ async def cambiar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         if descripcion:
             message += f"\n\nDescripcion: {descripcion}"
         
-        await update.message.reply_text(message)
+        await reply(update, message)
         
     except ValueError:
-        await update.message.reply_text(
+        await reply(
+            update,
             "Por favor, ingresa numeros validos.\n"
             "Ejemplo: /cambiar 100000\n"
             "Ejemplo: /cambiar 100000 320"
@@ -1359,9 +3974,9 @@ async def cambiar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def ingreso(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Comando /ingreso - Registra el ingreso mensual"""
     if not context.args:
-        ingreso_actual = get_ingreso_mensual(update.effective_user.id)
+        ingreso_actual = await run_io(get_ingreso_mensual, update.effective_user.id)
         if ingreso_actual:
-            saldo_bs, saldo_usdt, _, _ = get_saldo_disponible(update.effective_user.id)
+            saldo_bs, saldo_usdt, _, _ = await run_io(get_saldo_disponible, update.effective_user.id)
             message = (
                 f"Ingreso mensual ({get_current_month_key()})\n\n"
                 f"Ingreso: {ingreso_actual['bolivares']:,.2f} Bs\n"
@@ -1381,14 +3996,14 @@ async def ingreso(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 "Ejemplo: /ingreso 120000 330\n\n"
                 "Si no especificas la tasa, se usara la tasa paralela actual."
             )
-        await update.message.reply_text(message)
+        await reply(update, message)
         return
     
     try:
         amount_bs = float(context.args[0].replace(',', '.'))
         
         if amount_bs <= 0:
-            await update.message.reply_text("El ingreso debe ser mayor a 0")
+            await reply(update, "El ingreso debe ser mayor a 0")
             return
         
         # Verificar si hay tasa manual
@@ -1401,15 +4016,16 @@ async def ingreso(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         
         # Si no se especificó tasa, usar la de la API
         if tasa_paralela is None or tasa_paralela <= 0:
-            tasa_paralela = get_parallel_rate() or get_dollar_rate()
+            tasa_paralela = await run_io(get_parallel_rate) or await run_io(get_dollar_rate)
             if tasa_paralela is None or tasa_paralela == 0:
-                await update.message.reply_text(
+                await reply(
+                    update,
                     "Error al obtener el tipo de cambio. Especifica la tasa manualmente.\n"
                     "Ejemplo: /ingreso 120000 330"
                 )
                 return
         
-        amount_usdt = set_ingreso_mensual(update.effective_user.id, amount_bs, tasa_paralela)
+        amount_usdt = await run_io(set_ingreso_mensual, update.effective_user.id, amount_bs, tasa_paralela)
         
         message = (
             f"Ingreso mensual registrado\n\n"
@@ -1419,25 +4035,68 @@ async def ingreso(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             f"El bot ahora llevara cuenta de tus gastos e intercambios contra este ingreso."
         )
         
-        await update.message.reply_text(message)
+        await reply(update, message)
         
     except ValueError:
-        await update.message.reply_text(
+        await reply(
+            update,
             "Por favor, ingresa un numero valido.\n"
             "Ejemplo: /ingreso 120000\n"
             "Ejemplo: /ingreso 120000 330"
         )
 
+async def sinonimo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Comando /sinonimo - Define palabras propias que se asocian a una categoría"""
+    user_id = update.effective_user.id
+    if not context.args:
+        sinonimos = await run_io(load_sinonimos)
+        user_sinonimos = sinonimos.get(str(user_id), {})
+        if not user_sinonimos:
+            message = "No tienes sinonimos definidos.\n"
+        else:
+            message = "Tus sinonimos:\n\n"
+            for palabra, cat in sorted(user_sinonimos.items()):
+                message += f"{palabra} -> {cat}\n"
+            message += "\n"
+        message += (
+            "Uso: /sinonimo <palabra> <categoria>\n"
+            "Ejemplo: /sinonimo almuerzo comida\n"
+            "Para eliminar: /sinonimo eliminar <palabra>"
+        )
+        await reply(update, message)
+        return
+    
+    if context.args[0].lower() == "eliminar" and len(context.args) > 1:
+        palabra = " ".join(context.args[1:]).lower()
+        await run_io(set_sinonimo, user_id, palabra, None)
+        await reply(update, f"Sinonimo eliminado: {palabra}")
+        return
+    
+    if len(context.args) < 2 or context.args[-1].lower() not in CATEGORIAS:
+        await reply(
+            update,
+            "Uso: /sinonimo <palabra> <categoria>\n"
+            f"Categorias disponibles: {', '.join(CATEGORIAS)}"
+        )
+        return
+    
+    palabra = " ".join(context.args[:-1]).lower()
+    categoria = context.args[-1].lower()
+    await run_io(set_sinonimo, user_id, palabra, categoria)
+    await reply(update, f"Sinonimo registrado: '{palabra}' se asociara a la categoria {categoria}")
+
 async def ai_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Comando /ai - Pregunta a la IA"""
     if not gemini_enabled:
-        await update.message.reply_text(
+        await reply(
+            update,
             "La IA no esta disponible. Verifica que GEMINI_API_KEY este configurada en el archivo .env"
         )
         return
     
     if not context.args:
-        await update.message.reply_text(
+        await reply(
+            update,
             "Por favor, haz una pregunta despues del comando.\n"
             "Ejemplo: /ai Cuanto es 1000 bolivares en dolares?"
         )
@@ -1446,91 +4105,185 @@ async def ai_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     question = " ".join(context.args)
     
     dollar_rate = None
-    question_lower = question.lower()
-    dollar_keywords = ['dolar', 'dólar', 'dollar', 'tasa', 'tipo de cambio', 'cambio', 'bs', 'bolivar', 'bolívar', 'usd', 'precio']
-    if any(keyword in question_lower for keyword in dollar_keywords):
-        dollar_rate = get_dollar_rate()
+    intenciones, _ = detect_intents(question.lower())
+    if intenciones & {"dolar", "bolivar"}:
+        dollar_rate = await run_io(get_dollar_rate)
     
-    thinking_msg = await update.message.reply_text("Pensando...")
+    thinking_msg = await reply(update, "Pensando...", esperar=True)
     
     ai_response = await ask_gemini(question, dollar_rate, update.effective_user.id)
     
-    await thinking_msg.delete()
+    await delete_message_quietly(thinking_msg)
     
     if ai_response:
-        await update.message.reply_text(ai_response)
+        await reply(update, ai_response)
     else:
-        await update.message.reply_text(
+        await reply(
+            update,
             "Error al consultar la IA. Intenta mas tarde."
         )
 
+def get_gemini_model(name):
+    """Obtiene (o crea) la instancia del modelo de Gemini"""
+    if name not in gemini_models:
+        gemini_models[name] = genai.GenerativeModel(name)
+    return gemini_models[name]
+
+def get_model_stats(name):
+    """Obtiene las estadísticas de latencia y errores de un modelo"""
+    if name not in gemini_model_stats:
+        gemini_model_stats[name] = {
+            "llamadas": 0,
+            "errores": 0,
+            "timeouts": 0,
+            "latencias": deque(maxlen=100),
+            "resultados": deque(maxlen=50),
+            "histograma": [0] * (len(LATENCY_BUCKETS) + 1),
+        }
+    return gemini_model_stats[name]
+
+def record_model_result(name, latency, ok, timeout=False):
+    """Registra el resultado de una llamada a un modelo"""
+    stats = get_model_stats(name)
+    stats["llamadas"] += 1
+    stats["resultados"].append(ok)
+    if ok or timeout:
+        # Un timeout cuenta como latencia mínima observada para que el modelo baje en el ranking
+        stats["latencias"].append(latency)
+    if not ok:
+        stats["errores"] += 1
+        if timeout:
+            stats["timeouts"] += 1
+    bucket = len(LATENCY_BUCKETS)
+    for i, limite in enumerate(LATENCY_BUCKETS):
+        if latency <= limite:
+            bucket = i
+            break
+    stats["histograma"][bucket] += 1
+
+def get_model_error_rate(name):
+    """Tasa de error reciente del modelo (últimas 50 llamadas)"""
+    resultados = get_model_stats(name)["resultados"]
+    if not resultados:
+        return 0.0
+    return 1 - sum(resultados) / len(resultados)
+
+def get_model_median_latency(name):
+    """Latencia mediana reciente del modelo (None si no hay datos)"""
+    latencias = sorted(get_model_stats(name)["latencias"])
+    if not latencias:
+        return None
+    return latencias[len(latencias) // 2]
+
+def rank_gemini_models(prefer_fast=False):
+    """Ordena los modelos candidatos para una consulta
+
+    Los modelos con muchos errores recientes van al final. Si prefer_fast es True,
+    se ordenan por latencia mediana observada (los que aún no tienen datos se prueban
+    primero, en el orden configurado); si no, se respeta el orden de GEMINI_MODELS.
+    """
+    def score(item):
+        posicion, name = item
+        degradado = get_model_error_rate(name) >= 0.5 and len(get_model_stats(name)["resultados"]) >= 5
+        if not prefer_fast:
+            return (degradado, posicion)
+        latencia = get_model_median_latency(name)
+        if latencia is None:
+            # Sin latencias registradas: se prueba primero, salvo que solo haya fallado
+            latencia = GEMINI_TIMEOUT if get_model_stats(name)["errores"] else 0
+        penalizada = latencia * (1 + 4 * get_model_error_rate(name))
+        return (degradado, penalizada, posicion)
+    
+    return [name for _, name in sorted(enumerate(GEMINI_MODELS), key=score)]
+
+def extract_gemini_text(response):
+    """Extrae el texto de una respuesta de Gemini"""
+    if hasattr(response, 'text') and response.text:
+        return response.text
+    elif hasattr(response, 'candidates') and response.candidates:
+        candidate = response.candidates[0]
+        if hasattr(candidate, 'content') and hasattr(candidate.content, 'parts'):
+            text_parts = [part.text for part in candidate.content.parts if hasattr(part, 'text')]
+            if text_parts:
+                return ' '.join(text_parts)
+    return None
+
+async def generate_with_router(context_prompt, prefer_fast=False):
+    """Envía el prompt al mejor modelo disponible, pasando al siguiente si falla o tarda demasiado"""
+    loop = asyncio.get_running_loop()
+    for name in rank_gemini_models(prefer_fast):
+        inicio = time.perf_counter()
+        try:
+            model = get_gemini_model(name)
+            response = await asyncio.wait_for(
+                loop.run_in_executor(
+                    gemini_executor,
+                    lambda: model.generate_content(context_prompt, request_options={"timeout": GEMINI_TIMEOUT})
+                ),
+                timeout=GEMINI_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            record_model_result(name, time.perf_counter() - inicio, ok=False, timeout=True)
+            print(f"Timeout del modelo {name} tras {GEMINI_TIMEOUT}s, probando el siguiente")
+            continue
+        except Exception as e:
+            record_model_result(name, time.perf_counter() - inicio, ok=False)
+            print(f"Error del modelo {name}: {e}")
+            continue
+        
+        record_model_result(name, time.perf_counter() - inicio, ok=True)
+        text = extract_gemini_text(response)
+        if text:
+            return text
+    return None
+
+def format_model_stats():
+    """Genera el texto con las estadísticas e histogramas de latencia por modelo"""
+    message = "Modelos de IA (latencia observada)\n\n"
+    etiquetas = [f"<={limite}s" for limite in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}s"]
+    for name in GEMINI_MODELS:
+        stats = get_model_stats(name)
+        mediana = get_model_median_latency(name)
+        message += (
+            f"{name}\n"
+            f"Llamadas: {stats['llamadas']} (errores: {stats['errores']}, timeouts: {stats['timeouts']})\n"
+            f"Tasa de error reciente: {get_model_error_rate(name) * 100:.1f}%\n"
+            f"Latencia mediana: {f'{mediana:.2f}s' if mediana is not None else 'sin datos'}\n"
+        )
+        histograma = ", ".join(
+            f"{etiqueta}: {count}" for etiqueta, count in zip(etiquetas, stats["histograma"]) if count
+        )
+        if histograma:
+            message += f"Histograma: {histograma}\n"
+        message += "\n"
+    return message
+
+async def modelos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Comando /modelos - Muestra latencia y errores de los modelos de IA"""
+    if not gemini_enabled:
+        await reply(update, "La IA no esta disponible.")
+        return
+    await reply(update, format_model_stats())
+
 async def ask_gemini(prompt, dollar_rate=None, user_id=None):
     """Hace una pregunta a Gemini AI con acceso a los datos del usuario"""
-    if not gemini_enabled or not gemini_model:
+    if not gemini_enabled:
         return None
     
     try:
-        prompt_lower = prompt.lower()
-        is_dollar_question = any(word in prompt_lower for word in [
-            'dolar', 'dólar', 'dollar', 'tasa', 'tipo de cambio', 'cambio', 
-            'usd', 'precio del dolar', 'cotizacion', 'cotización'
-        ]) or ('tasa' in prompt_lower and ('cual' in prompt_lower or 'cuál' in prompt_lower or 'que' in prompt_lower or 'qué' in prompt_lower or 'hay' in prompt_lower or 'hoy' in prompt_lower))
-        
-        is_expense_question = any(word in prompt_lower for word in [
-            'gasto', 'gasté', 'gastado', 'gastos', 'resumen', 'resumen del mes', 'resumen mensual',
-            'cuanto he gastado', 'cuánto he gastado', 'cuanto gasté', 'cuánto gasté',
-            'total', 'balance', 'saldo', 'llevo gastado', 'he gastado', 'mis gastos'
-        ])
+        intenciones, _ = detect_intents(prompt.lower(), user_id)
+        is_dollar_question = "dolar" in intenciones
+        is_expense_question = "consulta_gastos" in intenciones
         
         if is_dollar_question and dollar_rate is None:
-            dollar_rate = get_dollar_rate()
+            dollar_rate = await run_io(get_dollar_rate)
         
         expenses_info = ""
         if is_expense_question and user_id:
-            # Ingreso mensual
-            ingreso = get_ingreso_mensual(user_id)
-            
-            # Gastos
-            total_bs, total_usd, gastos = get_month_summary(user_id)
-            current_rate = get_dollar_rate() or dollar_rate
-            
-            # Intercambios (compra de USDT, NO son gastos)
-            intercambios = get_intercambios_month(user_id)
-            total_bs_intercambios = sum(i["bolivares"] for i in intercambios)
-            total_usdt_intercambios = sum(i["usdt"] for i in intercambios)
-            
-            # Saldo disponible
-            saldo_bs, saldo_usdt, _, _ = get_saldo_disponible(user_id)
-            
-            expenses_info = "\n\nINFORMACIÓN FINANCIERA DEL USUARIO (mes actual):\n"
-            
-            if ingreso:
-                expenses_info += f"- Ingreso mensual: {ingreso['bolivares']:,.2f} Bs (${ingreso['usdt']:,.4f} USDT)\n"
-            
-            if total_bs is not None:
-                expenses_info += f"- Total gastado: {total_bs:,.2f} Bs (${total_usd:,.2f} USD)\n"
-                expenses_info += f"- Número de gastos: {len(gastos)}\n"
-            
-            if len(intercambios) > 0:
-                expenses_info += f"- Intercambios (Bs->USDT): {total_bs_intercambios:,.2f} Bs -> {total_usdt_intercambios:,.4f} USDT\n"
-                expenses_info += f"- Número de intercambios: {len(intercambios)}\n"
-            
-            if saldo_bs is not None:
-                expenses_info += f"- Saldo disponible: {saldo_bs:,.2f} Bs (${saldo_usdt:,.2f} USD equivalente)\n"
-            
-            if current_rate:
-                expenses_info += f"- Tipo de cambio oficial actual: {current_rate:,.2f} Bs/$\n"
-            
-            if len(gastos) > 0:
-                expenses_info += f"\nÚltimos gastos:\n"
-                for i, gasto in enumerate(gastos[-5:], 1):
-                    expenses_info += f"{i}. {gasto['fecha']}: {gasto['bolivares']:,.2f} Bs (${gasto['dolares']:,.2f} USD)\n"
-            
-            if len(intercambios) > 0:
-                expenses_info += f"\nÚltimos intercambios:\n"
-                for i, intercambio in enumerate(intercambios[-5:], 1):
-                    expenses_info += f"{i}. {intercambio['fecha']}: {intercambio['bolivares']:,.2f} Bs -> {intercambio['usdt']:,.4f} USDT (tasa: {intercambio['tasa_paralela']:,.2f})\n"
-        
+            # Contexto precalculado del usuario (se actualiza con cada cambio del registro)
+            current_rate = dollar_rate or await run_io(get_dollar_rate)
+            expenses_info = render_ai_context(await run_io(get_ai_context_snapshot, user_id), current_rate)
+
         context_info = ""
         if dollar_rate and is_dollar_question:
             context_info = f"\n\nINFORMACIÓN ACTUAL DEL DÓLAR:\n- Tipo de cambio oficial: {dollar_rate:,.2f} bolívares = 1 dólar USD\n- Esta información es actualizada en tiempo real.\n"
@@ -1551,136 +4304,666 @@ async def ask_gemini(prompt, dollar_rate=None, user_id=None):
             f"- IMPORTANTE: Los intercambios (compra de USDT) NO son gastos, son compra de divisa. Diferencia entre gastos e intercambios.\n"
             f"- Si pregunta por resumen, total, o cuánto ha gastado, proporciona los números exactos sin rodeos\n"
             f"- Si pregunta sobre saldo disponible, usa la información de ingreso menos gastos menos intercambios\n"
+            f"- Si pregunta por meses anteriores o por categorías, usa el historial proporcionado\n"
             f"- Mantén un tono profesional y objetivo en todas tus respuestas\n"
             f"- NUNCA uses emojis, símbolos decorativos, o caracteres especiales innecesarios"
         )
-        response = gemini_model.generate_content(context_prompt)
-        
-        if hasattr(response, 'text') and response.text:
-            return response.text
-        elif hasattr(response, 'candidates') and response.candidates:
-            candidate = response.candidates[0]
-            if hasattr(candidate, 'content') and hasattr(candidate.content, 'parts'):
-                text_parts = [part.text for part in candidate.content.parts if hasattr(part, 'text')]
-                if text_parts:
-                    return ' '.join(text_parts)
-        
-        return None
+        # Preguntas cortas y factuales van al modelo más rápido; el resto sigue el orden de preferencia
+        prefer_fast = len(prompt) <= GEMINI_SHORT_PROMPT_CHARS and not is_expense_question
+        return await generate_with_router(context_prompt, prefer_fast)
     except Exception as e:
         print(f"Error al consultar Gemini: {e}")
         import traceback
         traceback.print_exc()
         return None
 
-def detect_fecha_in_text(text):
-    """Detecta fechas en el texto (ayer, hoy, fechas específicas)"""
+# Palabras clave de intención (coincidencia como subcadena, igual que las búsquedas anteriores)
+INTENT_KEYWORDS = {
+    "compra": ["compre", "compré", "compra de"],
+    "comprar": ["comprar"],
+    "cambio": ["cambie", "cambié", "cambiar"],
+    "gasto": ["gast"],
+    "usdt": ["usdt"],
+    "hoy": ["hoy"],
+    "dolar": ["dolar", "dólar", "dollar", "tasa", "tipo de cambio", "cambio", "usd", "cotizacion", "cotización"],
+    "bolivar": ["bs", "bolivar", "bolívar", "precio"],
+    "consulta_gastos": ["gasto", "gasté", "gastado", "resumen", "total", "balance", "saldo"],
+}
+
+# Autómatas compilados: None para el global, user_id para los que incluyen sinónimos del usuario
+keyword_automata = {}
+
+def build_keyword_automaton(keywords):
+    """Construye un autómata Aho-Corasick
+
+    keywords: diccionario palabra -> lista de (tipo, valor, solo_inicio_palabra).
+    Si solo_inicio_palabra es True, la coincidencia debe empezar al inicio de una palabra.
+    """
+    goto = [{}]
+    fail = [0]
+    output = [[]]
+    for palabra, etiquetas in keywords.items():
+        estado = 0
+        for ch in palabra:
+            if ch not in goto[estado]:
+                goto.append({})
+                fail.append(0)
+                output.append([])
+                goto[estado][ch] = len(goto) - 1
+            estado = goto[estado][ch]
+        output[estado].extend((len(palabra),) + tuple(etiqueta) for etiqueta in etiquetas)
+    
+    # Enlaces de fallo por niveles (BFS)
+    cola = deque(goto[0].values())
+    while cola:
+        r = cola.popleft()
+        for ch, u in goto[r].items():
+            cola.append(u)
+            f = fail[r]
+            while f and ch not in goto[f]:
+                f = fail[f]
+            destino = goto[f].get(ch, 0)
+            fail[u] = destino if destino != u else 0
+            output[u] = output[u] + output[fail[u]]
+    
+    return {"goto": goto, "fail": fail, "output": output}
+
+def scan_keywords(automaton, text):
+    """Recorre el texto una sola vez y devuelve las coincidencias (inicio, fin, tipo, valor)"""
+    goto = automaton["goto"]
+    fail = automaton["fail"]
+    output = automaton["output"]
+    estado = 0
+    matches = []
+    for i, ch in enumerate(text):
+        while estado and ch not in goto[estado]:
+            estado = fail[estado]
+        estado = goto[estado].get(ch, 0)
+        for largo, tipo, valor, solo_inicio_palabra in output[estado]:
+            inicio = i - largo + 1
+            if solo_inicio_palabra and inicio > 0 and text[inicio - 1].isalnum():
+                continue
+            matches.append((inicio, i + 1, tipo, valor))
+    return matches
+
+def _base_keywords():
+    """Palabras clave globales: intenciones y categorías"""
+    keywords = {}
+    for intencion, palabras in INTENT_KEYWORDS.items():
+        for palabra in palabras:
+            keywords.setdefault(palabra, []).append(("intencion", intencion, False))
+    for cat in CATEGORIAS:
+        keywords.setdefault(cat, []).append(("categoria", cat, True))
+    return keywords
+
+def get_keyword_automaton(user_id=None):
+    """Obtiene el autómata compilado (con los sinónimos del usuario, si tiene)"""
+    clave = str(user_id) if user_id is not None else None
+    if clave in keyword_automata:
+        return keyword_automata[clave]
+    
+    keywords = _base_keywords()
+    sinonimos = load_sinonimos().get(clave, {}) if clave is not None else {}
+    if not sinonimos:
+        # Sin sinónimos propios, el usuario comparte el autómata global
+        if None not in keyword_automata:
+            keyword_automata[None] = build_keyword_automaton(keywords)
+        keyword_automata[clave] = keyword_automata[None]
+        return keyword_automata[clave]
+    
+    for palabra, cat in sinonimos.items():
+        keywords.setdefault(palabra, []).append(("categoria", cat, True))
+    keyword_automata[clave] = build_keyword_automaton(keywords)
+    return keyword_automata[clave]
+
+def set_sinonimo(user_id, palabra, categoria):
+    """Registra (o elimina, si categoria es None) un sinónimo de categoría del usuario"""
+    with storage_lock:
+        sinonimos = load_sinonimos()
+        user_sinonimos = sinonimos.setdefault(str(user_id), {})
+        if categoria is None:
+            user_sinonimos.pop(palabra.lower(), None)
+        else:
+            user_sinonimos[palabra.lower()] = categoria
+        save_sinonimos(sinonimos)
+    keyword_automata.pop(str(user_id), None)
+
+def detect_intents(text, user_id=None):
+    """Detecta intenciones y categorías de un texto en minúsculas en una sola pasada"""
+    intenciones = set()
+    categorias = []
+    for inicio, fin, tipo, valor in scan_keywords(get_keyword_automaton(user_id), text):
+        if tipo == "intencion":
+            intenciones.add(valor)
+        else:
+            categorias.append((inicio, fin, valor))
+    return intenciones, categorias
+
+# Tokenizador de mensajes en lenguaje natural (patrón compilado una sola vez)
+MESSAGE_TOKEN_PATTERN = re.compile(
+    r"(?P<fecha>\d{4}-\d{2}-\d{2}|\d{1,2}[/-]\d{1,2}(?:[/-]\d{4})?)"
+    r"|(?P<monto>\d{1,3}(?:\.\d{3})+(?:,\d+)?|\d+(?:[.,]\d+)?)"
+    r"|(?P<simbolo>\$)"
+    r"|(?P<palabra>[a-záéíóúüñ]+)"
+    r"|(?P<separador>[,;\n])"
+)
+
+# Palabras que indican la moneda de un monto
+MONEDAS = {
+    "bs": "bs", "bsf": "bs", "bolivar": "bs", "bolívar": "bs", "bolivares": "bs", "bolívares": "bs",
+    "usd": "usd", "dolar": "usd", "dólar": "usd", "dolares": "usd", "dólares": "usd",
+    "usdt": "usdt",
+}
+
+def parse_message_text(text, user_id=None, hoy=None):
+    """Tokeniza un mensaje en una sola pasada
+
+    Devuelve un diccionario con la lista de tokens (tipo, valor, inicio, fin),
+    los segmentos del mensaje (separados por comas, punto y coma, saltos de
+    línea o la palabra "y"), las intenciones detectadas y los montos, monedas,
+    categorías y fechas encontrados. Las categorías (incluidos los sinónimos
+    del usuario) salen del autómata de palabras clave.
+    """
     text_lower = text.lower()
-    fecha_detectada = None
-    
-    # Detectar "ayer"
-    if "ayer" in text_lower:
-        fecha_detectada = datetime.now() - timedelta(days=1)
-        return fecha_detectada
-    
-    # Detectar "hoy" (aunque es el default, lo marcamos explícitamente)
-    if "hoy" in text_lower:
-        fecha_detectada = datetime.now()
-        return fecha_detectada
-    
-    # Detectar "anteayer" o "hace 2 días"
-    if "anteayer" in text_lower or "hace 2 días" in text_lower or "hace 2 dias" in text_lower:
-        fecha_detectada = datetime.now() - timedelta(days=2)
-        return fecha_detectada
-    
-    # Detectar "hace X días"
-    import re
-    match = re.search(r'hace\s+(\d+)\s+d[ií]as?', text_lower)
-    if match:
-        dias = int(match.group(1))
-        fecha_detectada = datetime.now() - timedelta(days=dias)
-        return fecha_detectada
-    
-    # Detectar fechas en formato YYYY-MM-DD o DD/MM/YYYY o DD-MM-YYYY
-    # Formato YYYY-MM-DD
-    match = re.search(r'(\d{4})-(\d{2})-(\d{2})', text)
-    if match:
-        try:
-            fecha_detectada = datetime(int(match.group(1)), int(match.group(2)), int(match.group(3)))
-            return fecha_detectada
-        except:
-            pass
-    
-    # Formato DD/MM/YYYY o DD-MM-YYYY
-    match = re.search(r'(\d{1,2})[/-](\d{1,2})[/-](\d{4})', text)
-    if match:
-        try:
-            dia = int(match.group(1))
-            mes = int(match.group(2))
-            año = int(match.group(3))
-            fecha_detectada = datetime(año, mes, dia)
-            return fecha_detectada
-        except:
-            pass
-    
-    # Formato DD/MM o DD-MM (asumir año actual)
-    match = re.search(r'(\d{1,2})[/-](\d{1,2})(?!\d)', text)
-    if match:
+    intenciones, categorias = detect_intents(text_lower, user_id)
+    fecha_info = parse_fecha_expresion(text_lower, hoy)
+    spans_fecha = fecha_info["spans"]
+    categoria_por_inicio = {}
+    for inicio, fin, cat in categorias:
+        if inicio not in categoria_por_inicio or fin > categoria_por_inicio[inicio][0]:
+            categoria_por_inicio[inicio] = (fin, cat)
+    
+    tokens = []
+    segmentos = [[]]
+    for match in MESSAGE_TOKEN_PATTERN.finditer(text_lower):
+        tipo = match.lastgroup
+        valor = match.group()
+        if any(inicio <= match.start() < fin for inicio, fin in spans_fecha):
+            # Parte de una expresión de fecha ("18 de noviembre", "hace 3 días")
+            tipo = "fecha"
+        elif tipo == "simbolo":
+            tipo, valor = "moneda", "usd"
+        elif tipo == "palabra":
+            if valor in MONEDAS:
+                tipo, valor = "moneda", MONEDAS[valor]
+            elif valor == "y":
+                tipo = "separador"
+            elif match.start() in categoria_por_inicio:
+                tipo, valor = "categoria", categoria_por_inicio[match.start()][1]
+        
+        token = {"tipo": tipo, "valor": valor, "inicio": match.start(), "fin": match.end()}
+        tokens.append(token)
+        if tipo == "separador":
+            if segmentos[-1]:
+                segmentos.append([])
+        else:
+            segmentos[-1].append(token)
+    
+    if not segmentos[-1]:
+        segmentos.pop()
+    
+    return {
+        "texto": text_lower,
+        "intenciones": intenciones,
+        "tokens": tokens,
+        "segmentos": segmentos,
+        "montos": [parse_monto(t["valor"]) for t in tokens if t["tipo"] == "monto"],
+        "monedas": [t["valor"] for t in tokens if t["tipo"] == "moneda"],
+        "categorias": [t["valor"] for t in tokens if t["tipo"] == "categoria"],
+        "fechas": [t["valor"] for t in tokens if t["tipo"] == "fecha"],
+        "fecha": fecha_info["fecha"],
+        "rango": fecha_info["rango"],
+    }
+
+def parse_monto(valor):
+    """Convierte un monto escrito en el mensaje a float
+
+    Acepta coma decimal ("45,50") y punto de miles ("1.500", "1.200,75").
+    """
+    if re.fullmatch(r"\d{1,3}(?:\.\d{3})+(?:,\d+)?", valor):
+        valor = valor.replace('.', '')
+    return float(valor.replace(',', '.'))
+
+# Palabras que suelen preceder a una fecha y no forman parte de la descripción
+CONECTORES_FECHA = {"el", "del", "de", "la", "los", "desde", "entre"}
+# Palabras que introducen el precio ("2 empanadas por 1000bs")
+CONECTORES_PRECIO = {"por", "a"}
+
+def _is_monto_anclado(segmento, i):
+    """Indica si el token i es un monto seguido de una moneda o de "en" ("50bs", "100 en")"""
+    return (
+        segmento[i]["tipo"] == "monto" and i + 1 < len(segmento)
+        and (segmento[i + 1]["tipo"] == "moneda" or segmento[i + 1]["valor"] == "en")
+    )
+
+def _split_segmento(segmento):
+    """Divide un segmento con varios montos en subsegmentos anclados a montos seguidos de moneda o "en"
+
+    Ejemplo: "gasté 50bs en pasaje 100 en galleta" -> ["gasté 50bs en pasaje", "100 en galleta"]
+    """
+    anclas = [i for i in range(len(segmento)) if _is_monto_anclado(segmento, i)]
+    if len(anclas) <= 1:
+        return [segmento]
+    cortes = [0] + anclas[1:] + [len(segmento)]
+    return [segmento[cortes[i]:cortes[i + 1]] for i in range(len(cortes) - 1)]
+
+def _moneda_de_monto(segmento, i):
+    """Moneda escrita junto al monto i ("80 usd", "$80", "500bs"); "bs" si no se indica"""
+    if i + 1 < len(segmento) and segmento[i + 1]["tipo"] == "moneda":
+        return segmento[i + 1]["valor"]
+    if i > 0 and segmento[i - 1]["tipo"] == "moneda":
+        return segmento[i - 1]["valor"]
+    return "bs"
+
+def extract_gastos(parse):
+    """Extrae los gastos (monto, moneda, categoría y descripción) de un mensaje ya tokenizado
+
+    La moneda es la escrita junto al monto ("bs", "usd" o "usdt"); convertir los
+    montos en dólares a bolívares le toca a quien registra el gasto.
+    """
+    texto = parse["texto"]
+    gastos_detectados = []
+    for segmento_completo in parse["segmentos"]:
+        for segmento in _split_segmento(segmento_completo):
+            es_gasto = any(
+                t["valor"].startswith("gast") or t["valor"] == "bs" or t["valor"] == "en"
+                for t in segmento if t["tipo"] in ("palabra", "moneda")
+            )
+            if not es_gasto:
+                continue
+            
+            # Preferir el monto seguido de moneda o "en" ("2 empanadas por 1000bs" -> 1000)
+            montos = [i for i, t in enumerate(segmento) if t["tipo"] == "monto"]
+            if not montos:
+                continue
+            anclados = [i for i in montos if _is_monto_anclado(segmento, i)]
+            posicion_monto = (anclados or montos)[0]
+            amount = parse_monto(segmento[posicion_monto]["valor"])
+            if amount <= 0:
+                continue
+            
+            categorias = [t["valor"] for t in segmento if t["tipo"] == "categoria"]
+            categoria = categorias[0] if categorias else "otros"
+            
+            # Descripción: texto después del primer "en" del segmento, sin la fecha.
+            # Si el "en" introduce el precio ("2 kilos de carne en 4000 bs"),
+            # se usa lo que hay entre el verbo y el "en"; sin "en", lo que hay entre
+            # el verbo y el monto ("compré 2 empanadas por 1000bs" -> "2 empanadas")
+            descripcion = ""
+            for i, token in enumerate(segmento):
+                if token["valor"] == "en" and token["tipo"] == "palabra":
+                    resto = []
+                    if i + 1 < len(segmento) and segmento[i + 1]["tipo"] == "monto":
+                        verbos = [
+                            j for j, t in enumerate(segmento[:i])
+                            if t["valor"].startswith(("gast", "compr"))
+                        ]
+                        inicio = verbos[0] + 1 if verbos else 0
+                        resto = [t for t in segmento[inicio:i] if t["tipo"] != "fecha"]
+                        while resto and resto[0]["valor"] in CONECTORES_FECHA:
+                            resto.pop(0)
+                    else:
+                        for siguiente in segmento[i + 1:]:
+                            if siguiente["tipo"] == "fecha":
+                                break
+                            resto.append(siguiente)
+                    while resto and resto[-1]["valor"] in CONECTORES_FECHA:
+                        resto.pop()
+                    if resto:
+                        descripcion = texto[resto[0]["inicio"]:resto[-1]["fin"]].strip()
+                    break
+            else:
+                verbos = [
+                    j for j, t in enumerate(segmento[:posicion_monto])
+                    if t["valor"].startswith(("gast", "compr"))
+                ]
+                resto = [t for t in segmento[verbos[0] + 1:posicion_monto] if t["tipo"] != "fecha"] if verbos else []
+                while resto and resto[0]["valor"] in CONECTORES_FECHA:
+                    resto.pop(0)
+                while resto and (resto[-1]["valor"] in CONECTORES_FECHA or resto[-1]["valor"] in CONECTORES_PRECIO):
+                    resto.pop()
+                if resto:
+                    descripcion = texto[resto[0]["inicio"]:resto[-1]["fin"]].strip()
+            
+            gastos_detectados.append({
+                "amount": amount,
+                "moneda": _moneda_de_monto(segmento, posicion_monto),
+                "categoria": categoria,
+                "descripcion": descripcion
+            })
+    
+    # Si no se detectaron gastos por segmentos, usar el primer monto del mensaje
+    if not gastos_detectados and parse["montos"] and parse["montos"][0] > 0:
+        gastos_detectados.append({
+            "amount": parse["montos"][0],
+            "moneda": "bs",
+            "categoria": "otros",
+            "descripcion": ""
+        })
+    
+    return gastos_detectados
+
+def analyze_message(text, user_id=None, hoy=None):
+    """Etapa de análisis de handle_message, sin Telegram ni escrituras
+
+    Devuelve un diccionario con la intención principal ("intercambio_usdt",
+    "intercambio_bs", "gastos", "gastos_hoy", "dolar" o "pregunta"), todas las
+    intenciones detectadas, los montos, los gastos extraídos y la fecha o rango.
+    """
+    parse = parse_message_text(text, user_id, hoy)
+    intenciones = parse["intenciones"]
+    montos = parse["montos"]
+    
+    intencion = "pregunta"
+    gastos = []
+    if intenciones & {"compra", "comprar", "cambio"} and montos and "usdt" in intenciones:
+        intencion = "intercambio_usdt"
+    elif "cambio" in intenciones and "gasto" not in intenciones and montos:
+        intencion = "intercambio_bs"
+    elif intenciones & {"gasto", "compra"} and montos:
+        intencion = "gastos"
+        gastos = extract_gastos(parse)
+    elif "hoy" in intenciones and "gasto" in intenciones:
+        intencion = "gastos_hoy"
+    elif "dolar" in intenciones:
+        intencion = "dolar"
+    
+    return {
+        "intencion": intencion,
+        "intenciones": intenciones,
+        "montos": montos,
+        "gastos": gastos,
+        "fecha": parse["fecha"],
+        "rango": parse["rango"],
+    }
+
+# Corpus de mensajes reales con el análisis esperado
+PARSER_CORPUS_FILE = os.path.join(script_dir, "corpus", "parser_corpus.json")
+
+def _compare_analysis(analisis, esperado):
+    """Compara un análisis con lo esperado; devuelve la lista de diferencias"""
+    diferencias = []
+    if "intencion" in esperado and analisis["intencion"] != esperado["intencion"]:
+        diferencias.append(f"intencion: {analisis['intencion']} != {esperado['intencion']}")
+    if "montos" in esperado and analisis["montos"] != esperado["montos"]:
+        diferencias.append(f"montos: {analisis['montos']} != {esperado['montos']}")
+    if "gastos" in esperado:
+        # Solo se comparan los campos indicados en cada gasto esperado
+        obtenidos = [
+            {campo: g[campo] for campo in esperado_gasto if campo in g}
+            for g, esperado_gasto in zip(analisis["gastos"], esperado["gastos"])
+        ]
+        if len(analisis["gastos"]) != len(esperado["gastos"]) or obtenidos != esperado["gastos"]:
+            diferencias.append(f"gastos: {analisis['gastos']} != {esperado['gastos']}")
+    if "fecha" in esperado:
+        fecha = analisis["fecha"].strftime("%Y-%m-%d") if analisis["fecha"] else None
+        if fecha != esperado["fecha"]:
+            diferencias.append(f"fecha: {fecha} != {esperado['fecha']}")
+    if "rango" in esperado:
+        rango = [d.strftime("%Y-%m-%d") for d in analisis["rango"]] if analisis["rango"] else None
+        if rango != esperado["rango"]:
+            diferencias.append(f"rango: {rango} != {esperado['rango']}")
+    return diferencias
+
+def run_parser_corpus(path=PARSER_CORPUS_FILE, repeticiones=200):
+    """Ejecuta el corpus contra la etapa de análisis de handle_message
+
+    Cada caso tiene "texto", "hoy" (YYYY-MM-DD) y "esperado" (intencion, montos,
+    gastos, fecha y/o rango). Muestra las diferencias, la precisión y los
+    mensajes por segundo. Devuelve (aciertos, total, mensajes_por_segundo).
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        casos = json.load(f)
+    for caso in casos:
+        caso["hoy_fecha"] = datetime.strptime(caso["hoy"], "%Y-%m-%d").date()
+    
+    aciertos = 0
+    for caso in casos:
+        analisis = analyze_message(caso["texto"], hoy=caso["hoy_fecha"])
+        diferencias = _compare_analysis(analisis, caso["esperado"])
+        if diferencias:
+            print(f"FALLA: {caso['texto']!r}")
+            for diferencia in diferencias:
+                print(f"  {diferencia}")
+        else:
+            aciertos += 1
+    
+    # Rendimiento sin la memoización de fechas, para medir el costo real del análisis
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        _parse_fecha_cached.cache_clear()
+        for caso in casos:
+            analyze_message(caso["texto"], hoy=caso["hoy_fecha"])
+    total = time.perf_counter() - inicio
+    mensajes_por_segundo = repeticiones * len(casos) / total if total > 0 else 0
+    
+    print(f"\nPrecision: {aciertos}/{len(casos)} ({aciertos / len(casos) * 100:.1f}%)")
+    print(f"Rendimiento: {mensajes_por_segundo:,.0f} mensajes/s")
+    return aciertos, len(casos), mensajes_por_segundo
+
+# Mensajes de ejemplo para medir el costo del tokenizador
+PARSER_BENCHMARK_MESSAGES = [
+    "gasté 50bs en el pasaje, 100 en una galleta",
+    "compré algo que me costó 2000 bs el día de ayer",
+    "gaste 1500 en comida y 300 en transporte",
+    "compre 20 usdt a 320",
+    "cuanto gaste hoy?",
+    "gasté 22000 en almuerzo el 18/11",
+]
+
+def benchmark_parser(iteraciones=20000):
+    """Mide el costo por mensaje del tokenizador y la extracción de gastos"""
+    inicio = time.perf_counter()
+    for i in range(iteraciones):
+        extract_gastos(parse_message_text(PARSER_BENCHMARK_MESSAGES[i % len(PARSER_BENCHMARK_MESSAGES)]))
+    total = time.perf_counter() - inicio
+    print(f"Tokenizador: {iteraciones} mensajes en {total:.3f}s")
+    print(f"Costo por mensaje: {total / iteraciones * 1e6:.1f} µs ({iteraciones / total:,.0f} mensajes/s)")
+    return total / iteraciones
+
+# Gramática de expresiones de fecha en español (compilada una sola vez)
+MESES = {
+    "enero": 1, "febrero": 2, "marzo": 3, "abril": 4, "mayo": 5, "junio": 6, "julio": 7,
+    "agosto": 8, "septiembre": 9, "setiembre": 9, "octubre": 10, "noviembre": 11, "diciembre": 12,
+}
+DIAS_SEMANA = {
+    "lunes": 0, "martes": 1, "miercoles": 2, "miércoles": 2, "jueves": 3,
+    "viernes": 4, "sabado": 5, "sábado": 5, "domingo": 6,
+}
+NUMEROS_TEXTO = {"un": 1, "una": 1, "dos": 2, "tres": 3, "cuatro": 4, "cinco": 5}
+
+_MES = "|".join(sorted(MESES, key=len, reverse=True))
+_DIA = "|".join(sorted(DIAS_SEMANA, key=len, reverse=True))
+_NUM = r"\d+|" + "|".join(NUMEROS_TEXTO)
+FECHA_PATTERN = re.compile(
+    rf"(?P<rango>\b(?:del|desde\s+el|entre\s+el|entre)\s+(?P<r_d1>\d{{1,2}})(?:\s+de\s+(?P<r_m1>{_MES}))?"
+    rf"\s+(?:al|hasta\s+el|y\s+el|y)\s+(?P<r_d2>\d{{1,2}})\s+de\s+(?P<r_m2>{_MES})(?:\s+(?:de|del)\s+(?P<r_y>\d{{4}}))?\b)"
+    rf"|(?P<iso>\b(?P<iso_y>\d{{4}})-(?P<iso_m>\d{{2}})-(?P<iso_d>\d{{2}})\b)"
+    rf"|(?P<dmy>\b(?P<dmy_d>\d{{1,2}})[/-](?P<dmy_m>\d{{1,2}})(?:[/-](?P<dmy_y>\d{{4}}))?(?![\d/-]))"
+    rf"|(?P<textual>\b(?P<t_d>\d{{1,2}})\s+de\s+(?P<t_m>{_MES})(?:\s+(?:de|del)\s+(?P<t_y>\d{{4}}))?\b)"
+    rf"|(?P<mes>\b(?P<m_m>{_MES})(?:\s+(?:de|del)\s+(?P<m_y>\d{{4}}))?\b)"
+    rf"|(?P<mes_relativo>\b(?:este|el)\s+mes(?P<mr_pasado>\s+pasado)?\b)"
+    rf"|(?P<semana_relativa>\b(?:esta|la)\s+semana(?P<sr_pasada>\s+pasada)?\b)"
+    rf"|(?P<dia_semana>\b(?:el\s+)?(?P<ds_d>{_DIA})(?P<ds_pasado>\s+pasado)?\b)"
+    rf"|(?P<hace>\bhace\s+(?P<h_n>{_NUM})\s+(?P<h_u>d[ií]as?|semanas?)\b)"
+    rf"|(?P<relativo>\b(?:anteayer|antier|ayer|hoy)\b)"
+)
+
+def _fecha_sin_futuro(year, month, day, hoy):
+    """Crea la fecha; si no se indicó año y queda en el futuro, usa el año anterior"""
+    fecha = datetime(year or hoy.year, month, day)
+    if year is None and fecha.date() > hoy:
+        fecha = datetime(hoy.year - 1, month, day)
+    return fecha
+
+def _rango_mes(year, month):
+    """Rango (inicio, fin) de un mes completo"""
+    inicio = datetime(year, month, 1)
+    siguiente = datetime(year + (month == 12), month % 12 + 1, 1)
+    return inicio, siguiente - timedelta(seconds=1)
+
+@functools.lru_cache(maxsize=2048)
+def _parse_fecha_cached(text_lower, day_iso):
+    """Aplica la gramática de fechas a un texto para un día dado (memoizado por texto y día)
+
+    Devuelve (fecha, es_relativa, rango, spans). Las fechas relativas (hoy, ayer,
+    hace N días, días de la semana) conservan la hora actual al usarse.
+    """
+    hoy = datetime.strptime(day_iso, "%Y-%m-%d").date()
+    fecha = None
+    es_relativa = False
+    rango = None
+    spans = []
+    
+    for match in FECHA_PATTERN.finditer(text_lower):
+        tipo = match.lastgroup
+        g = match.group
+        resultado = None
+        relativa = False
+        rango_match = None
         try:
-            dia = int(match.group(1))
-            mes = int(match.group(2))
-            año = datetime.now().year
-            fecha_detectada = datetime(año, mes, dia)
-            # Si la fecha es en el futuro, asumir año anterior
-            if fecha_detectada > datetime.now():
-                fecha_detectada = datetime(año - 1, mes, dia)
-            return fecha_detectada
-        except:
-            pass
+            if tipo == "rango":
+                mes_fin = MESES[g("r_m2")]
+                mes_inicio = MESES[g("r_m1")] if g("r_m1") else mes_fin
+                year = int(g("r_y")) if g("r_y") else None
+                inicio = _fecha_sin_futuro(year, mes_inicio, int(g("r_d1")), hoy)
+                fin = _fecha_sin_futuro(year, mes_fin, int(g("r_d2")), hoy)
+                if fin < inicio:
+                    inicio = datetime(inicio.year - 1, inicio.month, inicio.day)
+                rango_match = (inicio, fin + timedelta(days=1) - timedelta(seconds=1))
+            elif tipo == "iso":
+                resultado = datetime(int(g("iso_y")), int(g("iso_m")), int(g("iso_d")))
+            elif tipo == "dmy":
+                year = int(g("dmy_y")) if g("dmy_y") else None
+                resultado = _fecha_sin_futuro(year, int(g("dmy_m")), int(g("dmy_d")), hoy)
+            elif tipo == "textual":
+                year = int(g("t_y")) if g("t_y") else None
+                resultado = _fecha_sin_futuro(year, MESES[g("t_m")], int(g("t_d")), hoy)
+            elif tipo == "mes":
+                month = MESES[g("m_m")]
+                year = int(g("m_y")) if g("m_y") else (hoy.year if month <= hoy.month else hoy.year - 1)
+                rango_match = _rango_mes(year, month)
+            elif tipo == "mes_relativo":
+                year, month = hoy.year, hoy.month
+                if g("mr_pasado"):
+                    year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+                rango_match = _rango_mes(year, month)
+            elif tipo == "semana_relativa":
+                lunes = datetime.combine(hoy, datetime.min.time()) - timedelta(days=hoy.weekday())
+                if g("sr_pasada"):
+                    lunes -= timedelta(days=7)
+                rango_match = (lunes, lunes + timedelta(days=7) - timedelta(seconds=1))
+            elif tipo == "dia_semana":
+                dias = (hoy.weekday() - DIAS_SEMANA[g("ds_d")]) % 7
+                if g("ds_pasado") and dias <= hoy.weekday():
+                    # "el martes pasado" es el de la semana pasada, no uno de esta semana (ni ayer)
+                    dias += 7
+                resultado = datetime.combine(hoy - timedelta(days=dias), datetime.min.time())
+                relativa = True
+            elif tipo == "hace":
+                n = g("h_n")
+                n = int(n) if n.isdigit() else NUMEROS_TEXTO[n]
+                dias = n * 7 if g("h_u").startswith("semana") else n
+                resultado = datetime.combine(hoy - timedelta(days=dias), datetime.min.time())
+                relativa = True
+            elif tipo == "relativo":
+                dias = {"hoy": 0, "ayer": 1, "anteayer": 2, "antier": 2}[match.group()]
+                resultado = datetime.combine(hoy - timedelta(days=dias), datetime.min.time())
+                relativa = True
+        except ValueError:
+            # Fecha inválida (por ejemplo 31/02): no cuenta como expresión de fecha
+            continue
+        
+        spans.append((match.start(), match.end()))
+        if resultado is not None and fecha is None:
+            fecha, es_relativa = resultado, relativa
+        if rango_match is not None and rango is None:
+            rango = rango_match
     
-    return None
+    return fecha, es_relativa, rango, tuple(spans)
+
+def parse_fecha_expresion(text, hoy=None):
+    """Analiza las expresiones de fecha de un texto
+
+    Reconoce hoy/ayer/anteayer, "hace N días/semanas", días de la semana
+    ("el lunes pasado"), fechas ("2025-11-18", "18/11", "18 de noviembre"),
+    meses ("noviembre", "el mes pasado"), semanas y rangos ("del 1 al 5 de noviembre").
+
+    Devuelve un diccionario con "fecha" (la primera fecha puntual o None),
+    "rango" (el primer rango (inicio, fin) o None) y "spans" (posiciones de
+    todas las expresiones, para poder quitarlas del texto).
+    """
+    ahora = datetime.now()
+    if hoy is None:
+        hoy = ahora.date()
+    fecha, es_relativa, rango, spans = _parse_fecha_cached(text.lower(), hoy.isoformat())
+    if fecha is not None and es_relativa:
+        # Las fechas relativas conservan la hora actual
+        fecha = datetime.combine(fecha.date(), ahora.time())
+    return {"fecha": fecha, "rango": rango, "spans": list(spans)}
+
+def detect_fecha_in_text(text):
+    """Detecta fechas en el texto (ayer, hoy, fechas específicas)"""
+    return parse_fecha_expresion(text)["fecha"]
+
+def remove_spans(text, spans):
+    """Quita del texto los fragmentos indicados por spans (inicio, fin)"""
+    partes = []
+    ultimo = 0
+    for inicio, fin in sorted(spans):
+        partes.append(text[ultimo:inicio])
+        ultimo = max(ultimo, fin)
+    partes.append(text[ultimo:])
+    return " ".join("".join(partes).split())
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Maneja mensajes de texto que no son comandos"""
-    text = update.message.text.lower()
     original_text = update.message.text
-    import re
+    analisis = await run_io(analyze_message, original_text, update.effective_user.id)
+    intencion = analisis["intencion"]
+    numbers = analisis["montos"]
     
     # Detectar compra/intercambio de USDT
     # Formatos: "compre 20 usdt a 320", "compre 20 usdt", "cambie 6400", "cambie 6400 a 320"
-    if any(word in text for word in ["compre", "compré", "comprar", "cambie", "cambié", "cambiar"]):
-        numbers = re.findall(r'\d+[.,]?\d*', text)
+    if intencion in ("intercambio_usdt", "intercambio_bs"):
         if len(numbers) >= 1:
             try:
                 # Si menciona USDT explícitamente
-                if "usdt" in text:
+                if intencion == "intercambio_usdt":
                     # Formato: "compre 20 usdt a 320" o "compre 20 usdt"
-                    amount_usdt = float(numbers[0].replace(',', '.'))
+                    amount_usdt = numbers[0]
                     tasa_paralela = None
                     
                     if len(numbers) >= 2:
                         # Hay tasa especificada
-                        tasa_paralela = float(numbers[1].replace(',', '.'))
+                        tasa_paralela = numbers[1]
                         amount_bs = amount_usdt * tasa_paralela
                     else:
                         # No hay tasa, usar la de la API
-                        tasa_paralela = get_parallel_rate()
+                        tasa_paralela = await run_io(get_parallel_rate)
                         if tasa_paralela is None or tasa_paralela == 0:
-                            await update.message.reply_text(
+                            await reply(
+                                update,
                                 "Error al obtener tasa. Especifica la tasa.\n"
                                 "Ejemplo: compre 20 usdt a 320"
                             )
                             return
                         amount_bs = amount_usdt * tasa_paralela
                     
-                    # Registrar intercambio
-                    amount_usdt_calc, intercambio_id = add_intercambio(
-                        update.effective_user.id,
-                        amount_bs,
-                        tasa_paralela,
-                        f"Compra de {amount_usdt} USDT"
-                    )
+                    # Registrar intercambio (un monto que no llega a 0.0001 USDT se rechaza)
+                    try:
+                        amount_usdt_calc, intercambio_id = await run_io(
+                            add_intercambio,
+                            update.effective_user.id,
+                            amount_bs,
+                            tasa_paralela,
+                            f"Compra de {amount_usdt} USDT"
+                        )
+                    except ValueError as e:
+                        await reply(update, f"No se registro el intercambio: {e}")
+                        return
                     
-                    saldo_bs, saldo_usdt, _, _ = get_saldo_disponible(update.effective_user.id)
+                    saldo_bs, saldo_usdt, _, _ = await run_io(get_saldo_disponible, update.effective_user.id)
                     
                     message = (
                         f"Intercambio registrado (ID: {intercambio_id})\n\n"
@@ -1695,36 +4978,42 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                             f"{saldo_bs:,.2f} Bs (${saldo_usdt:,.2f} USD equivalente)"
                         )
                     
-                    await update.message.reply_text(message)
+                    await reply(update, message)
                     return
                 
                 # Si dice "cambie 6400" o "cambie 6400 a 320" (sin mencionar USDT, asumimos que es Bs a USDT)
-                elif any(word in text for word in ["cambie", "cambié", "cambiar"]) and not "gast" in text:
-                    amount_bs = float(numbers[0].replace(',', '.'))
+                elif intencion == "intercambio_bs":
+                    amount_bs = numbers[0]
                     tasa_paralela = None
                     
                     if len(numbers) >= 2:
                         # Hay tasa especificada
-                        tasa_paralela = float(numbers[1].replace(',', '.'))
+                        tasa_paralela = numbers[1]
                     else:
                         # No hay tasa, usar la de la API
-                        tasa_paralela = get_parallel_rate()
+                        tasa_paralela = await run_io(get_parallel_rate)
                         if tasa_paralela is None or tasa_paralela == 0:
-                            await update.message.reply_text(
+                            await reply(
+                                update,
                                 "Error al obtener tasa. Especifica la tasa.\n"
                                 "Ejemplo: cambie 6400 320"
                             )
                             return
                     
-                    # Registrar intercambio
-                    amount_usdt, intercambio_id = add_intercambio(
-                        update.effective_user.id,
-                        amount_bs,
-                        tasa_paralela,
-                        "Intercambio Bs a USDT"
-                    )
+                    # Registrar intercambio (un monto que no llega a 0.0001 USDT se rechaza)
+                    try:
+                        amount_usdt, intercambio_id = await run_io(
+                            add_intercambio,
+                            update.effective_user.id,
+                            amount_bs,
+                            tasa_paralela,
+                            "Intercambio Bs a USDT"
+                        )
+                    except ValueError as e:
+                        await reply(update, f"No se registro el intercambio: {e}")
+                        return
                     
-                    saldo_bs, saldo_usdt, _, _ = get_saldo_disponible(update.effective_user.id)
+                    saldo_bs, saldo_usdt, _, _ = await run_io(get_saldo_disponible, update.effective_user.id)
                     
                     message = (
                         f"Intercambio registrado (ID: {intercambio_id})\n\n"
@@ -1739,138 +5028,62 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                             f"{saldo_bs:,.2f} Bs (${saldo_usdt:,.2f} USD equivalente)"
                         )
                     
-                    await update.message.reply_text(message)
+                    await reply(update, message)
                     return
                     
             except (ValueError, IndexError):
+                # Números que no se pudieron interpretar: se sigue con la IA o la ayuda
                 pass
     
     # Detectar gasto(s) - puede haber múltiples gastos en un mensaje
-    if "gast" in text or "gasté" in text or "gaste" in text or "compré" in text or "compre" in text:
-        # Detectar fecha en el mensaje
-        fecha_gasto = detect_fecha_in_text(original_text)
+    if intencion == "gastos":
+        # Fecha detectada por el tokenizador
+        fecha_gasto = analisis["fecha"]
         
         # Si no se detectó fecha, usar hoy
         if fecha_gasto is None:
             fecha_gasto = datetime.now()
         
-        # Buscar todos los números en el mensaje
-        numbers = re.findall(r'\d+[.,]?\d*', text)
         if numbers:
             try:
                 # Obtener la tasa para la fecha del gasto
-                dollar_rate = get_tasa_for_date(fecha_gasto, tipo="oficial")
+                dollar_rate = await run_io(get_tasa_for_date, fecha_gasto, tipo="oficial")
                 if not dollar_rate or dollar_rate == 0:
                     # Si no hay tasa para esa fecha, intentar obtener la actual
-                    dollar_rate = get_dollar_rate()
+                    dollar_rate = await run_io(get_dollar_rate)
                     if not dollar_rate or dollar_rate == 0:
-                        await update.message.reply_text(
+                        await reply(
+                            update,
                             "Error al obtener el tipo de cambio. Intenta mas tarde."
                         )
                         return
                 
-                # Detectar múltiples gastos
-                # Patrón: número seguido de "bs" o contexto de gasto
-                gastos_detectados = []
-                
-                # Buscar patrones como "50bs", "100 en", "400 en", etc.
-                # Dividir por comas o "y" para detectar múltiples gastos
-                # También considerar números seguidos de "bs" o "en"
-                partes = re.split(r'[,y]\s*', text)
-                
-                # Si no se dividió bien, intentar detectar números seguidos de "bs" o "en"
-                if len(partes) == 1 or len(numbers) > len(partes):
-                    # Buscar patrones: número + "bs" o número + "en"
-                    patrones = re.findall(r'(\d+[.,]?\d*)\s*(?:bs|en)', text, re.IGNORECASE)
-                    if patrones:
-                        # Reconstruir partes basadas en los patrones encontrados
-                        partes = []
-                        for patron in patrones:
-                            # Buscar el contexto alrededor de cada número
-                            idx = text.lower().find(patron[0])
-                            if idx != -1:
-                                # Extraer desde el número hasta la siguiente coma o fin
-                                resto = text[idx:]
-                                if ',' in resto:
-                                    parte = resto[:resto.find(',')]
-                                elif ' y ' in resto:
-                                    parte = resto[:resto.find(' y ')]
-                                else:
-                                    parte = resto
-                                partes.append(parte.strip())
+                # Gastos detectados a partir de los segmentos del mensaje; los montos
+                # en dólares ("80 usd", "$80") se pasan a bolívares con la tasa del día
+                gastos_detectados = [
+                    dict(g, amount=g["amount"] * dollar_rate) if g["moneda"] in ("usd", "usdt") else g
+                    for g in analisis["gastos"]
+                ]
                 
-                for parte in partes:
-                    if any(word in parte for word in ["gast", "bs", "en"]):
-                        # Buscar número en esta parte
-                        nums_en_parte = re.findall(r'\d+[.,]?\d*', parte)
-                        if nums_en_parte:
-                            try:
-                                amount = float(nums_en_parte[0].replace(',', '.'))
-                                if amount > 0:
-                                    # Intentar detectar categoría o descripción
-                                    categoria = "otros"
-                                    descripcion = ""
-                                    
-                                    # Buscar categorías conocidas
-                                    for cat in CATEGORIAS:
-                                        if cat in parte:
-                                            categoria = cat
-                                            break
-                                    
-                                    # Extraer descripción (texto después del número)
-                                    palabras = parte.split()
-                                    if len(palabras) > 1:
-                                        # Buscar texto descriptivo después de "en"
-                                        if "en" in parte:
-                                            idx_en = parte.find("en")
-                                            descripcion = parte[idx_en+2:].strip()
-                                    
-                                    gastos_detectados.append({
-                                        "amount": amount,
-                                        "categoria": categoria,
-                                        "descripcion": descripcion
-                                    })
-                            except ValueError:
-                                continue
-                
-                # Si no se detectaron múltiples, usar el primer número como antes
-                if not gastos_detectados and numbers:
-                    amount_bs = float(numbers[0].replace(',', '.'))
-                    if amount_bs > 0:
-                        gastos_detectados.append({
-                            "amount": amount_bs,
-                            "categoria": "otros",
-                            "descripcion": ""
-                        })
-                
-                # Registrar todos los gastos detectados
+                # Registrar todos los gastos detectados en una sola escritura
                 if gastos_detectados:
-                    total_bs = 0
-                    total_usd = 0
+                    registrados, (saldo_bs, saldo_usdt), alertas = await run_io(
+                        add_gastos_batch,
+                        update.effective_user.id,
+                        gastos_detectados,
+                        dollar_rate,
+                        fecha_gasto
+                    )
+                    total_bs = sum(g["bolivares"] for g in registrados)
+                    total_usd = sum(g["amount_usd"] for g in registrados)
                     mensajes_gastos = []
                     
-                    for gasto_info in gastos_detectados:
-                        amount_bs = gasto_info["amount"]
-                        categoria = gasto_info["categoria"]
-                        descripcion = gasto_info["descripcion"]
-                        
-                        amount_usd, gasto_id = add_gasto(
-                            update.effective_user.id,
-                            amount_bs,
-                            dollar_rate,
-                            categoria,
-                            descripcion,
-                            fecha_gasto
-                        )
-                        
-                        total_bs += amount_bs
-                        total_usd += amount_usd
-                        
-                        msg_gasto = f"{amount_bs:,.2f} Bs (${amount_usd:,.2f} USD)"
-                        if categoria != "otros":
-                            msg_gasto += f" - {categoria}"
-                        if descripcion:
-                            msg_gasto += f" - {descripcion}"
+                    for g in registrados:
+                        msg_gasto = f"{g['bolivares']:,.2f} Bs (${g['amount_usd']:,.2f} USD)"
+                        if g["categoria"] != "otros":
+                            msg_gasto += f" - {g['categoria']}"
+                        if g["descripcion"]:
+                            msg_gasto += f" - {g['descripcion']}"
                         mensajes_gastos.append(msg_gasto)
                     
                     # Mensaje de confirmación
@@ -1899,29 +5112,29 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                             f"Tipo de cambio ({fecha_str}): {dollar_rate:,.2f} Bs/$\n"
                         )
                     
-                    saldo_bs, saldo_usdt, _, _ = get_saldo_disponible(update.effective_user.id)
                     if saldo_bs is not None:
                         message += (
                             f"\nSaldo disponible:\n"
-                            f"{saldo_bs:,.2f} Bs (${saldo_usdt:,.2f} USD equivalente)"
+                            f"{saldo_bs:,.2f} Bs (${saldo_usdt:,.2f} USD equivalente)\n"
                         )
+                    if alertas:
+                        message += "\n" + "\n".join(alertas)
                     
-                    await update.message.reply_text(message)
+                    await reply(update, message)
                     return
             
             except ValueError:
                 pass
     
     # Detectar preguntas sobre gastos de hoy específicamente
-    hoy_keywords = ['hoy', 'cuanto gaste hoy', 'cuánto gasté hoy', 'gastos de hoy', 'gaste hoy']
-    is_hoy_question = any(keyword in text for keyword in hoy_keywords) and any(word in text for word in ['gast', 'gasté', 'gaste'])
+    is_hoy_question = intencion == "gastos_hoy"
     
     if is_hoy_question:
         hoy = datetime.now().date()
-        gastos = get_gastos_by_date(update.effective_user.id, hoy)
+        gastos = await run_io(get_gastos_by_date, update.effective_user.id, hoy)
         
         if not gastos:
-            await update.message.reply_text("No hay gastos registrados hoy.")
+            await reply(update, "No hay gastos registrados hoy.")
             return
         
         total_bs = sum(g["bolivares"] for g in gastos)
@@ -1944,51 +5157,53 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 message += f"Descripcion: {g['descripcion']}\n"
             message += "\n"
         
-        await update.message.reply_text(message)
+        await reply(update, message)
         return
     
     if gemini_enabled:
-        dollar_keywords = ['dolar', 'dólar', 'dollar', 'tasa', 'tipo de cambio', 'cambio', 'usd', 'precio del dolar', 'cotizacion', 'cotización']
-        is_dollar_question = any(keyword in text for keyword in dollar_keywords) or ('tasa' in text and ('cual' in text or 'cuál' in text or 'que' in text or 'qué' in text or 'hay' in text or 'hoy' in text))
+        is_dollar_question = "dolar" in analisis["intenciones"]
         
         dollar_rate = None
         if is_dollar_question:
-            dollar_rate = get_dollar_rate()
+            dollar_rate = await run_io(get_dollar_rate)
             print(f"Pregunta detectada sobre dólar: '{original_text}'. Tipo de cambio: {dollar_rate}")
         
-        thinking_msg = await update.message.reply_text("Pensando...")
+        thinking_msg = await reply(update, "Pensando...", esperar=True)
         
         try:
             ai_response = await ask_gemini(original_text, dollar_rate, update.effective_user.id)
             
-            await thinking_msg.delete()
+            await delete_message_quietly(thinking_msg)
             
             if ai_response:
-                await update.message.reply_text(ai_response)
+                await reply(update, ai_response)
                 return
             else:
                 if is_dollar_question and dollar_rate:
-                    await update.message.reply_text(
+                    await reply(
+                        update,
                         f"Tipo de cambio del dolar oficial:\n\n"
                         f"{dollar_rate:,.2f} Bs = 1 USD\n\n"
                         f"Esta es la tasa oficial actualizada."
                     )
                     return
         except Exception as e:
-            await thinking_msg.delete()
+            await delete_message_quietly(thinking_msg)
             print(f"Error en handle_message: {e}")
             import traceback
             traceback.print_exc()
             if is_dollar_question:
-                dollar_rate = get_dollar_rate()
+                dollar_rate = await run_io(get_dollar_rate)
                 if dollar_rate:
-                    await update.message.reply_text(
+                    await reply(
+                        update,
                         f"Tipo de cambio del dolar oficial:\n\n"
                         f"{dollar_rate:,.2f} Bs = 1 USD"
                     )
                     return
     
-    await update.message.reply_text(
+    await reply(
+        update,
         "Para registrar un gasto, escribe:\n"
         "/gasto <cantidad>\n\n"
         "O escribe: 'gasté 22000'\n\n"
@@ -2000,49 +5215,756 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         "Usa /start para ver todos los comandos disponibles."
     )
 
+def percentile(values, q):
+    """Percentil q (0-100) de una lista de valores (None si está vacía)"""
+    if not values:
+        return None
+    ordenados = sorted(values)
+    idx = min(len(ordenados) - 1, int(round(q / 100 * (len(ordenados) - 1))))
+    return ordenados[idx]
+
+def get_ai_slot_limit():
+    """Cupos simultáneos para la IA; se reducen a 1 si la prioridad alta supera su objetivo p99"""
+    p99 = percentile(scheduler_metrics[PRIORIDAD_ALTA]["latencias"], 99)
+    if p99 is not None and p99 * 1000 > SCHED_P99_TARGET_MS:
+        return 1
+    return max(1, SCHED_MAX_AI_CONCURRENT)
+
+def _scheduler_dispatch():
+    """Entrega los cupos libres a las tareas en cola, en orden de prioridad y llegada"""
+    cola = scheduler_state["cola"]
+    while cola and scheduler_state["activos"] < SCHED_MAX_CONCURRENT:
+        prioridad, _, futuro = cola[0]
+        if prioridad == PRIORIDAD_BAJA and scheduler_state["activos_ia"] >= get_ai_slot_limit():
+            # En la cima solo quedan consultas a la IA y no hay cupo para ellas
+            break
+        heapq.heappop(cola)
+        if futuro.done():
+            continue
+        scheduler_state["activos"] += 1
+        if prioridad == PRIORIDAD_BAJA:
+            scheduler_state["activos_ia"] += 1
+        futuro.set_result(None)
+
+def _scheduler_release(prioridad):
+    """Libera el cupo de una tarea terminada"""
+    scheduler_state["activos"] -= 1
+    if prioridad == PRIORIDAD_BAJA:
+        scheduler_state["activos_ia"] -= 1
+    _scheduler_dispatch()
+
+@asynccontextmanager
+async def scheduler_slot(prioridad):
+    """Espera un cupo del planificador y lo mantiene mientras dura el bloque"""
+    inicio = time.perf_counter()
+    futuro = asyncio.get_running_loop().create_future()
+    scheduler_state["secuencia"] += 1
+    heapq.heappush(scheduler_state["cola"], (prioridad, scheduler_state["secuencia"], futuro))
+    _scheduler_dispatch()
+    try:
+        await futuro
+    except asyncio.CancelledError:
+        if futuro.done() and not futuro.cancelled():
+            _scheduler_release(prioridad)
+        raise
+    
+    metricas = scheduler_metrics[prioridad]
+    metricas["esperas"].append(time.perf_counter() - inicio)
+    try:
+        yield
+    finally:
+        metricas["atendidos"] += 1
+        metricas["latencias"].append(time.perf_counter() - inicio)
+        _scheduler_release(prioridad)
+
+def message_priority(update):
+    """Prioridad de un mensaje de texto: registros primero, preguntas a la IA al final"""
+    text = update.message.text.lower() if update.message and update.message.text else ""
+    intenciones, _ = detect_intents(text)
+    if intenciones & {"gasto", "compra", "comprar", "cambio"}:
+        return PRIORIDAD_ALTA
+    return PRIORIDAD_BAJA if gemini_enabled else PRIORIDAD_MEDIA
+
+@asynccontextmanager
+async def user_lock(user_id):
+    """Candado por usuario: mantiene en orden los updates de un mismo usuario
+
+    asyncio.Lock atiende a los que esperan en orden de llegada. El candado se
+    elimina cuando nadie lo usa, para no acumular uno por cada usuario visto.
+    """
+    if user_id is None:
+        yield
+        return
+    entrada = user_locks.get(user_id)
+    if entrada is None:
+        entrada = user_locks[user_id] = {"lock": asyncio.Lock(), "usuarios": 0}
+    entrada["usuarios"] += 1
+    try:
+        async with entrada["lock"]:
+            yield
+    finally:
+        entrada["usuarios"] -= 1
+        if entrada["usuarios"] == 0:
+            del user_locks[user_id]
+
+def new_token_bucket(tasa, capacidad):
+    """Token bucket: `tasa` tokens por segundo, hasta `capacidad` acumulados"""
+    return {"tasa": tasa, "capacidad": capacidad, "tokens": float(capacidad), "ultimo": time.monotonic()}
+
+def take_token(bucket):
+    """Reserva un token y devuelve cuántos segundos hay que esperar para usarlo (0 si ya está)"""
+    ahora = time.monotonic()
+    bucket["tokens"] = min(bucket["capacidad"], bucket["tokens"] + (ahora - bucket["ultimo"]) * bucket["tasa"])
+    bucket["ultimo"] = ahora
+    bucket["tokens"] -= 1
+    if bucket["tokens"] >= 0:
+        return 0
+    return -bucket["tokens"] / bucket["tasa"]
+
+async def _send_with_retry(enviar):
+    """Ejecuta un envío; si Telegram responde RetryAfter, espera lo indicado y reintenta"""
+    for intento in range(OUT_MAX_RETRIES + 1):
+        try:
+            return await enviar()
+        except RetryAfter as e:
+            if intento == OUT_MAX_RETRIES:
+                raise
+            outbound_metrics["reintentos"] += 1
+            espera = e.retry_after
+            espera = espera.total_seconds() if hasattr(espera, "total_seconds") else float(espera)
+            print(f"Limite de Telegram alcanzado, reintentando en {espera:.1f} s")
+            await asyncio.sleep(espera)
+
+async def _outbound_worker(chat_id):
+    """Vacía la cola de un chat en orden, respetando los límites del chat y el global"""
+    cola = outbound_state["colas"][chat_id]
+    if chat_id not in outbound_state["buckets"]:
+        tasa = OUT_GROUP_RATE if chat_id < 0 else OUT_CHAT_RATE
+        outbound_state["buckets"][chat_id] = new_token_bucket(tasa, OUT_CHAT_BURST)
+    if outbound_state["global"] is None:
+        # El límite global de Telegram es por bot: con sharding cada trabajador usa su parte
+        tasa_global = OUT_GLOBAL_RATE / max(BOT_WORKERS, 1)
+        outbound_state["global"] = new_token_bucket(tasa_global, tasa_global)
+    
+    try:
+        while cola:
+            enviar, futuro, encolado = cola.popleft()
+            espera = max(take_token(outbound_state["buckets"][chat_id]), take_token(outbound_state["global"]))
+            if espera > 0:
+                await asyncio.sleep(espera)
+            outbound_metrics["esperas"].append(time.perf_counter() - encolado)
+            try:
+                resultado = await _send_with_retry(enviar)
+                outbound_metrics["enviados"] += 1
+                if futuro is not None:
+                    futuro.set_result(resultado)
+            except Exception as e:
+                outbound_metrics["errores"] += 1
+                if futuro is not None:
+                    futuro.set_exception(e)
+                else:
+                    print(f"Error al enviar mensaje al chat {chat_id}: {e}")
+    finally:
+        del outbound_state["colas"][chat_id]
+        del outbound_state["tareas"][chat_id]
+
+async def enqueue_message(chat_id, enviar, esperar=False):
+    """Encola un envío (función sin argumentos que devuelve la corrutina de envío)
+
+    Los envíos de un mismo chat salen en el orden en que se encolaron. Si esperar
+    es True, espera la entrega y devuelve lo que devuelve Telegram (por ejemplo,
+    el mensaje enviado); si no, vuelve de inmediato y los errores solo se registran.
+    """
+    if chat_id is None:
+        return await _send_with_retry(enviar)
+    
+    futuro = asyncio.get_running_loop().create_future() if esperar else None
+    cola = outbound_state["colas"].get(chat_id)
+    if cola is None:
+        cola = outbound_state["colas"][chat_id] = deque()
+    cola.append((enviar, futuro, time.perf_counter()))
+    outbound_metrics["max_cola"] = max(outbound_metrics["max_cola"], len(cola))
+    if chat_id not in outbound_state["tareas"]:
+        outbound_state["tareas"][chat_id] = asyncio.create_task(_outbound_worker(chat_id))
+    
+    if futuro is not None:
+        return await futuro
+    return None
+
+async def reply(update, texto, esperar=False, **kwargs):
+    """Responde al mensaje del update a través de la cola de salida"""
+    chat_id = update.effective_chat.id if update.effective_chat else None
+    return await enqueue_message(
+        chat_id, lambda: update.message.reply_text(texto, **kwargs), esperar
+    )
+
+async def reply_document(update, esperar=False, **kwargs):
+    """Envía un documento como respuesta a través de la cola de salida"""
+    chat_id = update.effective_chat.id if update.effective_chat else None
+    return await enqueue_message(
+        chat_id, lambda: update.message.reply_document(**kwargs), esperar
+    )
+
+async def reply_photo(update, esperar=False, **kwargs):
+    """Envía una imagen como respuesta a través de la cola de salida"""
+    chat_id = update.effective_chat.id if update.effective_chat else None
+    return await enqueue_message(
+        chat_id, lambda: update.message.reply_photo(**kwargs), esperar
+    )
+
+async def delete_message_quietly(mensaje):
+    """Borra un mensaje (como "Pensando..."), ignorando si ya no existe"""
+    if mensaje is None:
+        return
+    try:
+        await mensaje.delete()
+    except TelegramError as e:
+        print(f"No se pudo borrar el mensaje: {e}")
+
+async def drain_outbound(app, timeout=10):
+    """Espera a que se entreguen los mensajes pendientes antes de apagar el bot"""
+    tareas = list(outbound_state["tareas"].values())
+    if tareas:
+        print(f"Enviando {sum(len(c) for c in outbound_state['colas'].values())} mensajes pendientes...")
+        await asyncio.wait(tareas, timeout=timeout)
+
+def format_outbound_metrics():
+    """Genera el texto con el estado de la cola de salida"""
+    pendientes = sum(len(cola) for cola in outbound_state["colas"].values())
+    message = (
+        f"Cola de salida\n"
+        f"Pendientes: {pendientes} en {len(outbound_state['colas'])} chats"
+        f" (maximo por chat: {outbound_metrics['max_cola']})\n"
+        f"Enviados: {outbound_metrics['enviados']} - Reintentos: {outbound_metrics['reintentos']}"
+        f" - Errores: {outbound_metrics['errores']}\n"
+    )
+    espera_p50 = percentile(outbound_metrics["esperas"], 50)
+    if espera_p50 is not None:
+        espera_p99 = percentile(outbound_metrics["esperas"], 99)
+        message += f"Espera p50/p99: {espera_p50 * 1000:,.0f}/{espera_p99 * 1000:,.0f} ms\n"
+    return message + "\n"
+
+def with_priority(handler, prioridad):
+    """Envuelve un handler para ejecutarlo a través del planificador
+
+    prioridad puede ser una constante PRIORIDAD_* o una función que recibe el update.
+    Las consultas a la IA se rechazan si el usuario ya tiene SCHED_AI_QUOTA_PER_USER pendientes.
+    Los updates de distintos usuarios se ejecutan en paralelo; los de un mismo
+    usuario, uno a la vez y en orden de llegada.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        # Durante el arranque, esperar un poco a que las tasas e índices estén listos
+        await wait_until_ready()
+        nivel = prioridad(update) if callable(prioridad) else prioridad
+        user_id = update.effective_user.id if update.effective_user else None
+        
+        if nivel == PRIORIDAD_BAJA and user_id is not None:
+            if scheduler_ai_pending.get(user_id, 0) >= SCHED_AI_QUOTA_PER_USER:
+                scheduler_metrics[nivel]["rechazados"] += 1
+                await reply(
+                    update,
+                    "Tienes demasiadas consultas a la IA en curso. Espera a que terminen."
+                )
+                return
+            scheduler_ai_pending[user_id] = scheduler_ai_pending.get(user_id, 0) + 1
+        
+        try:
+            async with user_lock(user_id):
+                async with scheduler_slot(nivel):
+                    await handler(update, context)
+        finally:
+            if nivel == PRIORIDAD_BAJA and user_id is not None:
+                scheduler_ai_pending[user_id] -= 1
+                if scheduler_ai_pending[user_id] <= 0:
+                    del scheduler_ai_pending[user_id]
+    return wrapper
+
+def format_scheduler_metrics():
+    """Genera el texto con profundidad de cola y tiempos de espera por prioridad"""
+    en_cola = {prioridad: 0 for prioridad in PRIORIDAD_NOMBRES}
+    for prioridad, _, futuro in scheduler_state["cola"]:
+        if not futuro.done():
+            en_cola[prioridad] += 1
+    
+    message = (
+        f"Planificador\n\n"
+        f"En ejecucion: {scheduler_state['activos']}/{SCHED_MAX_CONCURRENT} "
+        f"(IA: {scheduler_state['activos_ia']}/{get_ai_slot_limit()})\n\n"
+    )
+    for prioridad, nombre in PRIORIDAD_NOMBRES.items():
+        metricas = scheduler_metrics[prioridad]
+        espera_p50 = percentile(metricas["esperas"], 50)
+        espera_p99 = percentile(metricas["esperas"], 99)
+        latencia_p99 = percentile(metricas["latencias"], 99)
+        message += (
+            f"Prioridad {nombre}\n"
+            f"En cola: {en_cola[prioridad]} - Atendidos: {metricas['atendidos']}"
+            f" - Rechazados: {metricas['rechazados']}\n"
+        )
+        if espera_p50 is not None:
+            message += f"Espera p50/p99: {espera_p50 * 1000:,.0f}/{espera_p99 * 1000:,.0f} ms\n"
+        if latencia_p99 is not None:
+            message += f"Latencia p99: {latencia_p99 * 1000:,.0f} ms"
+            if prioridad == PRIORIDAD_ALTA:
+                message += f" (objetivo: {SCHED_P99_TARGET_MS:,.0f} ms)"
+            message += "\n"
+        message += "\n"
+    return message
+
+async def metricas(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Comando /metricas - Muestra el estado del planificador, de la E/S y de la cola de salida"""
+    await reply(update, format_scheduler_metrics() + format_outbound_metrics() + format_io_metrics())
+
 # Configuración del bot
-telegram_token = os.getenv('TELEGRAM_TOKEN')
-if not telegram_token:
-    print("Error: TELEGRAM_TOKEN no encontrada en .env")
-    print(f"Directorio actual: {os.getcwd()}")
-    print(f"Ruta del script: {script_dir}")
-    print(f"Buscando .env en: {env_path}")
-    print(f"Existe .env: {os.path.exists(env_path)}")
-    if os.path.exists(env_path):
-        print("Contenido de .env:")
-        with open(env_path, 'r') as f:
-            print(f.read())
-    exit(1)
-
-app = ApplicationBuilder().token(telegram_token).build()
-
-# Agregar handlers
-app.add_handler(CommandHandler("start", start))
-app.add_handler(CommandHandler("gasto", gasto))
-app.add_handler(CommandHandler("resumen", resumen))
-app.add_handler(CommandHandler("dolar", dolar))
-app.add_handler(CommandHandler("ai", ai_command))
-app.add_handler(CommandHandler("listar", listar))
-app.add_handler(CommandHandler("eliminar", eliminar))
-app.add_handler(CommandHandler("editar", editar))
-app.add_handler(CommandHandler("estadisticas", estadisticas))
-app.add_handler(CommandHandler("presupuesto", presupuesto))
-app.add_handler(CommandHandler("comparar", comparar))
-app.add_handler(CommandHandler("buscar", buscar))
-app.add_handler(CommandHandler("gastos_hoy", gastos_hoy))
-app.add_handler(CommandHandler("exportar", exportar))
-app.add_handler(CommandHandler("binance_rate", binance_rate))
-app.add_handler(CommandHandler("cambiar", cambiar))
-app.add_handler(CommandHandler("ingreso", ingreso))
-app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+def warm_storage():
+    """Carga los archivos de datos y construye los índices, arreglos de estadísticas y autómatas de cada usuario"""
+    gastos = load_gastos()
+    for user_id in gastos:
+        get_gastos_index(user_id, gastos)
+        get_gastos_arrays(user_id)
+        get_quantile_sketches(user_id)
+        get_busqueda_index(user_id)
+    for user_id in load_sinonimos():
+        get_keyword_automaton(user_id)
+    load_intercambios()
+    load_ingresos()
+    load_presupuestos()
+    return len(gastos)
 
-if __name__ == "__main__":
-    print("Bot iniciado...")
-    # Guardar tasas del día actual al iniciar
-    print("Guardando tasas del día actual...")
+async def _warm_up_phase(nombre, coro):
+    """Ejecuta una fase del arranque y registra su duración (un fallo no detiene las demás)"""
+    inicio = time.perf_counter()
     try:
-        save_today_rates()
-        print("Tasas del día guardadas correctamente")
+        await coro
+        estado = "ok"
     except Exception as e:
-        print(f"Error al guardar tasas iniciales: {e}")
-    app.run_polling()
+        estado = f"error: {e}"
+    warmup_state["fases"][nombre] = {"segundos": round(time.perf_counter() - inicio, 3), "estado": estado}
+
+async def warm_up(con_datos=True):
+    """Precalienta en paralelo las tasas del día y (si con_datos) los datos e índices"""
+    inicio = time.perf_counter()
+    fases = [
+        _warm_up_phase("tasa_oficial", run_io(get_dollar_rate)),
+        _warm_up_phase("tasa_paralela", run_io(get_parallel_rate)),
+    ]
+    if con_datos:
+        fases.append(_warm_up_phase("datos_e_indices", run_io(warm_storage)))
+    await asyncio.gather(*fases)
+    warmup_state["duracion"] = round(time.perf_counter() - inicio, 3)
+    warmup_state["evento"].set()
+    
+    detalle = ", ".join(
+        f"{nombre}: {fase['segundos']:.2f} s" + ("" if fase["estado"] == "ok" else f" ({fase['estado']})")
+        for nombre, fase in warmup_state["fases"].items()
+    )
+    print(f"Arranque completo en {warmup_state['duracion']:.2f} s ({detalle})")
+
+def start_warm_up(con_datos=True):
+    """Inicia el precalentamiento en segundo plano (el bot ya puede atender updates)"""
+    warmup_state["evento"] = asyncio.Event()
+    warmup_state["tarea"] = asyncio.create_task(warm_up(con_datos))
+
+async def wait_until_ready(timeout=WARMUP_MAX_WAIT):
+    """Espera a que termine el arranque, como mucho `timeout` segundos
+
+    Devuelve False si se agotó el tiempo; el handler sigue igual, con las tasas
+    y los índices obtenidos bajo demanda.
+    """
+    evento = warmup_state["evento"]
+    if evento is None or evento.is_set():
+        return True
+    try:
+        await asyncio.wait_for(evento.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+async def on_startup(app) -> None:
+    """Inicia el endpoint de salud y el precalentamiento sin retrasar la recepción de updates"""
+    await start_health_server(app)
+    start_warm_up()
+
+async def registrar_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Registra la llegada de cada update para el endpoint de salud"""
+    health_state["updates"] += 1
+    health_state["ultima_actualizacion"] = time.time()
+
+def get_health_status():
+    """Estado del bot para el endpoint de salud"""
+    ahora = time.time()
+    ultima = health_state["ultima_actualizacion"]
+    return {
+        "status": "ok",
+        "modo": health_state["modo"],
+        "uptime_s": round(ahora - health_state["inicio"], 1),
+        "updates": health_state["updates"],
+        "segundos_desde_ultimo_update": round(ahora - ultima, 1) if ultima else None,
+        "listo": warmup_state["evento"] is None or warmup_state["evento"].is_set(),
+        "arranque": warmup_state["fases"],
+        "handlers_activos": scheduler_state["activos"],
+        "handlers_en_cola": len(scheduler_state["cola"]),
+        "mensajes_pendientes": sum(len(cola) for cola in outbound_state["colas"].values()),
+        "io_en_curso": io_metrics["en_curso"],
+        "io_espera_p99_ms": round(percentile(io_metrics["esperas"], 99) * 1000, 1) if io_metrics["esperas"] else None,
+    }
+
+async def _health_handler(reader, writer):
+    """Atiende una petición HTTP al endpoint de salud"""
+    try:
+        linea = await asyncio.wait_for(reader.readline(), 5)
+        # Descartar las cabeceras
+        while True:
+            cabecera = await asyncio.wait_for(reader.readline(), 5)
+            if cabecera in (b"\r\n", b"\n", b""):
+                break
+        partes = linea.decode('latin-1').split()
+        metodo = partes[0] if partes else ""
+        ruta = partes[1].split('?')[0] if len(partes) > 1 else ""
+        if metodo in ("GET", "HEAD") and ruta in ("/health", "/healthz"):
+            estado, cuerpo = "200 OK", json.dumps(get_health_status()).encode('utf-8')
+        else:
+            estado, cuerpo = "404 Not Found", b'{"status": "not_found"}'
+        respuesta = (
+            f"HTTP/1.1 {estado}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(cuerpo)}\r\n"
+            f"Connection: close\r\n\r\n"
+        ).encode('latin-1')
+        writer.write(respuesta if metodo == "HEAD" else respuesta + cuerpo)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_health_server(app) -> None:
+    """Inicia el endpoint de salud en el mismo event loop del bot
+
+    El servidor webhook de python-telegram-bot no admite rutas propias,
+    así que el endpoint de salud usa su propio puerto.
+    """
+    if HEALTH_PORT <= 0:
+        return
+    try:
+        health_state["servidor"] = await asyncio.start_server(_health_handler, HEALTH_LISTEN, HEALTH_PORT)
+        print(f"Endpoint de salud en http://{HEALTH_LISTEN}:{HEALTH_PORT}/health")
+    except OSError as e:
+        print(f"No se pudo iniciar el endpoint de salud: {e}")
+
+async def stop_health_server(app) -> None:
+    """Cierra el endpoint de salud"""
+    servidor = health_state["servidor"]
+    if servidor is not None:
+        servidor.close()
+        await servidor.wait_closed()
+        health_state["servidor"] = None
+
+async def on_shutdown(app) -> None:
+    """Cierra el endpoint de salud y espera a que terminen las escrituras pendientes"""
+    await stop_health_server(app)
+    # La espera corre en otro hilo para no bloquear el event loop (y el envío de los
+    # mensajes pendientes) mientras terminan las escrituras
+    await asyncio.to_thread(io_executor.shutdown, wait=True)
+    gemini_executor.shutdown(wait=False, cancel_futures=True)
+
+def get_webhook_secret():
+    """Token secreto del webhook: el de .env o uno aleatorio por arranque"""
+    if WEBHOOK_SECRET:
+        # Telegram solo acepta A-Z, a-z, 0-9, _ y -, hasta 256 caracteres
+        if not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET):
+            print("Error: WEBHOOK_SECRET solo puede tener letras, números, _ y - (máximo 256)")
+            sys.exit(1)
+        return WEBHOOK_SECRET
+    print("Advertencia: WEBHOOK_SECRET no definido, se usará uno aleatorio en este arranque")
+    return uuid.uuid4().hex
+
+def run_bot(app):
+    """Ejecuta el bot en modo polling o webhook según BOT_MODE"""
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            print("Error: BOT_MODE=webhook requiere WEBHOOK_URL (por ejemplo, https://bot.ejemplo.com)")
+            sys.exit(1)
+        if bool(WEBHOOK_CERT) != bool(WEBHOOK_KEY):
+            print("Error: WEBHOOK_CERT y WEBHOOK_KEY deben definirse juntos")
+            sys.exit(1)
+        
+        webhook_url = f"{WEBHOOK_URL}/{WEBHOOK_PATH}"
+        tls = "TLS propio" if WEBHOOK_CERT else "TLS en el proxy inverso"
+        print(f"Modo webhook: {webhook_url} -> {WEBHOOK_LISTEN}:{WEBHOOK_PORT} ({tls})")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=webhook_url,
+            secret_token=get_webhook_secret(),
+            cert=WEBHOOK_CERT or None,
+            key=WEBHOOK_KEY or None,
+        )
+    elif BOT_MODE == "polling":
+        print("Modo polling")
+        app.run_polling()
+    else:
+        print(f"Error: BOT_MODE desconocido '{BOT_MODE}' (usa polling o webhook)")
+        sys.exit(1)
+
+# Archivos con datos por usuario (claves = user_id), que se reparten entre shards
+SHARD_FILES = [GASTOS_FILE, INTERCAMBIOS_FILE, INGRESOS_FILE, PRESUPUESTOS_FILE, SINONIMOS_FILE,
+               PRESUPUESTOS_CATEGORIAS_FILE, POSICIONES_FILE, VENTAS_FILE]
+
+def get_shard_index(user_id, total):
+    """Shard al que pertenece un usuario (siempre el mismo para el mismo user_id)"""
+    return int(user_id) % total
+
+def configure_data_dir(directorio):
+    """Hace que los load_*/save_* de este proceso usen los archivos por usuario de un directorio
+
+    tasas.json no se mueve: las tasas son globales y todos los procesos comparten el mismo archivo.
+    """
+    global GASTOS_FILE, PRESUPUESTOS_FILE, INTERCAMBIOS_FILE, INGRESOS_FILE, SINONIMOS_FILE
+    global PRESUPUESTOS_CATEGORIAS_FILE, POSICIONES_FILE, VENTAS_FILE
+    os.makedirs(directorio, exist_ok=True)
+    GASTOS_FILE = os.path.join(directorio, "gastos.json")
+    PRESUPUESTOS_FILE = os.path.join(directorio, "presupuestos.json")
+    INTERCAMBIOS_FILE = os.path.join(directorio, "intercambios.json")
+    INGRESOS_FILE = os.path.join(directorio, "ingresos.json")
+    SINONIMOS_FILE = os.path.join(directorio, "sinonimos.json")
+    PRESUPUESTOS_CATEGORIAS_FILE = os.path.join(directorio, "presupuestos_categorias.json")
+    POSICIONES_FILE = os.path.join(directorio, "posiciones.json")
+    VENTAS_FILE = os.path.join(directorio, "ventas.json")
+
+def _load_json_file(path):
+    """Carga un JSON si existe (diccionario vacío si no existe o está dañado)"""
+    if os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except:
+            return {}
+    return {}
+
+def prepare_shards(total):
+    """Reparte los datos por usuario entre `total` shards y devuelve sus directorios
+
+    Si el número de shards cambió (o es la primera vez), los datos se combinan
+    desde la distribución anterior (o desde los archivos de un solo proceso) y se
+    escriben en una nueva generación de directorios. shards.json se actualiza al
+    final, así que si el proceso se interrumpe a mitad la distribución anterior
+    sigue intacta. tasas.json no se reparte: todos los procesos usan el de la raíz.
+    """
+    meta_path = os.path.join(SHARDS_DIR, "shards.json")
+    meta = _load_json_file(meta_path)
+    
+    def directorios(generacion, n):
+        return [os.path.join(SHARDS_DIR, f"gen{generacion}", f"shard_{i}") for i in range(n)]
+    
+    if meta.get("total") == total:
+        return directorios(meta["generacion"], total)
+    
+    if meta.get("total", 1) > 1:
+        fuentes = directorios(meta["generacion"], meta["total"])
+    else:
+        fuentes = [os.path.dirname(os.path.abspath(GASTOS_FILE))]
+    generacion = meta.get("generacion", 0) + 1
+    nuevos = directorios(generacion, total)
+    print(f"Repartiendo datos en {total} shards (generacion {generacion})...")
+    
+    for nombre in SHARD_FILES:
+        archivo = os.path.basename(nombre)
+        combinado = {}
+        for fuente in fuentes:
+            combinado.update(_load_json_file(os.path.join(fuente, archivo)))
+        partes = [{} for _ in range(total)]
+        for clave, datos in combinado.items():
+            partes[get_shard_index(clave, total)][clave] = datos
+        for directorio, parte in zip(nuevos, partes):
+            os.makedirs(directorio, exist_ok=True)
+            write_json_atomic(os.path.join(directorio, archivo), parte)
+    
+    os.makedirs(SHARDS_DIR, exist_ok=True)
+    write_json_atomic(meta_path, {"total": total, "generacion": generacion})
+    return nuevos
+
+def merge_shards():
+    """Devuelve los datos de los shards a los archivos de un solo proceso (BOT_WORKERS=1)
+
+    Si la última distribución tenía varios shards, sus archivos son los más nuevos:
+    se combinan y reemplazan los de la raíz, y shards.json pasa a total 1, así el
+    próximo reparto parte de la raíz. Los directorios de los shards no se borran.
+    """
+    meta_path = os.path.join(SHARDS_DIR, "shards.json")
+    meta = _load_json_file(meta_path)
+    if meta.get("total", 1) <= 1:
+        return
+    
+    fuentes = [
+        os.path.join(SHARDS_DIR, f"gen{meta['generacion']}", f"shard_{i}") for i in range(meta["total"])
+    ]
+    print(f"Combinando {meta['total']} shards (generacion {meta['generacion']}) en los archivos de la raiz...")
+    for nombre in SHARD_FILES:
+        combinado = {}
+        for fuente in fuentes:
+            combinado.update(_load_json_file(os.path.join(fuente, os.path.basename(nombre))))
+        write_json_atomic(nombre, combinado)
+    write_json_atomic(meta_path, {"total": 1, "generacion": meta["generacion"]})
+
+def run_shard_worker(indice, directorio, cola):
+    """Punto de entrada de un proceso trabajador: procesa los updates de sus usuarios"""
+    configure_data_dir(directorio)
+    print(f"Trabajador {indice} iniciado (datos en {directorio})")
+    asyncio.run(_shard_worker_loop(cola))
+
+async def _shard_worker_loop(cola):
+    """Recibe updates serializados desde el proceso frontal y los procesa con los handlers"""
+    app = build_app(updater=False)
+    loop = asyncio.get_running_loop()
+    async with app:
+        await app.start()
+        start_warm_up()
+        while True:
+            datos = await loop.run_in_executor(None, cola.get)
+            if datos is None:
+                break
+            await app.update_queue.put(Update.de_json(datos, app.bot))
+        await app.stop()
+        await drain_outbound(app)
+    await on_shutdown(app)
+
+def start_shard_worker(indice):
+    """Inicia (o reinicia) el proceso trabajador de un shard"""
+    contexto = multiprocessing.get_context("spawn")
+    proceso = contexto.Process(
+        target=run_shard_worker,
+        args=(indice, shard_state["directorios"][indice], shard_state["colas"][indice]),
+        name=f"bot-shard-{indice}",
+        daemon=True,
+    )
+    proceso.start()
+    shard_state["procesos"][indice] = proceso
+
+async def dispatch_to_shard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Envía el update al trabajador dueño del usuario (reinicia el trabajador si murió)"""
+    user_id = update.effective_user.id if update.effective_user else 0
+    indice = get_shard_index(user_id, len(shard_state["colas"]))
+    if not shard_state["procesos"][indice].is_alive():
+        print(f"Trabajador {indice} detenido, reiniciando...")
+        start_shard_worker(indice)
+    shard_state["colas"][indice].put(update.to_dict())
+
+async def start_shards(app) -> None:
+    """Inicia los procesos trabajadores y el endpoint de salud del proceso frontal"""
+    for indice in range(len(shard_state["colas"])):
+        start_shard_worker(indice)
+    await start_health_server(app)
+
+async def stop_shards(app) -> None:
+    """Pide a los trabajadores que terminen lo pendiente y espera a que salgan"""
+    for cola in shard_state["colas"]:
+        cola.put(None)
+    for proceso in shard_state["procesos"]:
+        if proceso is not None:
+            await asyncio.get_running_loop().run_in_executor(None, proceso.join, 30)
+    await on_shutdown(app)
+
+def build_sharded_app(total):
+    """Crea la aplicación del proceso frontal: solo recibe updates y los reparte entre shards"""
+    contexto = multiprocessing.get_context("spawn")
+    shard_state["directorios"] = prepare_shards(total)
+    shard_state["colas"] = [contexto.Queue() for _ in range(total)]
+    shard_state["procesos"] = [None] * total
+    
+    # Sin procesamiento concurrente: el reparto conserva el orden de llegada de cada usuario
+    builder = new_app_builder(get_telegram_token())
+    app = builder.post_init(start_shards).post_shutdown(stop_shards).build()
+    app.add_handler(TypeHandler(Update, registrar_update), group=-1)
+    app.add_handler(TypeHandler(Update, dispatch_to_shard))
+    print(f"Modo sharding: {total} procesos trabajadores")
+    return app
+
+def get_telegram_token():
+    """Obtiene el token de Telegram (termina el proceso si no está configurado)"""
+    telegram_token = os.getenv('TELEGRAM_TOKEN')
+    if not telegram_token:
+        print("Error: TELEGRAM_TOKEN no encontrada en .env")
+        print(f"Directorio actual: {os.getcwd()}")
+        print(f"Ruta del script: {script_dir}")
+        print(f"Buscando .env en: {env_path}")
+        print(f"Existe .env: {os.path.exists(env_path)}")
+        if os.path.exists(env_path):
+            print("Contenido de .env:")
+            with open(env_path, 'r') as f:
+                print(f.read())
+        sys.exit(1)
+    return telegram_token
+
+def new_app_builder(telegram_token):
+    """ApplicationBuilder con el token y, si se configuró, la API de Telegram alternativa"""
+    builder = ApplicationBuilder().token(telegram_token)
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL.rstrip('/')}/bot")
+    return builder
+
+def build_app(updater=True):
+    """Crea la aplicación de Telegram y registra los handlers
+
+    Con updater=False la aplicación no recibe updates por sí misma (la usan los
+    procesos trabajadores, que reciben los updates del proceso frontal).
+    """
+    # Procesamiento concurrente de updates: el planificador decide el orden de ejecución
+    builder = new_app_builder(get_telegram_token()).concurrent_updates(True)
+    if not updater:
+        builder = builder.updater(None)
+    app = builder.post_init(on_startup).post_stop(drain_outbound).post_shutdown(on_shutdown).build()
+    
+    # Registrar cada update para el endpoint de salud (antes de los demás handlers)
+    app.add_handler(TypeHandler(Update, registrar_update), group=-1)
+
+    # Agregar handlers
+    app.add_handler(CommandHandler("start", with_priority(start, PRIORIDAD_MEDIA)))
+    app.add_handler(CommandHandler("gasto", with_priority(gasto, PRIORIDAD_ALTA)))
+    app.add_handler(CommandHandler("resumen", with_priority(resumen, PRIORIDAD_MEDIA)))
+    app.add_handler(CommandHandler("dolar", with_priority(dolar, PRIORIDAD_ALTA)))
+    app.add_handler(CommandHandler("ai", with_priority(ai_command, PRIORIDAD_BAJA)))
+    app.add_handler(CommandHandler("modelos", with_priority(modelos, PRIORIDAD_MEDIA)))
+    app.add_handler(CommandHandler("metricas", with_priority(metricas, PRIORIDAD_MEDIA)))
+    app.add_handler(CommandHandler("listar", with_priority(listar, PRIORIDAD_MEDIA)))
+    app.add_handler(CommandHandler("eliminar", with_priority(eliminar, PRIORIDAD_ALTA)))
+    app.add_handler(CommandHandler("editar", with_priority(editar, PRIORIDAD_ALTA)))
+    app.add_handler(CommandHandler("estadisticas", with_priority(estadisticas, PRIORIDAD_MEDIA)))
+    app.add_handler(CommandHandler("presupuesto", with_priority(presupuesto, PRIORIDAD_ALTA)))
+    app.add_handler(CommandHandler("comparar", with_priority(comparar, PRIORIDAD_MEDIA)))
+    app.add_handler(CommandHandler("buscar", with_priority(buscar, PRIORIDAD_MEDIA)))
+    app.add_handler(CallbackQueryHandler(with_priority(paginar, PRIORIDAD_MEDIA), pattern=r"^pag\|"))
+    app.add_handler(CommandHandler("gastos_hoy", with_priority(gastos_hoy, PRIORIDAD_MEDIA)))
+    app.add_handler(CommandHandler("exportar", with_priority(exportar, PRIORIDAD_MEDIA)))
+    app.add_handler(CommandHandler("importar", with_priority(importar, PRIORIDAD_MEDIA)))
+    app.add_handler(MessageHandler(filters.Document.ALL, with_priority(documento_recibido, PRIORIDAD_MEDIA)))
+    app.add_handler(CommandHandler("grafico", with_priority(grafico, PRIORIDAD_MEDIA)))
+    app.add_handler(CommandHandler("binance_rate", with_priority(binance_rate, PRIORIDAD_ALTA)))
+    app.add_handler(CommandHandler("cambiar", with_priority(cambiar, PRIORIDAD_ALTA)))
+    app.add_handler(CommandHandler("posicion", with_priority(posicion, PRIORIDAD_MEDIA)))
+    app.add_handler(CommandHandler("vender", with_priority(vender, PRIORIDAD_ALTA)))
+    app.add_handler(CommandHandler("ingreso", with_priority(ingreso, PRIORIDAD_ALTA)))
+    app.add_handler(CommandHandler("sinonimo", with_priority(sinonimo, PRIORIDAD_ALTA)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, with_priority(handle_message, message_priority)))
+    
+    return app
+
+if __name__ == "__main__":
+    if "--bench-parser" in sys.argv:
+        benchmark_parser()
+        sys.exit(0)
+    if "--corpus" in sys.argv:
+        aciertos, total, _ = run_parser_corpus()
+        sys.exit(0 if aciertos == total else 1)
+    
+    # Las tasas del día se guardan en segundo plano al arrancar (ver warm_up)
+    if BOT_WORKERS > 1:
+        app = build_sharded_app(BOT_WORKERS)
+    else:
+        # Si antes se usaron varios procesos, sus datos vuelven a la raíz antes de cargarlos
+        merge_shards()
+        app = build_app()
+    print("Bot iniciado...")
+    run_bot(app)
@@ -56,6 +56,20 @@ if [ ! -f ".env" ]; then
     cat > .env << EOF
 TELEGRAM_TOKEN=tu_token_aqui
 GEMINI_API_KEY=tu_api_key_aqui
+
+# Modo de ejecución: polling (por defecto) o webhook
+BOT_MODE=polling
+# Webhook (solo con BOT_MODE=webhook)
+#WEBHOOK_URL=https://bot.ejemplo.com
+#WEBHOOK_LISTEN=127.0.0.1
+#WEBHOOK_PORT=8443
+#WEBHOOK_PATH=telegram
+#WEBHOOK_SECRET=cambia_este_secreto
+# Certificado y clave solo si no hay proxy inverso (nginx, caddy) con TLS
+#WEBHOOK_CERT=/etc/ssl/bot/cert.pem
+#WEBHOOK_KEY=/etc/ssl/bot/key.pem
+# Endpoint de salud (GET /health); desactivado si no se indica un puerto
+#HEALTH_PORT=8080
 EOF
     echo "📝 Por favor, edita el archivo .env con tus credenciales:"
     echo "   nano $BOT_DIR/.env"
@@ -73,6 +87,8 @@ Type=simple
 User=$USER
 WorkingDirectory=$BOT_DIR
 Environment="PATH=/usr/bin:/usr/local/bin"
+# BOT_MODE y la configuración del webhook se leen desde .env
+EnvironmentFile=$BOT_DIR/.env
 ExecStart=$BOT_DIR/venv/bin/python3 $BOT_DIR/bot.py
 Restart=always
 RestartSec=10